@@ -1,7 +1,11 @@
+import asyncio
 import logging
 from dataclasses import dataclass
 from uuid_extensions import uuid7str
-from pydantic_ai import Agent, RunContext
+import datetime
+from pydantic_ai import Agent, ModelRetry, RunContext
+from agents.router import model_router
+from services.projection import projected
 from models import (
     Office,
     Appointment,
@@ -11,20 +15,15 @@ from models import (
 )
 
 from utils import actual_date_time
-from services.speciality import find_specilities_by_office_id
-from services.doctor import (
-  find_doctor_by_name,
-  find_doctors_by_office_id
-)
-
-from services.office import (
-  find_office_by_id,
-)
+from database import UnitOfWork, after_commit
+from services.reference import find_office_reference
+from services import slots
+from services.aio import appointment as aio_appointment, patient as aio_patient, slots as aio_slots
+from services.aio.database import AsyncUnitOfWork, run_read, run_write
 
 from services.appointment import (
     list_office_appointments,
     find_appointment,
-    add_appointment,
     delete_appointment
 )
 
@@ -33,6 +32,10 @@ from services.patient import (
     add_patient,
 )
 
+from services.contact import refresh_contact_view
+from services.context import AppointmentContext
+from services.routing import routing_resolver
+
 logger = logging.getLogger('health_up:appointment_agent')
 logger.setLevel(logging.CRITICAL)
 
@@ -41,14 +44,14 @@ class AppointmentDependencies:
     office_id: str
     patient_id: str
     patient_phone_number: str
+    uow: UnitOfWork | AsyncUnitOfWork | None = None
+    # Prefetched before the run, the tools serve from it when present.
+    context: AppointmentContext | None = None
     
-# ollama_model = OpenAIModel(
-#     model_name='phi4-mini', provider=OpenAIProvider(base_url='http://localhost:11434/v1')
-# )    
-
-appointment_agent = Agent("openai:gpt-4o", system_prompt="""
+appointment_agent = Agent(model_router, name='appointment_agent', system_prompt="""
                 Date format is: DD/MM/YYYY
                 Reply patient with patient name
+                When a current context message is given, use it instead of calling the tools below for the same data.
                 You are a secretary in a dental office. Perform the following steps:
                 1. Say patient can use word 'menu' to see the menu.
                 2. Use `get_office_info` tool to retrieve office info from database.
@@ -72,8 +75,8 @@ appointment_agent = Agent("openai:gpt-4o", system_prompt="""
                 14. Show numbered list of doctors by name.
                 15. Ask the patient to select a doctor by number.
                 16. If patient choose a doctor, extract doctor id.
-                17. Use the `list_appointments` tool to get a list of office existing appointments.
-                18. Based on a list of existing appointments, suggest a numbered list of 10 available dates and hours for the next two weeks to the patient using current date and time.
+                17. Use the `find_available_slots` tool with the doctor id to get the available dates and hours for the next two weeks.
+                18. Show the available dates and hours to the patient as a numbered list, never suggest any other date and hour.
                 19. Ask the patient to select a date and time by number.
                 20. Use patient id and doctor id to schedule the appointment.
                 21. If the patient confirms, extract appointment.
@@ -85,6 +88,13 @@ appointment_agent = Agent("openai:gpt-4o", system_prompt="""
                 25. If the patient says yes, say: Ok, see you soon!
               """)
 
+def patient_created(deps: AppointmentDependencies):
+    try:
+        refresh_contact_view()
+    except Exception as e:
+        logger.error(f"Error refreshing contacts: {e}")
+    routing_resolver.invalidate(deps.office_id, deps.patient_phone_number)
+
 @appointment_agent.tool
 def current_date_time(ctx: RunContext[AppointmentDependencies]) -> str:
     logger.info("Add date and time...")
@@ -96,69 +106,125 @@ def get_patient_id(ctx: RunContext[AppointmentDependencies]) -> Patient:
     return ctx.deps.patient_id
 
 @appointment_agent.tool
-def get_patient(ctx: RunContext[AppointmentDependencies]) -> Patient:
+@projected
+async def get_patient(ctx: RunContext[AppointmentDependencies]) -> Patient:
     logger.info("Get patient...")
-    patient = find_patient(ctx.deps.office_id, ctx.deps.patient_phone_number)
+    if ctx.deps.context is not None:
+        return ctx.deps.context.patient
+    patient = await run_read(find_patient, aio_patient.find_patient,
+                             ctx.deps.office_id, ctx.deps.patient_phone_number,
+                             uow=ctx.deps.uow)
     return patient
 
 @appointment_agent.tool
-def create_patient(ctx: RunContext[AppointmentDependencies], 
-                   patient: Patient) -> Patient:
+@projected
+async def create_patient(ctx: RunContext[AppointmentDependencies], 
+                         patient: Patient) -> Patient:
     patient.id = uuid7str()
     patient.phone_number = ctx.deps.patient_phone_number
     patient.office_id = ctx.deps.office_id
-    add_patient(patient)
+    await run_write(add_patient, aio_patient.add_patient, patient, uow=ctx.deps.uow)
+    if ctx.deps.context is not None:
+        ctx.deps.context.patient = patient
+    after_commit(ctx.deps.uow, lambda: patient_created(ctx.deps))
     return patient
 
 @appointment_agent.tool
+@projected
 def get_office_info(ctx: RunContext[AppointmentDependencies]) -> Office:
     logger.info("Get office info...")
-    return find_office_by_id(ctx.deps.office_id)
+    if ctx.deps.context is not None:
+        return ctx.deps.context.office
+    return find_office_reference(ctx.deps.office_id).office
 
 @appointment_agent.tool
+@projected
 def list_doctors(ctx: RunContext[AppointmentDependencies]) -> list[Doctor]:
     logger.info("Get office doctors...")
-    return find_doctors_by_office_id(ctx.deps.office_id)
+    if ctx.deps.context is not None:
+        return ctx.deps.context.doctors
+    return find_office_reference(ctx.deps.office_id).doctors
 
 @appointment_agent.tool
+@projected
 def get_doctor(ctx: RunContext[AppointmentDependencies], doctor_name: str) -> Patient:
     logger.info("Get doctor...")
-    return find_doctor_by_name(
-      ctx.deps.office_id, 
-      doctor_name
-    )
+    return find_office_reference(ctx.deps.office_id).doctor_by_name(doctor_name)
     
 @appointment_agent.tool
+@projected
 def list_specialities(ctx: RunContext[AppointmentDependencies]) -> list[Speciality]:
     logger.info("Get office specialists...")
-    return find_specilities_by_office_id(ctx.deps.office_id)
+    if ctx.deps.context is not None:
+        return ctx.deps.context.specialities
+    return find_office_reference(ctx.deps.office_id).specialities
   
 @appointment_agent.tool
-def list_appointments(ctx: RunContext[AppointmentDependencies]) -> list[Appointment]:
+@projected
+async def list_appointments(ctx: RunContext[AppointmentDependencies]) -> list[Appointment]:
     logger.info("Listing appointments...")
     now = actual_date_time('America/Sao_Paulo')
-    return list_office_appointments(ctx.deps.office_id, now.date_time)
+    return await run_read(list_office_appointments, aio_appointment.list_office_appointments,
+                          ctx.deps.office_id, now.date_time, uow=ctx.deps.uow)
   
 @appointment_agent.tool
-def get_appointment(ctx: RunContext[AppointmentDependencies]) -> Appointment:
+async def find_available_slots(ctx: RunContext[AppointmentDependencies], doctor_id: str,
+                         date_from: datetime.datetime | None = None,
+                         date_to: datetime.datetime | None = None,
+                         n: int = 10) -> list[datetime.datetime]:
+    """Finds the first `n` free dates and hours of a doctor, for the next two weeks by default."""
+    logger.info("Finding available slots...")
+    if ctx.deps.context is not None:
+        office = ctx.deps.context.office
+    else:
+        office = (await asyncio.to_thread(find_office_reference, ctx.deps.office_id)).office
+    return await run_read(slots.find_available_slots, aio_slots.find_available_slots,
+                          office.opening_hours, doctor_id, date_from, date_to, n,
+                          uow=ctx.deps.uow)
+
+@appointment_agent.tool
+@projected
+async def get_appointment(ctx: RunContext[AppointmentDependencies]) -> Appointment:
     logger.info("Get appointment...")
+    if ctx.deps.context is not None:
+        return ctx.deps.context.appointment
     now = actual_date_time('America/Sao_Paulo')
-    return find_appointment(ctx.deps.office_id, 
-                            ctx.deps.patient_id, 
-                            now.date_time)
+    return await run_read(find_appointment, aio_appointment.find_appointment,
+                          ctx.deps.office_id, 
+                          ctx.deps.patient_id, 
+                          now.date_time,
+                          uow=ctx.deps.uow)
 
-@appointment_agent.tool_plain
-def cancel_appointment(appointment: Appointment) -> bool:
+@appointment_agent.tool
+async def cancel_appointment(ctx: RunContext[AppointmentDependencies], 
+                             appointment: Appointment) -> bool:
     logger.info("Canceling appointment: ", appointment)
-    return delete_appointment(appointment)
+    deleted = await run_write(delete_appointment, aio_appointment.delete_appointment,
+                              appointment, uow=ctx.deps.uow)
+    if deleted and ctx.deps.context is not None:
+        ctx.deps.context.appointment = None
+    return deleted
   
-@appointment_agent.tool
-def create_appointment(ctx: RunContext[AppointmentDependencies], 
-                       appointment: Appointment, patient_id, doctor_id) -> Appointment:
+# Taken slots are sent back to the model with free ones to pick from.
+@appointment_agent.tool(retries=3)
+@projected
+async def create_appointment(ctx: RunContext[AppointmentDependencies], 
+                             appointment: Appointment, patient_id, doctor_id) -> Appointment:
     logger.info("Creating appointment: ", appointment)
     appointment.id = uuid7str()
     appointment.office_id = ctx.deps.office_id
     appointment.doctor_id = doctor_id
     appointment.patient_id = patient_id if patient_id else ctx.deps.patient_id
-    add_appointment(appointment)
+    office = (await asyncio.to_thread(find_office_reference, ctx.deps.office_id)).office
+    try:
+        await run_write(slots.reserve_slot, aio_slots.reserve_slot,
+                        appointment, office.opening_hours, uow=ctx.deps.uow)
+    except slots.SlotUnavailable as e:
+        available = await run_read(slots.find_available_slots, aio_slots.find_available_slots,
+                                   office.opening_hours, appointment.doctor_id,
+                                   limit=5, uow=ctx.deps.uow)
+        raise ModelRetry(f"{e}, pick one of the available slots: "
+                         f"{', '.join(f'{slot:%d/%m/%Y %H:%M}' for slot in available)}")
+    if ctx.deps.context is not None:
+        ctx.deps.context.appointment = appointment
     return appointment
\ No newline at end of file
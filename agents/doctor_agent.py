@@ -3,6 +3,8 @@ import pytz
 import logging
 from dataclasses import dataclass
 from pydantic_ai import Agent, RunContext
+from agents.router import model_router
+from services.projection import projected
 from models import (
     Appointment,
     DoctorAppointment,
@@ -10,6 +12,9 @@ from models import (
 )
 
 from utils import actual_date_time
+from database import UnitOfWork
+from services.aio import appointment as aio_appointment, doctor as aio_doctor, patient as aio_patient
+from services.aio.database import AsyncUnitOfWork, run_read, run_write
 from services.doctor import (
   find_doctor_by_id,
 )
@@ -18,6 +23,8 @@ from services.patient import (
   find_patient_history,
 )
 
+from services.reference import find_office_reference
+
 from services.appointment import (
     delete_appointment,
     list_doctor_appointments,
@@ -31,12 +38,9 @@ class DoctorDependencies:
     office_id: str
     doctor_id: str
     doctor_phone_number: str
+    uow: UnitOfWork | AsyncUnitOfWork | None = None
 
-# ollama_model = OpenAIModel(
-#     model_name='llama3.2', provider=OpenAIProvider(base_url='http://localhost:11434/v1')
-# )   
-
-doctor_agent = Agent("openai:gpt-4o", system_prompt="""
+doctor_agent = Agent(model_router, name='doctor_agent', system_prompt="""
                 Date format is: DD/MM/YYYY
                 You are a doctor secretary in a dental office. Perform the following steps:
                 1. Remember doctor can use word 'menu' to see the menu.
@@ -62,27 +66,42 @@ def current_date_time() -> str:
     return f"Current date and time is: {datetime.datetime.now(tz).strftime("%Y-%m-%dT%H:%M:%S%z")}"
   
 @doctor_agent.tool
-def list_appointments(ctx: RunContext[DoctorDependencies]) -> list[DoctorAppointment]:
+@projected
+async def list_appointments(ctx: RunContext[DoctorDependencies]) -> list[DoctorAppointment]:
     logger.info("Listing appointments...")
     now = actual_date_time('America/Sao_Paulo')
-    return list_doctor_appointments(ctx.deps.doctor_id, now.date_time)
+    return await run_read(list_doctor_appointments, aio_appointment.list_doctor_appointments,
+                          ctx.deps.doctor_id, now.date_time, uow=ctx.deps.uow)
 
 @doctor_agent.tool
-def get_doctor(ctx: RunContext[DoctorDependencies]) -> Patient:
+@projected
+async def get_doctor(ctx: RunContext[DoctorDependencies]) -> Patient:
     logger.info("Get doctor...")
-    return find_doctor_by_id(
+    doctor = find_office_reference(ctx.deps.office_id).doctor(ctx.deps.doctor_id)
+    if doctor is not None:
+        return doctor
+    return await run_read(
+      find_doctor_by_id,
+      aio_doctor.find_doctor_by_id,
       ctx.deps.doctor_id, 
+      uow=ctx.deps.uow
     )
     
     
-@doctor_agent.tool_plain
-def get_patient_history(patient_id) -> Patient:
+@doctor_agent.tool
+@projected
+async def get_patient_history(ctx: RunContext[DoctorDependencies], patient_id) -> Patient:
     logger.info("Get patient history...")
-    return find_patient_history(
-      patient_id
+    return await run_read(
+      find_patient_history,
+      aio_patient.find_patient_history,
+      patient_id,
+      uow=ctx.deps.uow
     )
   
-@doctor_agent.tool_plain
-def cancel_appointment(appointment: Appointment) -> bool:
+@doctor_agent.tool
+async def cancel_appointment(ctx: RunContext[DoctorDependencies], 
+                             appointment: Appointment) -> bool:
     logger.info("Canceling appointment: ", appointment)
-    return delete_appointment(appointment)
+    return await run_write(delete_appointment, aio_appointment.delete_appointment,
+                           appointment, uow=ctx.deps.uow)
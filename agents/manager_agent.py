@@ -2,16 +2,19 @@ import datetime
 import pytz
 import logging
 from dataclasses import dataclass
+from database import UnitOfWork
+from services.aio import manager as aio_manager
+from services.aio.database import AsyncUnitOfWork, run_read
 from pydantic_ai import Agent, RunContext
+from agents.router import model_router
+from services.projection import projected
 from models import (
     Office,
     Manager,
     OfficeInventory
 )
 
-from services.office import (
-  find_office_by_id,
-)
+from services.reference import find_office_reference
 
 from services.manager import (
   find_manager_by_id,
@@ -25,12 +28,9 @@ class ManagerDependencies:
     office_id: str
     manager_id: str
     manager_phone_number: str
+    uow: UnitOfWork | AsyncUnitOfWork | None = None
 
-# ollama_model = OpenAIModel(
-#     model_name='llama3.2', provider=OpenAIProvider(base_url='http://localhost:11434/v1')
-# )   
-
-manager_agent = Agent("openai:gpt-4o", system_prompt="""
+manager_agent = Agent(model_router, name='manager_agent', system_prompt="""
                 You are a secretary in a dental office. Perform the following steps:
                 1. Remember manager can use word 'menu' to see the menu.                
                 2. Use the `get_manager` tool to retrieve doctor info from database.
@@ -46,9 +46,10 @@ def current_date_time() -> str:
     return f"Current date and time is: {datetime.datetime.now(tz).strftime("%Y-%m-%dT%H:%M:%S %Z")}"
   
 @manager_agent.tool
+@projected
 def get_office_info(ctx: RunContext[ManagerDependencies]) -> Office:
     logger.info("Get office info...")
-    return find_office_by_id(ctx.deps.office_id)
+    return find_office_reference(ctx.deps.office_id).office
   
 @manager_agent.tool
 def get_office_inventory(ctx: RunContext[ManagerDependencies]) -> OfficeInventory:
@@ -60,7 +61,9 @@ def get_office_inventory(ctx: RunContext[ManagerDependencies]) -> OfficeInventor
     return inventories
       
 @manager_agent.tool  
-def get_manager(ctx: RunContext[ManagerDependencies]) -> Manager:
+@projected
+async def get_manager(ctx: RunContext[ManagerDependencies]) -> Manager:
     logger.info("Get office info...")
-    return find_manager_by_id(ctx.deps.manager_id)
+    return await run_read(find_manager_by_id, aio_manager.find_manager_by_id,
+                          ctx.deps.manager_id, uow=ctx.deps.uow)
 
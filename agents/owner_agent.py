@@ -2,7 +2,12 @@ import datetime
 import pytz
 import logging
 from dataclasses import dataclass
+from database import UnitOfWork
+from services.aio import owner as aio_owner
+from services.aio.database import AsyncUnitOfWork, run_read
 from pydantic_ai import Agent, RunContext
+from agents.router import model_router
+from services.projection import projected
 from models import (
     Office,
     Owner,
@@ -10,9 +15,7 @@ from models import (
     OfficePopularServices
 )
 
-from services.office import (
-  find_office_by_id,
-)
+from services.reference import find_office_reference
 
 from services.owner import (
   find_owner_by_id,
@@ -26,12 +29,9 @@ class OwnerDependencies:
     office_id: str
     owner_id: str
     owner_phone_number: str
+    uow: UnitOfWork | AsyncUnitOfWork | None = None
 
-# ollama_model = OpenAIModel(
-#     model_name='llama3.2', provider=OpenAIProvider(base_url='http://localhost:11434/v1')
-# )   
-
-owner_agent = Agent("openai:gpt-4o", system_prompt="""
+owner_agent = Agent(model_router, name='owner_agent', system_prompt="""
                 You are a secretary in a dental office. Perform the following steps:
                 1. Remember owner can use word 'menu' to see the menu.                
                 2. Use the `get_owner` tool to retrieve owner info from database.
@@ -49,14 +49,17 @@ def current_date_time() -> str:
     return f"Current date and time is: {datetime.datetime.now(tz).strftime("%Y-%m-%dT%H:%M:%S %Z")}"
   
 @owner_agent.tool
+@projected
 def get_office_info(ctx: RunContext[OwnerDependencies]) -> Office:
     logger.info("Get office info...")
-    return find_office_by_id(ctx.deps.office_id)
+    return find_office_reference(ctx.deps.office_id).office
 
 @owner_agent.tool
-def get_owner(ctx: RunContext[OwnerDependencies]) -> Owner:
+@projected
+async def get_owner(ctx: RunContext[OwnerDependencies]) -> Owner:
     logger.info("Get office info...")
-    return find_owner_by_id(ctx.deps.owner_id)
+    return await run_read(find_owner_by_id, aio_owner.find_owner_by_id,
+                          ctx.deps.owner_id, uow=ctx.deps.uow)
    
 @owner_agent.tool
 def get_office_revenue(ctx: RunContext[OwnerDependencies]) -> OfficeRevenue:
@@ -0,0 +1,245 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import threading
+import unicodedata
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import httpx
+import openai
+from dotenv import load_dotenv
+from pydantic_ai.exceptions import FallbackExceptionGroup, ModelHTTPError
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    RetryPromptPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models import Model, ModelRequestParameters, StreamedResponse, infer_model
+from pydantic_ai.models.openai import OpenAIModel
+from pydantic_ai.providers.openai import OpenAIProvider
+from pydantic_ai.settings import ModelSettings
+from pydantic_ai.usage import Usage
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:router')
+
+primary_model = os.getenv('MODEL_PRIMARY') or 'openai:gpt-4o'
+# Empty disables tiering, every request goes to the primary models.
+light_model = os.getenv('MODEL_LIGHT') or ''
+fallback_models = os.getenv('MODEL_FALLBACKS') or ''
+failover_cooldown = float(os.getenv('MODEL_FAILOVER_COOLDOWN') or 30)
+light_max_words = int(os.getenv('MODEL_LIGHT_MAX_WORDS') or 4)
+ollama_base_url = os.getenv('OLLAMA_BASE_URL') or 'http://localhost:11434/v1'
+
+# Rate limits and provider side errors, another model may well succeed.
+FAILOVER_STATUSES = {408, 409, 429, 500, 502, 503, 504, 529}
+FAILOVER_ERRORS = (
+    TimeoutError,
+    asyncio.TimeoutError,
+    httpx.TransportError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+)
+
+# Greetings, menu navigation and confirmations, in English and Portuguese.
+SIMPLE_WORDS = {
+    'oi', 'ola', 'hi', 'hello', 'hey', 'bom', 'boa', 'dia', 'tarde', 'noite', 'good',
+    'morning', 'afternoon', 'evening', 'menu', 'sim', 'nao', 'yes', 'no', 'ok', 'okay',
+    'certo', 'beleza', 'pode', 'ser', 'confirmo', 'confirmar', 'confirm', 'confirmed',
+    'obrigado', 'obrigada', 'valeu', 'thanks', 'thank', 'you', 'tchau', 'bye', 'isso',
+    'perfeito', 'otimo', 'great', 'sure', 'claro', 'combinado',
+}
+WORD = re.compile(r'[a-z]+|\d+')
+
+class ModelUnavailable(Exception):
+    def __init__(self, model_name: str, seconds: float):
+        super().__init__(f"{model_name} is cooling down for {seconds:.0f}s after a failure")
+
+def should_fail_over(error: Exception) -> bool:
+    if isinstance(error, ModelHTTPError):
+        return error.status_code in FAILOVER_STATUSES
+    return isinstance(error, (ModelUnavailable, *FAILOVER_ERRORS))
+
+def create_model(name: str) -> Model:
+    """Model from a name like `openai:gpt-4o`, or `ollama:phi4-mini` for a local model."""
+    if name.startswith('ollama:'):
+        return OpenAIModel(name.removeprefix('ollama:'),
+                           provider=OpenAIProvider(base_url=ollama_base_url, api_key='ollama'))
+    return infer_model(name)
+
+def is_simple_turn(messages: list[ModelMessage],
+                   model_request_parameters: ModelRequestParameters,
+                   max_words: int = light_max_words) -> bool:
+    """Whether the request answers a short greeting, menu option or confirmation.
+
+    Requests carrying tool results, retries or a structured result always
+    need the primary models.
+    """
+    if model_request_parameters.result_tools or not messages:
+        return False
+    request = messages[-1]
+    if not isinstance(request, ModelRequest):
+        return False
+    if any(isinstance(part, (ToolReturnPart, RetryPromptPart)) for part in request.parts):
+        return False
+    prompts = [part.content for part in request.parts
+               if isinstance(part, UserPromptPart) and isinstance(part.content, str)]
+    if not prompts:
+        return False
+    text = unicodedata.normalize('NFKD', ' '.join(prompts).lower())
+    words = WORD.findall(''.join(c for c in text if not unicodedata.combining(c)))
+    return 0 < len(words) <= max_words and all(
+        word in SIMPLE_WORDS or word.isdigit() for word in words)
+
+@dataclass
+class ModelStats:
+    requests: int = 0
+    failures: int = 0
+    seconds: float = 0
+    request_tokens: int = 0
+    response_tokens: int = 0
+
+    def as_dict(self) -> dict[str, float]:
+        succeeded = self.requests - self.failures
+        return {
+            'requests': self.requests,
+            'failures': self.failures,
+            'avg_ms': round(self.seconds / succeeded * 1000) if succeeded else 0,
+            'request_tokens': self.request_tokens,
+            'response_tokens': self.response_tokens,
+        }
+
+@dataclass
+class ModelTier:
+    """Models tried in order, skipping the ones that recently failed."""
+    name: str
+    model_names: list[str]
+    models: list[Model] = field(default_factory=list)
+    stats: dict[str, ModelStats] = field(default_factory=dict)
+    failovers: int = 0
+    _cooling_until: dict[str, float] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock)
+
+    def _models(self) -> list[Model]:
+        # Built on first use, so importing the agents doesn't create clients.
+        with self._lock:
+            if not self.models:
+                self.models = [create_model(name) for name in self.model_names]
+            return self.models
+
+    def _record(self, model: Model, seconds: float, usage: Usage | None = None, failed: bool = False):
+        with self._lock:
+            stats = self.stats.setdefault(model.model_name, ModelStats())
+            stats.requests += 1
+            if failed:
+                stats.failures += 1
+                return
+            stats.seconds += seconds
+            if usage is not None:
+                stats.request_tokens += usage.request_tokens or 0
+                stats.response_tokens += usage.response_tokens or 0
+
+    async def request(self, messages: list[ModelMessage], model_settings: ModelSettings | None,
+                      model_request_parameters: ModelRequestParameters) -> tuple[ModelResponse, Usage]:
+        models = self._models()
+        now = time.monotonic()
+        with self._lock:
+            available = [m for m in models if self._cooling_until.get(m.model_name, 0) <= now]
+        errors: list[Exception] = []
+        # When every model failed recently the first one gets another chance.
+        for index, model in enumerate(available or models[:1]):
+            if index > 0:
+                with self._lock:
+                    self.failovers += 1
+                logger.warning(f"Failing over from {errors[-1]} to {model.model_name}")
+            started = time.monotonic()
+            try:
+                response, usage = await model.request(messages, model_settings, model_request_parameters)
+            except Exception as e:
+                self._record(model, time.monotonic() - started, failed=True)
+                if not should_fail_over(e):
+                    raise
+                with self._lock:
+                    self._cooling_until[model.model_name] = time.monotonic() + failover_cooldown
+                errors.append(e)
+                continue
+            self._record(model, time.monotonic() - started, usage)
+            return response, usage
+        raise FallbackExceptionGroup(f"Every {self.name} model failed", errors)
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                'failovers': self.failovers,
+                'models': {name: stats.as_dict() for name, stats in self.stats.items()},
+            }
+
+class RoutedModel(Model):
+    """Sends simple turns to the light tier and everything else to the primary one.
+
+    A light response calling tools is discarded and the request escalated,
+    so the light models only ever answer with text. Each tier fails over
+    between its models on rate limits, timeouts and provider errors.
+    """
+
+    def __init__(self, primary: list[str], light: list[str] | None = None):
+        self.primary = ModelTier('primary', primary)
+        self.light = ModelTier('light', light) if light else None
+        self.escalations = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_names(cls, primary: str, fallbacks: str = '', light: str = '') -> 'RoutedModel':
+        split = lambda names: [name.strip() for name in names.split(',') if name.strip()]
+        return cls(split(primary) + split(fallbacks), split(light))
+
+    async def request(self, messages: list[ModelMessage], model_settings: ModelSettings | None,
+                      model_request_parameters: ModelRequestParameters) -> tuple[ModelResponse, Usage]:
+        # Tokens spent on a discarded light response are still billed.
+        discarded = Usage()
+        if self.light is not None and is_simple_turn(messages, model_request_parameters):
+            try:
+                response, usage = await self.light.request(messages, model_settings, model_request_parameters)
+                if not any(isinstance(part, ToolCallPart) for part in response.parts):
+                    return response, usage
+                discarded = usage
+            except Exception as e:
+                logger.warning(f"Light models failed, escalating: {e}")
+            with self._lock:
+                self.escalations += 1
+        response, usage = await self.primary.request(messages, model_settings, model_request_parameters)
+        return response, discarded + usage
+
+    @asynccontextmanager
+    async def request_stream(self, messages: list[ModelMessage], model_settings: ModelSettings | None,
+                             model_request_parameters: ModelRequestParameters) -> AsyncIterator[StreamedResponse]:
+        async with self.primary._models()[0].request_stream(
+                messages, model_settings, model_request_parameters) as response:
+            yield response
+
+    @property
+    def model_name(self) -> str:
+        return f"router:{','.join(self.primary.model_names)}"
+
+    @property
+    def system(self) -> str | None:
+        return None
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {'escalations': self.escalations}
+        stats['primary'] = self.primary.as_dict()
+        if self.light is not None:
+            stats['light'] = self.light.as_dict()
+        return stats
+
+# Shared by the agents, so their metrics and cooldowns are too.
+model_router = RoutedModel.from_names(primary_model, fallback_models, light_model)
@@ -0,0 +1,13 @@
+import os
+import logging
+from pydantic_ai import Agent
+
+logger = logging.getLogger('health_up:summary_agent')
+logger.setLevel(logging.CRITICAL)
+
+summary_agent = Agent(os.getenv("SUMMARY_MODEL") or "openai:gpt-4o-mini", name='summary_agent', system_prompt="""
+                You summarize conversations between a dental office assistant and a contact.
+                Keep names, ids, dates, chosen doctors, appointments and any open request.
+                Merge the previous summary with the new turns into a single short summary.
+                Reply only with the summary.
+              """)
@@ -0,0 +1,123 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+_MISSING = object()
+
+class TTLCache:
+    """Thread safe LRU cache with optional time to live and weight budget.
+
+    Entries are evicted least recently used first when there are more than
+    `maxsize` of them or, if `weigh` is given, when their total weight goes
+    over `max_weight`.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None,
+                 max_weight: int | None = None,
+                 weigh: Callable[[Any], int] | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.weight = 0
+        self._lock = threading.RLock()
+        # key -> (value, expires_at, weight)
+        self._entries: OrderedDict[Hashable, tuple[Any, float | None, int]] = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            value, expires_at, _ = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            weight = self.weigh(value) if self.weigh else 0
+            expires_at = time.monotonic() + self.ttl if self.ttl else None
+            self._entries[key] = (value, expires_at, weight)
+            self.weight += weight
+            self._evict()
+
+    def update(self, key: Hashable, function: Callable[[Any], Any]) -> bool:
+        """Replaces a cached value with `function(value)`, keeping its expiry."""
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return False
+            value, expires_at, weight = entry
+            value = function(value)
+            new_weight = self.weigh(value) if self.weigh else 0
+            self._entries[key] = (value, expires_at, new_weight)
+            self._entries.move_to_end(key)
+            self.weight += new_weight - weight
+            self._evict()
+            return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def pop_matching(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        with self._lock:
+            keys = [key for key, (value, _, _) in self._entries.items()
+                    if predicate(key, value)]
+            for key in keys:
+                self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.weight = 0
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'weight': self.weight,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return False
+            expires_at = entry[1]
+            return expires_at is None or expires_at >= time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key: Hashable) -> Any:
+        value, _, weight = self._entries.pop(key)
+        self.weight -= weight
+        return value
+
+    def _evict(self):
+        while self._entries and (
+            len(self._entries) > self.maxsize
+            or (self.max_weight is not None and self.weight > self.max_weight)
+        ):
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
@@ -0,0 +1,89 @@
+import argparse
+import logging
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:cli')
+logger.setLevel(logging.INFO)
+
+def compact_chat(args):
+    from services.chat import compact_chat_messages
+    rows, size_before, size_after = compact_chat_messages(args.batch_size, args.dry_run)
+    saved = size_before - size_after
+    print(f"{'Would rewrite' if args.dry_run else 'Rewrote'} {rows} chat messages: "
+          f"{size_before} -> {size_after} bytes ({saved} bytes saved)")
+
+def measure_projections(args):
+    from services.projection import measure_stored_projections
+    savings = measure_stored_projections(args.batch_size, args.limit)
+    print(f"{savings.rows} chat messages, {savings.tool_returns} tool returns")
+    print(f"Tool return tokens (estimated): {savings.tokens_before} -> {savings.tokens_after}")
+    print(f"Stored bytes: {savings.stored_before} -> {savings.stored_after}")
+
+def migrate(args):
+    from sqlmodel import create_engine
+    from migrations import run_migrations, verify
+    if args.database_url:
+        engine = create_engine(args.database_url)
+    else:
+        from database import engine
+    applied = run_migrations(engine, args.target)
+    for migration in applied:
+        print(f"Applied migration {migration.version}: {migration.description}")
+    if not applied:
+        print("Database is up to date")
+    if args.verify:
+        missing = verify(engine)
+        if missing:
+            raise SystemExit(f"Missing or invalid indexes: {', '.join(missing)}")
+        print("All indexes are present and valid")
+
+def refresh_contacts(args):
+    from services.contact import refresh_contact_view
+    refresh_contact_view(concurrently=not args.blocking)
+
+def invalidate_offices(args):
+    from services.reference import notify_office_change
+    notify_office_change(args.office_id)
+    print(f"Workers will reload {f'office {args.office_id}' if args.office_id else 'every office'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Health Up Worker maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("compact-chat",
+                                  help="Rewrite stored chat messages with the current storage format")
+    command.add_argument("--batch-size", type=int, default=500)
+    command.add_argument("--dry-run", action="store_true")
+    command.set_defaults(func=compact_chat)
+
+    command = commands.add_parser("measure-projections",
+                                  help="Compare stored tool returns with the current field sets")
+    command.add_argument("--batch-size", type=int, default=500)
+    command.add_argument("--limit", type=int, help="Stop after this many chat messages")
+    command.set_defaults(func=measure_projections)
+
+    command = commands.add_parser("migrate", help="Apply pending schema migrations")
+    command.add_argument("--database-url", help="Defaults to DATABASE_URL")
+    command.add_argument("--target", type=int, help="Stop after this migration version")
+    command.add_argument("--verify", action="store_true",
+                         help="Check every expected index exists afterwards")
+    command.set_defaults(func=migrate)
+
+    command = commands.add_parser("refresh-contacts",
+                                  help="Refresh the contact materialized view")
+    command.add_argument("--blocking", action="store_true",
+                         help="Refresh without CONCURRENTLY")
+    command.set_defaults(func=refresh_contacts)
+
+    command = commands.add_parser("invalidate-offices",
+                                  help="Make the workers reload cached office data")
+    command.add_argument("--office-id", help="Defaults to every office")
+    command.set_defaults(func=invalidate_offices)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
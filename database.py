@@ -1,12 +1,143 @@
 import os
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Callable, Iterator
 from dotenv import load_dotenv
+from utils import env_flag
+from sqlalchemy import event
 from sqlmodel import (
-    create_engine, 
+    create_engine,
+    Session,
 )
 
 load_dotenv()
 
+logger = logging.getLogger('health_up:database')
+
 database_url = os.getenv("DATABASE_URL")
 
-engine = create_engine(database_url, echo=True)  
-    
+# Every message in flight holds a connection for its unit of work, prefetch and
+# parallel tool reads take one more each.
+worker_concurrency = int(os.getenv('WORKER_CONCURRENCY') or 16)
+prefetch_workers = int(os.getenv('CONTEXT_PREFETCH_WORKERS') or 8)
+parallel_reads = int(os.getenv('DB_PARALLEL_READS') or 8)
+needed_connections = worker_concurrency + prefetch_workers + parallel_reads
+
+engine_options = {
+    'echo': env_flag('DB_ECHO'),
+    'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True),
+    'pool_recycle': int(os.getenv('DB_POOL_RECYCLE') or 1800),
+}
+if not database_url.startswith('sqlite'):
+    engine_options['pool_size'] = int(os.getenv('DB_POOL_SIZE') or worker_concurrency)
+    engine_options['max_overflow'] = int(os.getenv('DB_MAX_OVERFLOW') or
+                                         max(needed_connections - engine_options['pool_size'], 0))
+    if engine_options['pool_size'] + engine_options['max_overflow'] < needed_connections:
+        logger.warning(f"DB_POOL_SIZE plus DB_MAX_OVERFLOW is under the {needed_connections} "
+                       f"connections WORKER_CONCURRENCY, CONTEXT_PREFETCH_WORKERS and "
+                       f"DB_PARALLEL_READS may hold, messages may wait for DB_POOL_TIMEOUT")
+    engine_options['pool_timeout'] = float(os.getenv('DB_POOL_TIMEOUT') or 30)
+    # Milliseconds, a stuck query fails instead of holding the message past its deadline.
+    statement_timeout = os.getenv('DB_STATEMENT_TIMEOUT')
+    if statement_timeout and database_url.startswith('postgres'):
+        engine_options['connect_args'] = {'options': f'-c statement_timeout={int(statement_timeout)}'}
+
+engine = create_engine(database_url, **engine_options)
+
+class UnitOfWork:
+    """One session and transaction shared by everything done for a message.
+
+    Tools of an agent may run in parallel threads, so the session is only
+    used while holding `lock`. Callbacks registered with `after_commit` run
+    once the transaction is committed, to update in-process caches.
+    `flushed` tells whether anything was written yet, see `read_uow`.
+    """
+
+    def __init__(self):
+        self.session = Session(engine, expire_on_commit=False)
+        self.lock = threading.RLock()
+        self.flushed = False
+        self._after_commit: list[Callable[[], None]] = []
+        event.listen(self.session, 'after_flush', self._on_flush)
+
+    def _on_flush(self, session, flush_context):
+        self.flushed = True
+
+    def after_commit(self, callback: Callable[[], None]):
+        self._after_commit.append(callback)
+
+    def commit(self):
+        with self.lock:
+            self.session.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        with self.lock:
+            self.session.rollback()
+        self._after_commit = []
+
+    def close(self):
+        with self.lock:
+            self.session.close()
+        self._after_commit = []
+
+    def __enter__(self) -> 'UnitOfWork':
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.commit()
+            else:
+                self.rollback()
+        finally:
+            self.close()
+
+@contextmanager
+def session_scope(uow: UnitOfWork | None = None, nested: bool = False):
+    """Yields the session of `uow`, or a new one committed when leaving the block.
+
+    Writes should only `flush`, committing is up to whoever owns the session.
+    With `nested` the block runs in a savepoint, so a failed write does not
+    abort the whole unit of work.
+    """
+    if uow is not None:
+        with uow.lock:
+            if nested:
+                with uow.session.begin_nested():
+                    yield uow.session
+            else:
+                yield uow.session
+        return
+    with Session(engine, expire_on_commit=False) as session:
+        yield session
+        session.commit()
+
+# Reads running on a connection of their own besides the units of work, see `read_uow`.
+read_slots = threading.BoundedSemaphore(parallel_reads)
+
+@contextmanager
+def read_uow(uow: UnitOfWork | None) -> Iterator[UnitOfWork | None]:
+    """Unit of work for a read, None while `uow` has nothing the read must see.
+
+    Reads then get a session of their own instead of waiting for the lock of
+    `uow`, so the read-only tools of an agent step run in parallel. At most
+    `DB_PARALLEL_READS` do at a time, the others go through `uow`, so
+    parallel steps can't exhaust the pool.
+    """
+    if uow is None or uow.flushed or not read_slots.acquire(blocking=False):
+        yield uow
+        return
+    try:
+        yield None
+    finally:
+        read_slots.release()
+
+def after_commit(uow: UnitOfWork | None, callback: Callable[[], None]):
+    if uow is None:
+        callback()
+    else:
+        uow.after_commit(callback)
@@ -1,14 +1,44 @@
 import os
-import json
+import time
+import asyncio
 import openai
 import logging
-from kafka import KafkaConsumer
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from kafka import KafkaConsumer, TopicPartition
 from dotenv import load_dotenv
 from twilio.rest import Client
+from database import UnitOfWork, engine
+from migrations import run_migrations
+from utils import env_flag
+from services.audio import AudioTooLong, audio_stats, too_long_reply
 from services.media import transcribe_media
-from services.messaging import send_reply
-from services.contact import find_contact_by_phone_number
+from services.deadline import (
+  Deadline,
+  DeadlineExceeded,
+  agent_timeout,
+  deadline_reply,
+  model_request_timeout,
+)
+from services.transcripts import find_transcript, transcript_cache
+from services import broker
+from services.broker import inbound_topic, outbound_topic, publish_reply
+from services.messaging import send_reply, split_message
+from services.sender import OutboundSender, twilio_http_client
+from services.tts import tts_cache
+from services.routing import Route, routing_resolver
+from services.dispatcher import ConversationDispatcher
+from services.history import history_manager, summary_timeout, system_prompt_parts
+from services.intents import intent_router
+from services.context import AppointmentContext, prefetch_context, prefetch_timeout
+from services.dedup import dedup_store, message_key
+from services.reference import office_reference_cache
+from services.usage import usage_tracker
+from services.aio import chat as aio_chat
+from services.aio.database import AsyncUnitOfWork, dispose_async_engine, message_uow, run_read, run_write
+from services.offsets import CommitOnRevoke, OffsetTracker
 
+from agents.router import model_router
 from agents.appointment_agent import (
   appointment_agent,
   AppointmentDependencies
@@ -33,12 +63,9 @@ from models import (
     ChatMessage,
 )
 
-from services.office import (
-  find_office_by_phone_number
-)
-
 from services.chat import (
     add_message_to_conversation,
+    conversation_cache_stats,
     get_conversation_messages,
 )
 
@@ -60,7 +87,8 @@ account_sid = os.getenv("TWILIO_ACCOUNT_SID")
 auth_token = os.getenv("TWILIO_AUTH_TOKEN")
 media_path = os.getenv("MEDIAS_PATH")
 
-twilio_client = Client(account_sid, auth_token)
+twilio_client = Client(account_sid, auth_token, http_client=twilio_http_client())
+outbound_sender = OutboundSender(twilio_client)
 openai_client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
     
 def to_chat_message(m: ModelMessage) -> ChatMessage:
@@ -82,114 +110,544 @@ def to_chat_message(m: ModelMessage) -> ChatMessage:
             }
     raise UnexpectedModelBehavior(f'Unexpected message type for chat app: {m}')
 
-def handle_message(message):
+def parse_phone_numbers(message) -> tuple[str, str] | None:
   if 'to_number' not in message:
-      return 
+      return None
   if 'from_number' not in message:
-      return
-    
-  content = message["body"]
-  num_media = int(message["num_media"] or 0)
-    
-  if num_media > 0:
-      media_url = message["media_url"]
-      mime_type = message["media_type"]
-      content = transcribe_media(media_url, media_path, mime_type, 
-                                 twilio_client, openai_client)
-  
-  if content is None:
-      content = message["body"]
-  
+      return None
+
   office_phone_number = message["to_number"]
   if ':' in office_phone_number:
       office_phone_number = office_phone_number.split(':')[1]
   else:
-      return
+      return None
   contact_phone_number = message["from_number"]
   if ':' in contact_phone_number:
       contact_phone_number = contact_phone_number.split(':')[1]
   else:
-      return
-  
-  office = find_office_by_phone_number(office_phone_number)
-  contact = find_contact_by_phone_number(office.id, contact_phone_number)
-  
-  response = None
-  messages = get_conversation_messages(office.id, contact_phone_number)
-  if contact is None or contact.kind == 'patient':        
+      return None
+
+  return office_phone_number, contact_phone_number
+
+def select_agent(route: Route, contact_phone_number, uow: UnitOfWork | AsyncUnitOfWork | None = None,
+                 context: AppointmentContext | None = None):
+  office = route.office
+  if route.contact_kind is None or route.contact_kind == 'patient':
     deps = AppointmentDependencies(
       office_id=office.id, 
-      patient_id = None if contact is None else contact.id,
-      patient_phone_number=contact_phone_number)    
-    response = appointment_agent.run_sync(content, 
-      message_history=messages, 
-      deps=deps)
-  elif contact.kind == 'doctor':
+      patient_id=route.contact_id,
+      patient_phone_number=contact_phone_number,
+      uow=uow,
+      context=context)    
+    return appointment_agent, deps
+  elif route.contact_kind == 'doctor':
     deps = DoctorDependencies(
       office_id=office.id, 
-      doctor_id=contact.id, 
-      doctor_phone_number=contact_phone_number)
-    response = doctor_agent.run_sync(
-      content, 
-      message_history=messages, 
-      deps=deps)
-  elif contact.kind == 'manager':
+      doctor_id=route.contact_id, 
+      doctor_phone_number=contact_phone_number,
+      uow=uow)
+    return doctor_agent, deps
+  elif route.contact_kind == 'manager':
     deps = ManagerDependencies(
       office_id=office.id, 
-      manager_id=contact.id, 
-      manager_phone_number=contact_phone_number)
-    response = manager_agent.run_sync(
-      content, 
-      message_history=messages, 
-      deps=deps)
-  elif contact.kind == 'owner':
+      manager_id=route.contact_id, 
+      manager_phone_number=contact_phone_number,
+      uow=uow)
+    return manager_agent, deps
+  elif route.contact_kind == 'owner':
     deps = OwnerDependencies(
       office_id=office.id, 
-      owner_id=contact.id, 
-      owner_phone_number=contact_phone_number)
-    response = owner_agent.run_sync(
-      content, 
-      message_history=messages, 
-      deps=deps)
-  
-  ai_message = add_message_to_conversation(
-    office.id, contact_phone_number, response.new_messages_json())
-
-  #print(f"Response: {response.data}")
+      owner_id=route.contact_id, 
+      owner_phone_number=contact_phone_number,
+      uow=uow)
+    return owner_agent, deps
+  return None, None
+
+def conversation_key(message) -> tuple[str, str]:
+  return message.get("to_number"), message.get("from_number")
+
+def handle_duplicate(key, office_phone_number, contact_phone_number) -> bool:
+  """Returns True if the message was already handled, sending its stored reply if it wasn't sent."""
+  if not dedup_store.enabled:
+      return False
+  processed = dedup_store.find(key)
+  if processed is None:
+      return False
+  logger.info(f"Skipping duplicate message {key}")
+  if not processed.delivered and processed.reply is not None:
+      if deliver_reply(office_phone_number, contact_phone_number, processed.reply,
+                       processed.is_media, processed.ai_message_id):
+        dedup_store.mark_delivered(key)
+  return True
+
+def deadline_exceeded(error: DeadlineExceeded, office_phone_number, contact_phone_number):
+  logger.warning(f"{error} of the message from {contact_phone_number}")
+  try:
+    deliver_reply(office_phone_number, contact_phone_number, deadline_reply, False, None)
+  except Exception as e:
+    logger.error(f"Error sending deadline reply to {contact_phone_number}: {e}")
+
+def audio_too_long(error: AudioTooLong, office_phone_number, contact_phone_number):
+  logger.warning(f"Rejected the voice note from {contact_phone_number}: {error}")
+  try:
+    deliver_reply(office_phone_number, contact_phone_number, too_long_reply, False, None)
+  except Exception as e:
+    logger.error(f"Error sending audio too long reply to {contact_phone_number}: {e}")
+
+def handle_message(message, deadline: Deadline | None = None):
+  deadline = deadline or Deadline()
+  phone_numbers = parse_phone_numbers(message)
+  if phone_numbers is None:
+      return
+  office_phone_number, contact_phone_number = phone_numbers
+  dedup_key, has_sid = message_key(message)
+  if handle_duplicate(dedup_key, office_phone_number, contact_phone_number):
+      return
+    
+  route = routing_resolver.resolve(office_phone_number, contact_phone_number)
+  if route is None:
+      logger.warning(f"No office found for {office_phone_number}")
+      return
+  office = route.office
+  content = message["body"]
+  num_media = int(message["num_media"] or 0)
+  # Voice notes start it early to run while the audio is transcribed.
+  prefetch = prefetch_context(route, contact_phone_number) if num_media > 0 else None
     
-  send_reply(office_phone_number,
-             contact_phone_number, 
-             response.data, 
-             num_media > 0, 
-             ai_message.id,
-             media_path,
-             twilio_client, 
-             openai_client)
+  try:
+    if num_media > 0:
+        media_url = message["media_url"]
+        mime_type = message["media_type"]
+        content = find_transcript(media_url)
+        if content is None:
+          with deadline.stage('transcription'):
+            content = transcribe_media(media_url, media_path, mime_type, 
+                                       twilio_client, openai_client, deadline)
+    
+    if content is None:
+        content = message["body"]
+    
+    # Everything done for this message, chat history included, is committed at once.
+    deadline.check('database')
+    with UnitOfWork() as uow:
+      messages = get_conversation_messages(office.id, contact_phone_number, uow)
+      intent_reply = intent_router.route(route, content, messages, uow)
+      if intent_reply is not None:
+        if prefetch is not None:
+          prefetch.cancel()
+        reply = intent_reply.text
+        ai_message = add_message_to_conversation(
+          office.id, contact_phone_number, intent_reply.messages_json(),
+          intent_reply.messages, uow)
+      else:
+        if prefetch is None:
+          prefetch = prefetch_context(route, contact_phone_number)
+        window = history_manager.prepare(office.id, contact_phone_number, messages)
+        if window.to_summarize:
+          history_manager.summarize(window, deadline.timeout('summary', summary_timeout))
+        context = prefetch.result(deadline.timeout('prefetch', prefetch_timeout)) if prefetch else None
+        agent, deps = select_agent(route, contact_phone_number, uow, context)
+        messages = window.messages(system_prompt_parts(agent),
+                                   context.message() if context is not None else None)
+        response = deadline.run('agent', agent.run(content, 
+          message_history=messages, 
+          deps=deps,
+          model_settings={'timeout': model_request_timeout}), agent_timeout)
+        reply = response.data
+        
+        ai_message = add_message_to_conversation(
+          office.id, contact_phone_number, response.new_messages_json(),
+          response.new_messages(), uow)
+        usage_tracker.record(agent.name, office.id, response.usage(),
+                             contact_phone_number, ai_message.id, uow)
+      if dedup_store.enabled:
+        dedup_store.record(dedup_key, has_sid, reply, num_media > 0, ai_message.id, uow)
+  except DeadlineExceeded as e:
+    deadline_exceeded(e, office_phone_number, contact_phone_number)
+    return
+  except AudioTooLong as e:
+    audio_too_long(e, office_phone_number, contact_phone_number)
+    return
+
+  #print(f"Response: {reply}")
+    
+  delivered = deliver_reply(office_phone_number,
+                            contact_phone_number, 
+                            reply, 
+                            num_media > 0, 
+                            ai_message.id)
+  if dedup_store.enabled and delivered:
+    dedup_store.mark_delivered(dedup_key)
+
+def deliver_reply(from_number, to_number, body_text, is_media, ai_response_id) -> bool:
+  """Returns whether the reply was sent, or queued for the sender workers."""
+  if outbound_topic:
+    publish_reply(from_number, to_number, body_text, is_media, ai_response_id)
+    return True
+  return send_reply(from_number, to_number, body_text, is_media, ai_response_id,
+                    media_path, outbound_sender, openai_client)
+
+async def handle_message_async(message, deadline: Deadline | None = None):
+  deadline = deadline or Deadline()
+  phone_numbers = parse_phone_numbers(message)
+  if phone_numbers is None:
+      return
+  office_phone_number, contact_phone_number = phone_numbers
+  dedup_key, has_sid = message_key(message)
+  if await asyncio.to_thread(handle_duplicate, dedup_key,
+                             office_phone_number, contact_phone_number):
+      return
 
+  route = await asyncio.to_thread(routing_resolver.resolve,
+                                  office_phone_number, contact_phone_number)
+  if route is None:
+      logger.warning(f"No office found for {office_phone_number}")
+      return
+  office = route.office
+  content = message["body"]
+  num_media = int(message["num_media"] or 0)
+  # Voice notes start it early to run while the audio is transcribed.
+  prefetch = prefetch_context(route, contact_phone_number) if num_media > 0 else None
+
+  try:
+    if num_media > 0:
+        media_url = message["media_url"]
+        mime_type = message["media_type"]
+        content = await asyncio.to_thread(find_transcript, media_url)
+        if content is None:
+          with deadline.stage('transcription'):
+            content = await asyncio.to_thread(transcribe_media, media_url, media_path,
+                                              mime_type, twilio_client, openai_client,
+                                              deadline)
+
+    if content is None:
+        content = message["body"]
+
+    deadline.check('database')
+    async with message_uow() as uow:
+      messages = await run_read(get_conversation_messages, aio_chat.get_conversation_messages,
+                                office.id, contact_phone_number, uow=uow)
+      # Nothing was written yet, the menu can read without the unit of work.
+      intent_reply = await asyncio.to_thread(intent_router.route, route, content, messages)
+      if intent_reply is not None:
+        if prefetch is not None:
+          prefetch.cancel()
+        reply = intent_reply.text
+        ai_message = await run_write(add_message_to_conversation, aio_chat.add_message_to_conversation,
+          office.id, contact_phone_number, intent_reply.messages_json(),
+          intent_reply.messages, uow=uow)
+      else:
+        if prefetch is None:
+          prefetch = prefetch_context(route, contact_phone_number)
+        window = await asyncio.to_thread(history_manager.prepare,
+                                         office.id, contact_phone_number, messages)
+        if window.to_summarize:
+          await history_manager.summarize_async(window,
+                                                deadline.timeout('summary', summary_timeout))
+        context = await asyncio.to_thread(prefetch.result,
+                                          deadline.timeout('prefetch', prefetch_timeout)) if prefetch else None
+        agent, deps = select_agent(route, contact_phone_number, uow, context)
+        messages = window.messages(system_prompt_parts(agent),
+                                   context.message() if context is not None else None)
+        response = await deadline.wait('agent', agent.run(content,
+          message_history=messages,
+          deps=deps,
+          model_settings={'timeout': model_request_timeout}), agent_timeout)
+        reply = response.data
+
+        ai_message = await run_write(add_message_to_conversation, aio_chat.add_message_to_conversation,
+          office.id, contact_phone_number, response.new_messages_json(),
+          response.new_messages(), uow=uow)
+        await run_write(usage_tracker.record, usage_tracker.record_async,
+                        agent.name, office.id, response.usage(),
+                        contact_phone_number, ai_message.id, uow=uow)
+      if dedup_store.enabled:
+        await run_write(dedup_store.record, dedup_store.record_async,
+                        dedup_key, has_sid, reply, num_media > 0, ai_message.id, uow=uow)
+  except DeadlineExceeded as e:
+    await asyncio.to_thread(deadline_exceeded, e, office_phone_number, contact_phone_number)
+    return
+  except AudioTooLong as e:
+    await asyncio.to_thread(audio_too_long, e, office_phone_number, contact_phone_number)
+    return
+
+  delivered = await asyncio.to_thread(deliver_reply,
+                                      office_phone_number,
+                                      contact_phone_number,
+                                      reply,
+                                      num_media > 0,
+                                      ai_message.id)
+  if dedup_store.enabled and delivered:
+    await asyncio.to_thread(dedup_store.mark_delivered, dedup_key)
+
+
+def create_consumer(**configs) -> KafkaConsumer:
+    return broker.create_consumer(inbound_topic, **configs)
+
+inbound_max_attempts = int(os.getenv('INBOUND_MAX_ATTEMPTS') or 3)
+inbound_retry_backoff = float(os.getenv('INBOUND_RETRY_BACKOFF') or 1)
+
+async def handle_message_with_retries(message, max_attempts: int | None = None,
+                                      retry_backoff: float | None = None):
+  """Retries a failing message, then parks it in `DEAD_LETTER_TOPIC`.
+
+  Raises when it can't be parked, so its offset is never committed.
+  """
+  max_attempts = max_attempts or inbound_max_attempts
+  retry_backoff = inbound_retry_backoff if retry_backoff is None else retry_backoff
+  for attempt in range(1, max_attempts + 1):
+    try:
+      return await handle_message_async(message)
+    except Exception as e:
+      if attempt < max_attempts:
+        delay = retry_backoff * 2 ** (attempt - 1)
+        logger.warning(f"Error handling message from {message.get('from_number')}, "
+                       f"retry {attempt}/{max_attempts - 1} in {delay:.2f}s: {e}")
+        await asyncio.sleep(delay)
+        continue
+      if not broker.dead_letter_topic:
+        raise
+      logger.error(f"Giving up on message from {message.get('from_number')} "
+                   f"after {max_attempts} attempts, publishing it to {broker.dead_letter_topic}")
+      await asyncio.to_thread(broker.publish_dead_letter, message, repr(e))
+
+stats_interval = float(os.getenv('STATS_INTERVAL') or 60)
+last_stats_report = time.monotonic()
+
+def report_stats(force=False):
+    global last_stats_report
+    now = time.monotonic()
+    if not force and now - last_stats_report < stats_interval:
+        return
+    last_stats_report = now
+    logger.info(f"Conversation cache: {conversation_cache_stats()}")
+    if transcript_cache is not None:
+        logger.info(f"Transcript cache: {transcript_cache.stats()}")
+    logger.info(f"Audio preprocessing: {audio_stats.stats()}")
+    logger.info(f"TTS cache: {tts_cache.stats()}")
+    logger.info(f"Outbound sender: {outbound_sender.stats()}")
+    logger.info(f"Intent router: {intent_router.stats()}")
+    logger.info(f"Routing cache: {routing_resolver.stats()}")
+    logger.info(f"Office reference cache: {office_reference_cache.stats()}")
+    logger.info(f"Model router: {model_router.stats()}")
+    logger.info(f"Model usage: {usage_tracker.stats()}")
+    if dedup_store.enabled:
+        logger.info(f"Deduplication: {dedup_store.stats()}")
+
+def apply_migrations():
+    if not env_flag('RUN_MIGRATIONS'):
+        return
+    for migration in run_migrations(engine):
+        logger.info(f"Applied migration {migration.version}: {migration.description}")
+
+def load_caches():
+    try:
+        routing_resolver.load()
+    except Exception as e:
+        logger.error(f"Error loading routing cache: {e}")
+    dedup_store.check_table()
+    office_reference_cache.check_table()
+
+def create_default_executor() -> ThreadPoolExecutor:
+    # Runs the sync agent tools, the independent calls of a step in parallel.
+    return ThreadPoolExecutor(max_workers=int(os.getenv('TOOL_THREADS') or 32),
+                              thread_name_prefix='tool')
 
 def main():
-    kafka_broker = os.getenv('KAFKA_BROKER')
-    kafka_client_id = os.getenv('KAFKA_CLIENT_ID')
-    kafka_group_id = os.getenv('KAFKA_GROUP_ID')
-    kafka_security_protocol = os.getenv('KAFKA_SECURITY_PROTOCOL')
-    kafka_sasl_username = os.getenv('KAFKA_USER')
-    kafka_sasl_password = os.getenv('KAFKA_PASSWORD')
-    kafka_sasl_mechanism = os.getenv('KAFKA_SASL_MECHANISM')
-    consumer = KafkaConsumer(
-        'process_message', 
-        bootstrap_servers=kafka_broker, 
-        api_version=(3, 9, 0),
-        #api_version=(1, 1, 1),
-        client_id=kafka_client_id if kafka_client_id else "health_up",
-        group_id=kafka_group_id if kafka_group_id else "health_up",
-        security_protocol=kafka_security_protocol if kafka_security_protocol else "PLAINTEXT",
-        sasl_mechanism=kafka_sasl_mechanism,
-        sasl_plain_username=kafka_sasl_username,
-        sasl_plain_password=kafka_sasl_password,
-        value_deserializer=lambda m: json.loads(m.decode('ascii')))
+    apply_migrations()
+    load_caches()
+    loop = asyncio.new_event_loop()
+    loop.set_default_executor(create_default_executor())
+    asyncio.set_event_loop(loop)
+    consumer = create_consumer()
     for msg in consumer:
         handle_message(msg.value)
+        report_stats()
+        routing_resolver.refresh_if_due()
+        office_reference_cache.poll_changes_if_due()
+        if dedup_store.enabled:
+            dedup_store.sweep_if_due()
+
+async def main_async():
+    # Shared with asyncio.to_thread, so every blocking call of the worker is bounded too.
+    asyncio.get_running_loop().set_default_executor(create_default_executor())
+    await asyncio.to_thread(apply_migrations)
+    await asyncio.to_thread(load_caches)
+    concurrency = int(os.getenv('WORKER_CONCURRENCY') or 16)
+    max_poll_records = int(os.getenv('KAFKA_MAX_POLL_RECORDS') or 100)
+    manual_commit = (os.getenv('KAFKA_MANUAL_COMMIT') or 'true').lower() == 'true'
+    dispatcher = ConversationDispatcher(concurrency)
+    tracker = OffsetTracker()
+    consumer = create_consumer(enable_auto_commit=not manual_commit,
+                               max_poll_records=max_poll_records)
+    if manual_commit:
+        consumer.subscribe([inbound_topic],
+                           listener=CommitOnRevoke(consumer, tracker))
+    # KafkaConsumer is not thread safe, every call to it goes through the same thread.
+    kafka_executor = ThreadPoolExecutor(max_workers=1)
+    loop = asyncio.get_running_loop()
+
+    def mark_done(partition, offset, task):
+        # A failed message holds back the commits of its partition until it is redelivered.
+        if task.cancelled() or task.exception() is not None:
+            logger.error(f"Message at offset {offset} of {partition} failed, not committing past it")
+            return
+        tracker.done(partition, offset)
+
+    async def commit():
+        offsets = tracker.committable()
+        if offsets:
+            try:
+                await loop.run_in_executor(kafka_executor, consumer.commit, offsets)
+            except Exception as e:
+                logger.error(f"Error committing offsets: {e}")
+
+    try:
+        while True:
+            records = await loop.run_in_executor(
+                kafka_executor,
+                partial(consumer.poll, timeout_ms=1000, max_records=max_poll_records))
+            for partition, partition_records in records.items():
+                for record in partition_records:
+                    message = record.value
+                    tracker.track(partition, record.offset)
+                    task = await dispatcher.submit(
+                        conversation_key(message),
+                        partial(handle_message_with_retries, message))
+                    task.add_done_callback(
+                        partial(mark_done, partition, record.offset))
+            if manual_commit:
+                await commit()
+            report_stats()
+            await asyncio.to_thread(routing_resolver.refresh_if_due)
+            await asyncio.to_thread(office_reference_cache.poll_changes_if_due)
+            if dedup_store.enabled:
+                await asyncio.to_thread(dedup_store.sweep_if_due)
+    finally:
+        await dispatcher.drain()
+        if manual_commit:
+            await commit()
+        await loop.run_in_executor(kafka_executor, consumer.close)
+        kafka_executor.shutdown()
+        await dispose_async_engine()
+
+def main_sender():
+    """Delivers the replies published to `OUTBOUND_TOPIC`.
+
+    Each poll is sent as a batch: replies to different contacts go out
+    concurrently, replies to the same contact in the order they were
+    published. Offsets are only committed up to the first reply that
+    couldn't be sent; its partition is rewound to it, so it is delivered
+    again on the next poll, up to `SENDER_MAX_ATTEMPTS` times. Replies
+    and chunks of replies that did go out are remembered and not sent
+    twice, across workers too when deduplication is on.
+    """
+    concurrency = int(os.getenv('SENDER_CONCURRENCY') or 16)
+    max_poll_records = int(os.getenv('KAFKA_MAX_POLL_RECORDS') or 100)
+    max_attempts = int(os.getenv('SENDER_MAX_ATTEMPTS') or 5)
+    consumer = create_sender_consumer(max_poll_records)
+    tracker = OffsetTracker()
+    consumer.subscribe([outbound_topic], listener=CommitOnRevoke(consumer, tracker))
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='sender')
+    # Records sent but not committed yet, the failed attempts of each record, and
+    # the chunks sent of the records that failed halfway.
+    sent: set[tuple[TopicPartition, int]] = set()
+    attempts: dict[tuple[TopicPartition, int], int] = {}
+    chunks_sent: dict[tuple[TopicPartition, int], set[int]] = {}
+
+    def send_record(partition: TopicPartition, record) -> bool:
+        reply = record.value
+        position = (partition, record.offset)
+        reply_key = f"outbound:{partition.topic}:{partition.partition}:{record.offset}"
+        chunks = chunks_sent.get(position)
+        if chunks is None:
+            chunks = set()
+            if dedup_store.enabled:
+                # Another worker may have sent some before the partition moved.
+                chunks = dedup_store.sent_chunks(reply_key, len(split_message(reply['body'])))
+            chunks_sent[position] = chunks
+
+        def chunk_sent(index: int):
+            chunks.add(index)
+            if dedup_store.enabled:
+                dedup_store.mark_chunk_sent(reply_key, index)
+
+        return send_reply(reply['from'], reply['to'], reply['body'], reply['is_media'],
+                          reply['ai_response_id'], media_path, outbound_sender, openai_client,
+                          sent_chunks=chunks, on_chunk_sent=chunk_sent)
+
+    def send_replies(records) -> tuple[TopicPartition, int] | None:
+        """Sends the replies to a contact in order, returns the first one that failed."""
+        for partition, record in records:
+            position = (partition, record.offset)
+            if position not in sent:
+                if not send_record(partition, record):
+                    attempts[position] = attempts.get(position, 0) + 1
+                    if attempts[position] < max_attempts:
+                        return position
+                    logger.error(f"Giving up on reply {record.value} after {max_attempts} attempts")
+                sent.add(position)
+            attempts.pop(position, None)
+            chunks_sent.pop(position, None)
+            tracker.done(partition, record.offset)
+        return None
+
+    def commit(offsets):
+        try:
+            consumer.commit(offsets)
+        except Exception as e:
+            # Rebalancing: the records are redelivered to the new owner, which
+            # skips the chunks already sent.
+            logger.error(f"Error committing sender offsets: {e}")
+            return
+        sent.difference_update({position for position in sent
+                                if position[0] in offsets
+                                and position[1] < offsets[position[0]].offset})
+
+    try:
+        while True:
+            records = consumer.poll(timeout_ms=1000, max_records=max_poll_records)
+            by_recipient: dict[str, list] = {}
+            for partition, partition_records in records.items():
+                for record in partition_records:
+                    tracker.track(partition, record.offset)
+                    by_recipient.setdefault(record.value['to'], []).append((partition, record))
+            rewind: dict[TopicPartition, int] = {}
+            for future in [executor.submit(send_replies, replies)
+                           for replies in by_recipient.values()]:
+                failed = future.result()
+                if failed is not None:
+                    partition, offset = failed
+                    rewind[partition] = min(offset, rewind.get(partition, offset))
+            offsets = tracker.committable()
+            if offsets:
+                commit(offsets)
+            for partition, offset in rewind.items():
+                logger.warning(f"Redelivering {partition} from offset {offset}")
+                try:
+                    consumer.seek(partition, offset)
+                except Exception as e:
+                    # No longer assigned, its new owner starts from the last commit.
+                    logger.error(f"Error rewinding {partition}: {e}")
+            tracker.forget(rewind)
+            report_stats()
+    finally:
+        executor.shutdown()
+        consumer.close()
+
+def create_sender_consumer(max_poll_records: int) -> KafkaConsumer:
+    return broker.create_consumer(
+        outbound_topic,
+        group_id=os.getenv('SENDER_GROUP_ID') or 'health_up_sender',
+        enable_auto_commit=False,
+        max_poll_records=max_poll_records)
 
 if __name__ == "__main__":
   logger.info("Starting Health Up Worker")
-  main()
+  worker_mode = os.getenv('WORKER_MODE')
+  if worker_mode == 'async':
+    asyncio.run(main_async())
+  elif worker_mode == 'sender':
+    main_sender()
+  else:
+    main()
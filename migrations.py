@@ -0,0 +1,181 @@
+import logging
+import datetime
+from dataclasses import dataclass, field
+from typing import Callable
+from sqlalchemy import (
+    Column,
+    DateTime,
+    Engine,
+    Index,
+    Integer,
+    MetaData,
+    String,
+    Table,
+    Connection,
+    inspect,
+    select,
+)
+from models import (
+    Appointment,
+    ChatMessage,
+    Office,
+    OfficeChange,
+    ProcessedMessage,
+    TurnUsage,
+    _Contact,
+)
+
+logger = logging.getLogger('health_up:migrations')
+
+migration_metadata = MetaData()
+
+schema_migration = Table(
+    'schema_migration',
+    migration_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String, nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+@dataclass
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+    # Indexes the migration is expected to leave behind, used by `verify`.
+    indexes: list[Index] = field(default_factory=list)
+    dialects: tuple[str, ...] | None = None
+
+    def applies_to(self, connection: Connection) -> bool:
+        return self.dialects is None or connection.dialect.name in self.dialects
+
+def _create_index_sql(connection: Connection, index: Index) -> str:
+    columns = ', '.join(column.name for column in index.columns)
+    unique = 'UNIQUE ' if index.unique else ''
+    # Building the index without blocking writes needs to run outside of a transaction.
+    concurrently = 'CONCURRENTLY ' if connection.dialect.name == 'postgresql' else ''
+    return (f'CREATE {unique}INDEX {concurrently}IF NOT EXISTS {index.name} '
+            f'ON {index.table.name} ({columns})')
+
+# A concurrent build that failed leaves its index behind, marked invalid.
+INVALID_INDEXES_SQL = ('SELECT c.relname FROM pg_index i '
+                       'JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid')
+
+def invalid_indexes(connection: Connection) -> set[str]:
+    """Names of the indexes Postgres won't use, always empty on other databases."""
+    if connection.dialect.name != 'postgresql':
+        return set()
+    return set(connection.exec_driver_sql(INVALID_INDEXES_SQL).scalars())
+
+def _index(table: Table, name: str) -> Index:
+    return next(index for index in table.indexes if index.name == name)
+
+def create_indexes(*indexes: Index) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection):
+        invalid = invalid_indexes(connection)
+        for index in indexes:
+            if index.name in invalid:
+                # IF NOT EXISTS would keep it, so it is built again from scratch.
+                logger.warning(f"Dropping invalid index {index.name}")
+                connection.exec_driver_sql(f'DROP INDEX CONCURRENTLY IF EXISTS {index.name}')
+            logger.info(f"Creating index {index.name}")
+            connection.exec_driver_sql(_create_index_sql(connection, index))
+    return upgrade
+
+def create_tables(*tables: Table) -> Callable[[Connection], None]:
+    def upgrade(connection: Connection):
+        for table in tables:
+            logger.info(f"Creating table {table.name}")
+            table.create(connection, checkfirst=True)
+    return upgrade
+
+hot_query_indexes = [
+    _index(Office.__table__, 'ix_office_phone_number'),
+    _index(ChatMessage.__table__, 'ix_chatmessage_office_id_phone_number_timestamp'),
+    _index(Appointment.__table__, 'ix_appointment_office_id_date_time'),
+    _index(Appointment.__table__, 'ix_appointment_doctor_id_date_time'),
+]
+
+contact_indexes = [
+    _index(_Contact.__table__, 'ux_contact_kind_id'),
+    _index(_Contact.__table__, 'ix_contact_office_id_phone_number'),
+]
+
+migrations: list[Migration] = [
+    Migration(
+        version=1,
+        description='Indexes for office, chat history and appointment lookups',
+        upgrade=create_indexes(*hot_query_indexes),
+        indexes=hot_query_indexes,
+    ),
+    Migration(
+        version=2,
+        description='Indexes on the contact materialized view',
+        upgrade=create_indexes(*contact_indexes),
+        indexes=contact_indexes,
+        # Only Postgres has materialized views that can be indexed.
+        dialects=('postgresql',),
+    ),
+    Migration(
+        version=3,
+        description='Processed message table for inbound deduplication',
+        upgrade=create_tables(ProcessedMessage.__table__),
+        indexes=[_index(ProcessedMessage.__table__, 'ix_processedmessage_expires_at')],
+    ),
+    Migration(
+        version=4,
+        description='Turn usage table for token accounting',
+        upgrade=create_tables(TurnUsage.__table__),
+        indexes=[_index(TurnUsage.__table__, 'ix_turnusage_office_id_created_at')],
+    ),
+    Migration(
+        version=5,
+        description='Office change table to invalidate cached office data',
+        upgrade=create_tables(OfficeChange.__table__),
+    ),
+]
+
+def applied_versions(connection: Connection) -> set[int]:
+    migration_metadata.create_all(connection, checkfirst=True)
+    return set(connection.execute(select(schema_migration.c.version)).scalars())
+
+def run_migrations(engine: Engine, target: int | None = None) -> list[Migration]:
+    """Applies pending migrations in order and returns the ones applied.
+
+    Every statement is idempotent, so a migration interrupted halfway can
+    simply be run again.
+    """
+    applied: list[Migration] = []
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        done = applied_versions(connection)
+        for migration in sorted(migrations, key=lambda m: m.version):
+            if migration.version in done:
+                continue
+            if target is not None and migration.version > target:
+                break
+            if migration.applies_to(connection):
+                logger.info(f"Applying migration {migration.version}: {migration.description}")
+                migration.upgrade(connection)
+            else:
+                logger.info(f"Skipping migration {migration.version} on {connection.dialect.name}")
+            connection.execute(schema_migration.insert().values(
+                version=migration.version,
+                description=migration.description,
+                applied_at=datetime.datetime.now()))
+            applied.append(migration)
+    return applied
+
+def verify(engine: Engine) -> list[str]:
+    """Returns the names of expected indexes missing from the database, or invalid."""
+    missing: list[str] = []
+    with engine.connect() as connection:
+        inspector = inspect(connection)
+        invalid = invalid_indexes(connection)
+        for migration in migrations:
+            if not migration.applies_to(connection):
+                continue
+            for index in migration.indexes:
+                existing = {i['name'] for i in inspector.get_indexes(index.table.name)}
+                if index.name not in existing or index.name in invalid:
+                    missing.append(index.name)
+    return missing
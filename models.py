@@ -1,6 +1,6 @@
 from datetime import datetime
 from pydantic import BaseModel
-from sqlmodel import Field, SQLModel, select, Column, DateTime
+from sqlmodel import Field, SQLModel, select, Column, DateTime, Index
 from sqlalchemy import union_all, literal_column
 from sqlalchemy.orm import registry
 from sqlalchemy_utils import create_materialized_view
@@ -22,6 +22,9 @@ class OfficeInventory(BaseModel):
     description: str
     quantity: int
 class Office(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_office_phone_number', 'phone_number'),
+    )
     id: str | None = Field(primary_key=True)
     name: str
     description: str
@@ -79,6 +82,10 @@ class PatientHistory(SQLModel, table=True):
     doctor_id: str | None = Field(default=None, foreign_key="doctor.id")
 
 class Appointment(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_appointment_office_id_date_time', 'office_id', 'date_time'),
+        Index('ix_appointment_doctor_id_date_time', 'doctor_id', 'date_time'),
+    )
     id: str | None = Field(primary_key=True)
     date_time: datetime = Field(sa_column=Column(DateTime(), nullable=False))
     office_id: str | None = Field(default=None, foreign_key="office.id")
@@ -99,6 +106,10 @@ class Inventory(SQLModel, table=True):
     office_id: str | None = Field(default=None, foreign_key="office.id")    
 
 class ChatMessage(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_chatmessage_office_id_phone_number_timestamp',
+              'office_id', 'phone_number', 'timestamp'),
+    )
     id: str | None = Field(primary_key=True)
     phone_number: str
     role: str | None = None
@@ -106,6 +117,40 @@ class ChatMessage(SQLModel, table=True):
     content: bytes
     office_id:  str | None = Field(default=None, foreign_key="office.id")
 
+class ProcessedMessage(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_processedmessage_expires_at', 'expires_at'),
+    )
+    key: str = Field(primary_key=True)
+    reply: str | None = None
+    is_media: bool = False
+    ai_message_id: str | None = None
+    delivered: bool = False
+    created_at: datetime = Field(sa_column=Column(DateTime(), nullable=False))
+    expires_at: datetime = Field(sa_column=Column(DateTime(), nullable=False))
+
+class TurnUsage(SQLModel, table=True):
+    __table_args__ = (
+        Index('ix_turnusage_office_id_created_at', 'office_id', 'created_at'),
+    )
+    id: str | None = Field(primary_key=True)
+    office_id: str | None = Field(default=None, foreign_key="office.id")
+    phone_number: str | None = None
+    agent: str
+    chat_message_id: str | None = None
+    requests: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+    created_at: datetime = Field(sa_column=Column(DateTime(), nullable=False))
+
+class OfficeChange(SQLModel, table=True):
+    """Tells the workers to reload cached office data, see `OfficeReferenceCache`."""
+    id: int | None = Field(default=None, primary_key=True)
+    # None when every office changed.
+    office_id: str | None = None
+    created_at: datetime = Field(sa_column=Column(DateTime(), nullable=False))
+
 mapper_registry = registry()
 
 class Contact(SQLModel):
@@ -147,6 +192,11 @@ class _Contact(SQLModel):
         name="contact",
         selectable=selectable,
         metadata=SQLModel.metadata,
+        indexes=[
+            # A unique index is required to REFRESH MATERIALIZED VIEW CONCURRENTLY.
+            Index('ux_contact_kind_id', 'kind', 'id', unique=True),
+            Index('ix_contact_office_id_phone_number', 'office_id', 'phone_number'),
+        ],
     )
 
 mapper_registry.map_imperatively(Contact, _Contact.__table__)
\ No newline at end of file
@@ -0,0 +1,79 @@
+import datetime
+from sqlmodel import (
+    select,
+)
+from models import (
+    Appointment,
+    DoctorAppointment,
+    Office,
+    Patient
+)
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def list_office_appointments(office_id, actual_date_time,
+                                   uow: AsyncUnitOfWork | None = None) -> list[Appointment]:
+    async with session_scope(uow) as session:
+        statement = select(Appointment)
+        statement = statement.where(Appointment.date_time >= actual_date_time)
+        statement = statement.where(Appointment.office_id == office_id)
+        statement = statement.limit(10)
+        results = await session.exec(statement)
+
+        return list(results)
+
+async def list_doctor_appointments(doctor_id, actual_date_time,
+                                   uow: AsyncUnitOfWork | None = None) -> list[DoctorAppointment]:
+    async with session_scope(uow) as session:
+        statement = select(Appointment, Patient).join(Patient)
+        statement = statement.where(Appointment.date_time >= actual_date_time)
+        statement = statement.where(Appointment.doctor_id == doctor_id)
+        results = await session.exec(statement)
+
+        return [
+            DoctorAppointment(
+              patient_id=patient.id,
+              patient_name=patient.name,
+              date_time=appointment.date_time,
+            )
+            for appointment, patient in results
+        ]
+
+async def find_appointment(office_id, patient_id, actual_date_time,
+                           uow: AsyncUnitOfWork | None = None) -> Appointment:
+    async with session_scope(uow) as session:
+        statement = select(Appointment, Patient, Office)
+        statement = statement.where(Appointment.office_id == office_id)
+        statement = statement.where(Appointment.patient_id == Patient.id)
+        statement = statement.where(Appointment.date_time >= actual_date_time)
+        statement = statement.where(Patient.id == patient_id)
+        results = await session.exec(statement)
+
+        next_appointment = results.first()
+        if next_appointment:
+            return next_appointment[0]
+        return None
+
+async def list_doctor_appointment_times(doctor_id, start: datetime.datetime, end: datetime.datetime,
+                                        uow: AsyncUnitOfWork | None = None) -> list[datetime.datetime]:
+    async with session_scope(uow) as session:
+        statement = select(Appointment.date_time)
+        statement = statement.where(Appointment.doctor_id == doctor_id)
+        statement = statement.where(Appointment.date_time >= start)
+        statement = statement.where(Appointment.date_time < end)
+        statement = statement.order_by(Appointment.date_time)
+        return list(await session.exec(statement))
+
+async def add_appointment(appointment, uow: AsyncUnitOfWork | None = None) -> Appointment:
+    async with session_scope(uow, nested=True) as session:
+        session.add(appointment)
+        await session.flush()
+        return appointment
+
+async def delete_appointment(appointment: Appointment, uow: AsyncUnitOfWork | None = None) -> bool:
+    async with session_scope(uow, nested=True) as session:
+        statement = select(Appointment).where(Appointment.id == appointment.id)
+        results = await session.exec(statement)
+        appointment = results.one()
+        await session.delete(appointment)
+        await session.flush()
+        return True
@@ -0,0 +1,82 @@
+import datetime
+from uuid_extensions import uuid7str
+from sqlmodel import (
+    select,
+)
+from models import (
+    ChatMessage
+)
+from database import after_commit
+from services.chat import (
+    HISTORY_LIMIT,
+    Conversation,
+    ConversationRow,
+    _is_conversation_message,
+    _to_row,
+    conversation_cache,
+)
+from services.chat_codec import encode_content
+from services.aio.database import AsyncUnitOfWork, session_scope
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+)
+
+async def load_conversation(office_id: str, from_number: str,
+                            uow: AsyncUnitOfWork | None = None) -> Conversation:
+    async with session_scope(uow) as session:
+        conversation = Conversation()
+        statement = select(ChatMessage)
+        statement = statement.where(ChatMessage.office_id == office_id)
+        statement = statement.where(ChatMessage.phone_number == from_number)
+        statement = statement.where(_is_conversation_message())
+        statement = statement.limit(1)
+        statement = statement.order_by(ChatMessage.timestamp.asc())
+        first = (await session.exec(statement)).first()
+        if first is None:
+            return conversation
+        conversation.append(_to_row(first))
+
+        statement = select(ChatMessage)
+        statement = statement.where(ChatMessage.office_id == office_id)
+        statement = statement.where(ChatMessage.phone_number == from_number)
+        statement = statement.where(ChatMessage.id != first.id)
+        statement = statement.where(_is_conversation_message())
+        statement = statement.limit(HISTORY_LIMIT)
+        statement = statement.order_by(ChatMessage.timestamp.desc())
+        results = (await session.exec(statement)).all()
+
+        for message in reversed(results):
+            conversation.append(_to_row(message))
+
+        return conversation
+
+async def get_conversation_messages(office_id: str, from_number: str,
+                                    uow: AsyncUnitOfWork | None = None) -> list[ModelMessage]:
+    key = (office_id, from_number)
+    conversation = conversation_cache.get(key)
+    if conversation is None:
+        conversation = await load_conversation(office_id, from_number, uow)
+        conversation_cache.set(key, conversation)
+    return conversation.messages()
+
+async def add_message_to_conversation(office_id: str, from_number: str, content: str,
+                                      messages: list[ModelMessage] | None = None,
+                                      uow: AsyncUnitOfWork | None = None) -> ChatMessage:
+    async with session_scope(uow, nested=True) as session:
+        message = ChatMessage(
+            id=uuid7str(),
+            office_id=office_id,
+            phone_number=from_number,
+            timestamp=datetime.datetime.now().isoformat(),
+            content=encode_content(content))
+        session.add(message)
+        await session.flush()
+
+    row = ConversationRow(
+        id=message.id,
+        messages=messages if messages is not None else ModelMessagesTypeAdapter.validate_json(content),
+        size=len(content))
+    after_commit(uow, lambda: conversation_cache.update(
+        (office_id, from_number), lambda conversation: conversation.append(row)))
+    return message
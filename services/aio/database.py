@@ -0,0 +1,169 @@
+import os
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Callable
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import UnitOfWork, database_url, engine_options, read_uow
+from utils import env_flag
+
+# Agent tools read through the async service layer, needs asyncpg (aiosqlite for sqlite).
+async_db_enabled = env_flag('ASYNC_DB')
+
+ASYNC_DRIVERS = {
+    'postgresql': 'asyncpg',
+    'sqlite': 'aiosqlite',
+}
+
+def to_async_url(url: str) -> str:
+    """`url` with the async driver of its database, psycopg2 becomes asyncpg."""
+    url = make_url(url)
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        return url.render_as_string(hide_password=False)
+    return url.set(drivername=f"{url.get_backend_name()}+{driver}").render_as_string(hide_password=False)
+
+async_database_url = os.getenv('ASYNC_DATABASE_URL') or to_async_url(database_url)
+
+_engine: AsyncEngine | None = None
+_engine_lock = threading.Lock()
+
+def async_engine() -> AsyncEngine:
+    """Created on first use, so the async drivers are only needed when enabled."""
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            options = {name: value for name, value in engine_options.items() if name != 'connect_args'}
+            statement_timeout = os.getenv('DB_STATEMENT_TIMEOUT')
+            if statement_timeout and async_database_url.startswith('postgres'):
+                options['connect_args'] = {'server_settings': {'statement_timeout': str(int(statement_timeout))}}
+            _engine = create_async_engine(async_database_url, **options)
+        return _engine
+
+async def dispose_async_engine():
+    """Closes the pooled connections, aiosqlite ones would otherwise keep the process alive."""
+    global _engine
+    with _engine_lock:
+        engine, _engine = _engine, None
+    if engine is not None:
+        await engine.dispose()
+
+class AsyncUnitOfWork:
+    """Async counterpart of `UnitOfWork`, one session and transaction per message.
+
+    Tools awaited concurrently share the session, so it is only used while
+    holding `lock`. The task holding it may take it again.
+    """
+
+    def __init__(self):
+        self.session = AsyncSession(async_engine(), expire_on_commit=False)
+        self.lock = asyncio.Lock()
+        self.flushed = False
+        self._owner: asyncio.Task | None = None
+        self._after_commit: list[Callable[[], None]] = []
+        event.listen(self.session.sync_session, 'after_flush', self._on_flush)
+
+    def _on_flush(self, session, flush_context):
+        self.flushed = True
+
+    @asynccontextmanager
+    async def locked(self):
+        task = asyncio.current_task()
+        if self._owner is task:
+            yield
+            return
+        async with self.lock:
+            self._owner = task
+            try:
+                yield
+            finally:
+                self._owner = None
+
+    def after_commit(self, callback: Callable[[], None]):
+        self._after_commit.append(callback)
+
+    async def commit(self):
+        async with self.locked():
+            await self.session.commit()
+        callbacks, self._after_commit = self._after_commit, []
+        if callbacks:
+            # Some block, like refreshing the contact view.
+            await asyncio.to_thread(lambda: [callback() for callback in callbacks])
+
+    async def rollback(self):
+        async with self.locked():
+            await self.session.rollback()
+        self._after_commit = []
+
+    async def close(self):
+        async with self.locked():
+            await self.session.close()
+        self._after_commit = []
+
+    async def __aenter__(self) -> 'AsyncUnitOfWork':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                await self.commit()
+            else:
+                await self.rollback()
+        finally:
+            await self.close()
+
+@asynccontextmanager
+async def session_scope(uow: AsyncUnitOfWork | None = None, nested: bool = False):
+    """Yields the session of `uow`, or a new one committed when leaving the block."""
+    if uow is not None:
+        async with uow.locked():
+            if nested:
+                async with uow.session.begin_nested():
+                    yield uow.session
+            else:
+                yield uow.session
+        return
+    async with AsyncSession(async_engine(), expire_on_commit=False) as session:
+        yield session
+        await session.commit()
+
+@asynccontextmanager
+async def message_uow():
+    """Unit of work of a message, an `AsyncUnitOfWork` when the async layer is enabled.
+
+    Committed when leaving the block, closed either way.
+    """
+    if async_db_enabled:
+        async with AsyncUnitOfWork() as uow:
+            yield uow
+        return
+    uow = UnitOfWork()
+    try:
+        yield uow
+        await asyncio.to_thread(uow.commit)
+    finally:
+        await asyncio.to_thread(uow.close)
+
+async def run_read(function: Callable, async_function: Callable, *args,
+                   uow: UnitOfWork | AsyncUnitOfWork | None = None, **kwargs):
+    """Awaits the async variant of a read, or runs the sync one in a thread.
+
+    The async service layer is used when enabled and `uow` has nothing the
+    read must see, otherwise the read goes through `uow` like before.
+    """
+    with read_uow(uow) as uow:
+        if isinstance(uow, AsyncUnitOfWork):
+            return await async_function(*args, uow=uow, **kwargs)
+        if uow is None and async_db_enabled:
+            return await async_function(*args, **kwargs)
+        return await asyncio.to_thread(function, *args, uow=uow, **kwargs)
+
+async def run_write(function: Callable, async_function: Callable, *args,
+                    uow: UnitOfWork | AsyncUnitOfWork | None = None, **kwargs):
+    """Awaits the async variant of a write with an `AsyncUnitOfWork`, or runs the sync one in a thread."""
+    if isinstance(uow, AsyncUnitOfWork):
+        return await async_function(*args, uow=uow, **kwargs)
+    return await asyncio.to_thread(function, *args, uow=uow, **kwargs)
@@ -0,0 +1,38 @@
+from sqlmodel import (
+    select,
+)
+from models import (
+    Doctor,
+)
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def find_doctor_by_id(doctor_id: str, uow: AsyncUnitOfWork | None = None) -> Doctor:
+    async with session_scope(uow) as session:
+        statement = select(Doctor)
+        statement = statement.where(Doctor.id == doctor_id)
+        results = await session.exec(statement)
+        return results.first()
+
+async def find_doctor_by_phone_number(office_id, phone_number, uow: AsyncUnitOfWork | None = None) -> Doctor:
+    async with session_scope(uow) as session:
+        statement = select(Doctor)
+        statement = statement.where(Doctor.office_id == office_id)
+        statement = statement.where(Doctor.phone_number == phone_number)
+        results = await session.exec(statement)
+        return results.first()
+
+async def find_doctor_by_name(office_id, doctor_name, uow: AsyncUnitOfWork | None = None) -> Doctor:
+    async with session_scope(uow) as session:
+        statement = select(Doctor)
+        statement = statement.where(Doctor.office_id == office_id)
+        statement = statement.where(Doctor.name == doctor_name)
+        results = await session.exec(statement)
+        return results.first()
+
+async def find_doctors_by_office_id(office_id, uow: AsyncUnitOfWork | None = None) -> list[Doctor]:
+    async with session_scope(uow) as session:
+        statement = select(Doctor)
+        statement = statement.where(Doctor.office_id == office_id)
+        results = await session.exec(statement)
+
+        return list(results)
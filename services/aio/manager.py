@@ -0,0 +1,21 @@
+from sqlmodel import select
+
+from models import (
+    Manager,
+)
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def find_manager_by_id(manager_id: str, uow: AsyncUnitOfWork | None = None) -> Manager:
+    async with session_scope(uow) as session:
+        statement = select(Manager)
+        statement = statement.where(Manager.id == manager_id)
+        results = await session.exec(statement)
+        return results.first()
+
+async def find_manager_by_phone_number(office_id, phone_number, uow: AsyncUnitOfWork | None = None) -> Manager:
+    async with session_scope(uow) as session:
+        statement = select(Manager)
+        statement = statement.where(Manager.office_id == office_id)
+        statement = statement.where(Manager.phone_number == phone_number)
+        results = await session.exec(statement)
+        return results.first()
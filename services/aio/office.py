@@ -0,0 +1,21 @@
+from sqlmodel import (
+    select,
+)
+from models import (
+    Office,
+)
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def find_office_by_phone_number(phone_number, uow: AsyncUnitOfWork | None = None) -> Office:
+    async with session_scope(uow) as session:
+        statement = select(Office)
+        statement = statement.where(Office.phone_number == phone_number)
+        results = await session.exec(statement)
+        return results.first()
+
+async def find_office_by_id(office_id, uow: AsyncUnitOfWork | None = None) -> Office:
+    async with session_scope(uow) as session:
+        statement = select(Office)
+        statement = statement.where(Office.id == office_id)
+        results = await session.exec(statement)
+        return results.first()
@@ -0,0 +1,21 @@
+from sqlmodel import select
+
+from models import (
+    Owner,
+)
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def find_owner_by_id(owner_id: str, uow: AsyncUnitOfWork | None = None) -> Owner:
+    async with session_scope(uow) as session:
+        statement = select(Owner)
+        statement = statement.where(Owner.id == owner_id)
+        results = await session.exec(statement)
+        return results.first()
+
+async def find_owner_by_phone_number(office_id, phone_number, uow: AsyncUnitOfWork | None = None) -> Owner:
+    async with session_scope(uow) as session:
+        statement = select(Owner)
+        statement = statement.where(Owner.office_id == office_id)
+        statement = statement.where(Owner.phone_number == phone_number)
+        results = await session.exec(statement)
+        return results.first()
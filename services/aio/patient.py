@@ -0,0 +1,31 @@
+from sqlmodel import (
+    select,
+)
+from models import (
+    Patient,
+    PatientHistory
+)
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def add_patient(patient, uow: AsyncUnitOfWork | None = None) -> Patient:
+    async with session_scope(uow, nested=True) as session:
+        session.add(patient)
+        await session.flush()
+        return patient
+
+async def find_patient(office_id, phone_number, uow: AsyncUnitOfWork | None = None) -> Patient:
+    async with session_scope(uow) as session:
+        statement = select(Patient)
+        statement = statement.where(Patient.office_id == office_id)
+        statement = statement.where(Patient.phone_number == phone_number)
+        results = await session.exec(statement)
+        return results.first()
+
+async def find_patient_history(patient_id, uow: AsyncUnitOfWork | None = None) -> Patient:
+    async with session_scope(uow) as session:
+        statement = select(PatientHistory)
+        statement = statement.where(PatientHistory.patient_id == patient_id)
+        statement = statement.limit(5)
+        statement = statement.order_by(PatientHistory.date_time.desc())
+        results = await session.exec(statement)
+        return results.first()
@@ -0,0 +1,53 @@
+import datetime
+from models import Appointment
+from services.slots import (
+    LOCK_DOCTOR,
+    SlotUnavailable,
+    _overlapping,
+    check_bookable,
+    free_slots,
+    local_now,
+    office_hours,
+    slot_duration,
+    slot_window,
+    to_local,
+)
+from services.aio.appointment import add_appointment, list_doctor_appointment_times
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def find_available_slots(opening_hours: str | None, doctor_id: str,
+                               start: datetime.datetime | None = None,
+                               end: datetime.datetime | None = None, limit: int = 10,
+                               uow: AsyncUnitOfWork | None = None) -> list[datetime.datetime]:
+    """First `limit` free slots of the doctor, from now to `SLOT_WINDOW_DAYS` ahead by default."""
+    start = max(to_local(start), local_now()) if start else local_now()
+    end = to_local(end) if end else start + slot_window
+    busy = await list_doctor_appointment_times(doctor_id, start - slot_duration, end, uow=uow)
+    return free_slots(office_hours(opening_hours), busy, start, end, limit)
+
+async def _lock_doctor(session, doctor_id: str):
+    if session.get_bind().dialect.name == 'postgresql':
+        await session.execute(LOCK_DOCTOR, {'key': f'appointment:{doctor_id}'})
+
+async def _reserve(appointment: Appointment, uow: AsyncUnitOfWork) -> Appointment:
+    slot = appointment.date_time
+    async with session_scope(uow) as session:
+        await _lock_doctor(session, appointment.doctor_id)
+        busy = await list_doctor_appointment_times(appointment.doctor_id, slot - slot_duration,
+                                                   slot + slot_duration, uow=uow)
+        conflict = _overlapping(busy, slot, slot_duration)
+        if conflict is not None:
+            raise SlotUnavailable(slot, conflict)
+    return await add_appointment(appointment, uow=uow)
+
+async def reserve_slot(appointment: Appointment, opening_hours: str | None,
+                       uow: AsyncUnitOfWork | None = None) -> Appointment:
+    """Adds the appointment, raising `SlotUnavailable` if the doctor isn't free then.
+
+    Committed right away in a transaction of its own, unless `uow` already wrote something.
+    """
+    check_bookable(appointment, opening_hours)
+    if uow is not None and uow.flushed:
+        return await _reserve(appointment, uow)
+    async with AsyncUnitOfWork() as own:
+        return await _reserve(appointment, own)
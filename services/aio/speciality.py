@@ -0,0 +1,15 @@
+from sqlmodel import (
+    select,
+)
+from models import (
+    Speciality,
+)
+from services.aio.database import AsyncUnitOfWork, session_scope
+
+async def find_specilities_by_office_id(office_id, uow: AsyncUnitOfWork | None = None) -> list[Speciality]:
+    async with session_scope(uow) as session:
+        statement = select(Speciality)
+        statement = statement.where(Speciality.office_id == office_id)
+        results = await session.exec(statement)
+
+        return list(results)
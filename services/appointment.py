@@ -1,7 +1,7 @@
-from database import engine
+import datetime
+from database import UnitOfWork, session_scope
 from sqlmodel import (
     select,
-    Session
 )
 from models import (
     Appointment, 
@@ -10,22 +10,18 @@ from models import (
     Patient
 )
     
-def list_office_appointments(office_id, actual_date_time) -> list[Appointment]:
-    with Session(engine) as session:
+def list_office_appointments(office_id, actual_date_time, uow: UnitOfWork | None = None) -> list[Appointment]:
+    with session_scope(uow) as session:
         statement = select(Appointment)
         statement = statement.where(Appointment.date_time >= actual_date_time)
         statement = statement.where(Appointment.office_id == office_id)
         statement = statement.limit(10)
         results = session.exec(statement)
         
-        appointments: list[Appointment] = []
-        for appointment in results:
-            appointments.extend(appointment)
+        return list(results)
 
-        return appointments
-
-def list_doctor_appointments(doctor_id, actual_date_time) -> list[DoctorAppointment]:
-    with Session(engine) as session:
+def list_doctor_appointments(doctor_id, actual_date_time, uow: UnitOfWork | None = None) -> list[DoctorAppointment]:
+    with session_scope(uow) as session:
         statement = select(Appointment, Patient).join(Patient)
         statement = statement.where(Appointment.date_time >= actual_date_time)
         statement = statement.where(Appointment.doctor_id == doctor_id)
@@ -33,7 +29,7 @@ def list_doctor_appointments(doctor_id, actual_date_time) -> list[DoctorAppointm
         
         appointments: list[DoctorAppointment] = []
         for appointment, patient in results:
-            appointments.extend(
+            appointments.append(
               DoctorAppointment(
                 patient_id=patient.id, 
                 patient_name=patient.name, 
@@ -43,8 +39,8 @@ def list_doctor_appointments(doctor_id, actual_date_time) -> list[DoctorAppointm
 
         return appointments
     
-def find_appointment(office_id, patient_id, actual_date_time) -> Patient: 
-    with Session(engine) as session:
+def find_appointment(office_id, patient_id, actual_date_time, uow: UnitOfWork | None = None) -> Patient: 
+    with session_scope(uow) as session:
         statement = select(Appointment, Patient, Office)
         statement = statement.where(Appointment.office_id == office_id)
         statement = statement.where(Appointment.patient_id == Patient.id)
@@ -57,19 +53,27 @@ def find_appointment(office_id, patient_id, actual_date_time) -> Patient:
             return next_appointment[0]
         return None
           
-def add_appointment(appointment) -> Appointment: 
-    with Session(engine) as session:
+def list_doctor_appointment_times(doctor_id, start: datetime.datetime, end: datetime.datetime,
+                                  uow: UnitOfWork | None = None) -> list[datetime.datetime]:
+    with session_scope(uow) as session:
+        statement = select(Appointment.date_time)
+        statement = statement.where(Appointment.doctor_id == doctor_id)
+        statement = statement.where(Appointment.date_time >= start)
+        statement = statement.where(Appointment.date_time < end)
+        statement = statement.order_by(Appointment.date_time)
+        return list(session.exec(statement))
+
+def add_appointment(appointment, uow: UnitOfWork | None = None) -> Appointment: 
+    with session_scope(uow, nested=True) as session:
         session.add(appointment)
-        session.commit()
         session.flush()
         return appointment
 
-def delete_appointment(appointment: Appointment) -> bool: 
-    with Session(engine) as session:
+def delete_appointment(appointment: Appointment, uow: UnitOfWork | None = None) -> bool: 
+    with session_scope(uow, nested=True) as session:
         statement = select(Appointment).where(Appointment.id == appointment.id)
         results = session.exec(statement)
         appointment = results.one()
         session.delete(appointment)
-        session.commit()
+        session.flush()
         return True
-
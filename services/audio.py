@@ -0,0 +1,113 @@
+import os
+import shutil
+import logging
+import threading
+import subprocess
+from dataclasses import dataclass
+from dotenv import load_dotenv
+from utils import env_flag
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:audio')
+
+SAMPLE_RATE = 16000
+# Mono signed 16 bit PCM.
+BYTES_PER_SECOND = SAMPLE_RATE * 2
+
+ffmpeg_path = shutil.which(os.getenv('FFMPEG_PATH') or 'ffmpeg')
+preprocess_enabled = env_flag('AUDIO_PREPROCESS', True)
+# Preprocessing is skipped without ffmpeg.
+preprocess_available = preprocess_enabled and ffmpeg_path is not None
+max_seconds = float(os.getenv('AUDIO_MAX_SECONDS') or 600)
+split_long_audio = env_flag('AUDIO_SPLIT', True)
+silence_threshold = os.getenv('AUDIO_SILENCE_THRESHOLD') or '-50dB'
+opus_bitrate = os.getenv('AUDIO_BITRATE') or '24k'
+ffmpeg_timeout = float(os.getenv('AUDIO_PREPROCESS_TIMEOUT') or 30)
+too_long_reply = (os.getenv('AUDIO_TOO_LONG_REPLY') or
+                  "Your voice message is too long, please send a shorter one or type your message.")
+
+class AudioTooLong(Exception):
+    pass
+
+@dataclass
+class PreprocessedAudio:
+    segments: list[bytes]
+    original_bytes: int
+    duration: float
+
+    @property
+    def processed_bytes(self) -> int:
+        return sum(len(segment) for segment in self.segments)
+
+class AudioStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.original_bytes = 0
+        self.processed_bytes = 0
+
+    def record(self, audio: PreprocessedAudio):
+        with self._lock:
+            self.messages += 1
+            self.original_bytes += audio.original_bytes
+            self.processed_bytes += audio.processed_bytes
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'messages': self.messages,
+                'original_bytes': self.original_bytes,
+                'processed_bytes': self.processed_bytes,
+                'saved_bytes': self.original_bytes - self.processed_bytes,
+            }
+
+audio_stats = AudioStats()
+
+def _ffmpeg(args: list[str], content: bytes) -> bytes:
+    result = subprocess.run(
+        [ffmpeg_path, '-hide_banner', '-loglevel', 'error', *args],
+        input=content, capture_output=True, timeout=ffmpeg_timeout, check=True)
+    return result.stdout
+
+def _decode(content: bytes) -> bytes:
+    # Trims leading silence, then trailing silence by trimming the reversed audio.
+    trim = f'silenceremove=start_periods=1:start_threshold={silence_threshold}'
+    return _ffmpeg([
+        '-i', 'pipe:0',
+        '-ac', '1', '-ar', str(SAMPLE_RATE),
+        '-af', f'{trim},areverse,{trim},areverse',
+        '-f', 's16le', 'pipe:1',
+    ], content)
+
+def _encode(pcm: bytes) -> bytes:
+    return _ffmpeg([
+        '-f', 's16le', '-ac', '1', '-ar', str(SAMPLE_RATE), '-i', 'pipe:0',
+        '-c:a', 'libopus', '-b:a', opus_bitrate, '-application', 'voip',
+        '-f', 'ogg', 'pipe:1',
+    ], pcm)
+
+def preprocess_audio(content: bytes) -> PreprocessedAudio | None:
+    """Downmixes to mono 16 kHz, trims silence and re-encodes as small Ogg/Opus.
+
+    Audio longer than `AUDIO_MAX_SECONDS` is split in segments of that length,
+    or rejected with `AudioTooLong` when `AUDIO_SPLIT` is off. Returns None
+    when preprocessing is disabled or ffmpeg is not available.
+    """
+    if not preprocess_available:
+        return None
+
+    pcm = _decode(content)
+    duration = len(pcm) / BYTES_PER_SECOND
+    if duration > max_seconds and not split_long_audio:
+        raise AudioTooLong(f"Audio is {duration:.0f}s long, the limit is {max_seconds:.0f}s")
+
+    segment_size = int(max_seconds * SAMPLE_RATE) * 2
+    segments = [_encode(pcm[start:start + segment_size])
+                for start in range(0, len(pcm), segment_size)]
+    audio = PreprocessedAudio(segments=segments, original_bytes=len(content),
+                              duration=duration)
+    audio_stats.record(audio)
+    logger.info(f"Preprocessed {duration:.1f}s of audio: {audio.original_bytes} -> "
+                f"{audio.processed_bytes} bytes in {len(segments)} segment(s)")
+    return audio
@@ -0,0 +1,83 @@
+import os
+import json
+import logging
+import threading
+from dotenv import load_dotenv
+from kafka import KafkaConsumer, KafkaProducer
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:broker')
+
+inbound_topic = os.getenv('INBOUND_TOPIC') or 'process_message'
+# Replies are sent right away when no outbound topic is configured.
+outbound_topic = os.getenv('OUTBOUND_TOPIC')
+# Messages that kept failing are published here, or left uncommitted when unset.
+dead_letter_topic = os.getenv('DEAD_LETTER_TOPIC')
+publish_timeout = float(os.getenv('KAFKA_PUBLISH_TIMEOUT') or 10)
+
+def connection_configs() -> dict:
+    kafka_client_id = os.getenv('KAFKA_CLIENT_ID')
+    kafka_security_protocol = os.getenv('KAFKA_SECURITY_PROTOCOL')
+    return dict(
+        bootstrap_servers=os.getenv('KAFKA_BROKER'),
+        api_version=(3, 9, 0),
+        client_id=kafka_client_id if kafka_client_id else "health_up",
+        security_protocol=kafka_security_protocol if kafka_security_protocol else "PLAINTEXT",
+        sasl_mechanism=os.getenv('KAFKA_SASL_MECHANISM'),
+        sasl_plain_username=os.getenv('KAFKA_USER'),
+        sasl_plain_password=os.getenv('KAFKA_PASSWORD'),
+    )
+
+def create_consumer(*topics, group_id: str | None = None, **configs) -> KafkaConsumer:
+    kafka_group_id = group_id or os.getenv('KAFKA_GROUP_ID')
+    return KafkaConsumer(
+        *topics,
+        group_id=kafka_group_id if kafka_group_id else "health_up",
+        value_deserializer=lambda m: json.loads(m.decode('utf-8')),
+        **connection_configs(),
+        **configs)
+
+def create_producer(**configs) -> KafkaProducer:
+    return KafkaProducer(
+        key_serializer=lambda k: k.encode('utf-8'),
+        value_serializer=lambda v: json.dumps(v).encode('utf-8'),
+        acks='all',
+        linger_ms=int(os.getenv('KAFKA_LINGER_MS') or 5),
+        **connection_configs(),
+        **configs)
+
+_producer: KafkaProducer | None = None
+_producer_lock = threading.Lock()
+
+def producer() -> KafkaProducer:
+    """Created on first use, shared by the worker threads and the event loop."""
+    global _producer
+    with _producer_lock:
+        if _producer is None:
+            _producer = create_producer()
+        return _producer
+
+def publish_reply(from_number, to_number, body_text, is_media, ai_response_id):
+    """Queues a reply for the sender workers.
+
+    Replies are keyed by recipient so the replies to a contact stay in order.
+    Waits for the broker to acknowledge it, so the inbound message is only
+    committed once its reply can't be lost.
+    """
+    future = producer().send(outbound_topic, key=to_number, value={
+        'from': from_number,
+        'to': to_number,
+        'body': body_text,
+        'is_media': is_media,
+        'ai_response_id': ai_response_id,
+    })
+    future.get(timeout=publish_timeout)
+
+def publish_dead_letter(message: dict, error: str):
+    """Parks a message that couldn't be handled, so its offset can be committed."""
+    future = producer().send(dead_letter_topic, key=message.get('from_number') or '', value={
+        'message': message,
+        'error': error,
+    })
+    future.get(timeout=publish_timeout)
@@ -1,51 +1,222 @@
+import os
+import json
 import datetime
+from collections import deque
+from dataclasses import dataclass, field
 from uuid_extensions import uuid7str
-from database import engine
+from database import UnitOfWork, after_commit, engine, session_scope
 from sqlmodel import (
+    or_,
     select,
     Session
 )
 from models import (
     ChatMessage
 )
+from cache import TTLCache
+from services.chat_codec import (
+    chat_content_version,
+    decode_content,
+    encode_content,
+    is_encoded,
+)
 from pydantic_ai.messages import (
     ModelMessage,
     ModelMessagesTypeAdapter,
 )
-    
-def get_conversation_messages(office_id: str, from_number: str) -> list[ModelMessage]:
-    with Session(engine) as session:
+
+HISTORY_LIMIT = 50
+SUMMARY_ROLE = 'summary'
+
+@dataclass
+class ConversationRow:
+    id: str
+    messages: list[ModelMessage]
+    size: int
+
+@dataclass
+class ConversationSummary:
+    content: str = ''
+    covered_until: datetime.datetime | None = None
+
+@dataclass
+class Conversation:
+    """Parsed rows of a conversation: the first one, which may hold the system
+    prompt, and the latest `HISTORY_LIMIT` ones."""
+    first: ConversationRow | None = None
+    recent: deque[ConversationRow] = field(default_factory=lambda: deque(maxlen=HISTORY_LIMIT))
+
+    def append(self, row: ConversationRow) -> 'Conversation':
+        if self.first is None:
+            self.first = row
+        else:
+            self.recent.append(row)
+        return self
+
+    def messages(self) -> list[ModelMessage]:
         messages: list[ModelMessage] = []
+        if self.first is not None:
+            messages.extend(self.first.messages)
+        for row in self.recent:
+            messages.extend(row.messages)
+        return messages
+
+    @property
+    def size(self) -> int:
+        size = self.first.size if self.first is not None else 0
+        return size + sum(row.size for row in self.recent)
+
+# Parsed messages take several times the size of their JSON, the budget is
+# expressed in stored bytes to keep the accounting cheap.
+conversation_cache = TTLCache(
+    maxsize=int(os.getenv('HISTORY_CACHE_SIZE') or 5000),
+    ttl=float(os.getenv('HISTORY_CACHE_TTL') or 600),
+    max_weight=int(os.getenv('HISTORY_CACHE_MAX_BYTES') or 64 * 1024 * 1024),
+    weigh=lambda conversation: conversation.size)
+
+def _to_row(message: ChatMessage) -> ConversationRow:
+    content = decode_content(message.content)
+    return ConversationRow(
+        id=message.id,
+        messages=ModelMessagesTypeAdapter.validate_json(content),
+        size=len(content))
+
+def _is_conversation_message():
+    return or_(ChatMessage.role.is_(None), ChatMessage.role != SUMMARY_ROLE)
+
+def load_conversation(office_id: str, from_number: str, uow: UnitOfWork | None = None) -> Conversation:
+    with session_scope(uow) as session:
+        conversation = Conversation()
         statement = select(ChatMessage)
         statement = statement.where(ChatMessage.office_id == office_id)
         statement = statement.where(ChatMessage.phone_number == from_number)
+        statement = statement.where(_is_conversation_message())
         statement = statement.limit(1)
         statement = statement.order_by(ChatMessage.timestamp.asc())
-        results = session.exec(statement)
-        for message in results:
-            messages.extend(ModelMessagesTypeAdapter.validate_json(message.content))
+        first = session.exec(statement).first()
+        if first is None:
+            return conversation
+        conversation.append(_to_row(first))
 
-        actual_date_time = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S%z")
         statement = select(ChatMessage)
+        statement = statement.where(ChatMessage.office_id == office_id)
         statement = statement.where(ChatMessage.phone_number == from_number)
-        statement = statement.where(ChatMessage.timestamp < actual_date_time)
-        statement = statement.limit(50)
-        statement = statement.order_by(ChatMessage.timestamp.asc())
-        results = session.exec(statement)
-        
-        for message in results:
-            messages.extend(ModelMessagesTypeAdapter.validate_json(message.content))
-            
-        return messages
-      
-def add_message_to_conversation(office_id: str, from_number: str, content: str):
-    with Session(engine, expire_on_commit=False) as session:  
+        statement = statement.where(ChatMessage.id != first.id)
+        statement = statement.where(_is_conversation_message())
+        statement = statement.limit(HISTORY_LIMIT)
+        statement = statement.order_by(ChatMessage.timestamp.desc())
+        results = session.exec(statement).all()
+
+        for message in reversed(results):
+            conversation.append(_to_row(message))
+
+        return conversation
+
+def get_conversation_messages(office_id: str, from_number: str,
+                              uow: UnitOfWork | None = None) -> list[ModelMessage]:
+    key = (office_id, from_number)
+    conversation = conversation_cache.get(key)
+    if conversation is None:
+        conversation = load_conversation(office_id, from_number, uow)
+        conversation_cache.set(key, conversation)
+    return conversation.messages()
+
+def conversation_cache_stats() -> dict[str, int]:
+    return conversation_cache.stats()
+
+def add_message_to_conversation(office_id: str, from_number: str, content: str,
+                                messages: list[ModelMessage] | None = None,
+                                uow: UnitOfWork | None = None):
+    with session_scope(uow, nested=True) as session:
       message = ChatMessage(
         id=uuid7str(),
         office_id=office_id,
-        phone_number=from_number, 
-        timestamp=datetime.datetime.now().isoformat(), 
-        content=content)
+        phone_number=from_number,
+        timestamp=datetime.datetime.now().isoformat(),
+        content=encode_content(content))
       session.add(message)
-      session.commit()
-      return message
+      session.flush()
+
+    row = ConversationRow(
+      id=message.id,
+      messages=messages if messages is not None else ModelMessagesTypeAdapter.validate_json(content),
+      size=len(content))
+    after_commit(uow, lambda: conversation_cache.update(
+      (office_id, from_number), lambda conversation: conversation.append(row)))
+    return message
+
+summary_cache = TTLCache(
+    maxsize=int(os.getenv('HISTORY_CACHE_SIZE') or 5000),
+    ttl=float(os.getenv('HISTORY_CACHE_TTL') or 600))
+
+def find_conversation_summary(office_id: str, from_number: str) -> ConversationSummary:
+    key = (office_id, from_number)
+    summary = summary_cache.get(key)
+    if summary is not None:
+        return summary
+
+    with session_scope() as session:
+        statement = select(ChatMessage)
+        statement = statement.where(ChatMessage.office_id == office_id)
+        statement = statement.where(ChatMessage.phone_number == from_number)
+        statement = statement.where(ChatMessage.role == SUMMARY_ROLE)
+        statement = statement.limit(1)
+        statement = statement.order_by(ChatMessage.timestamp.desc())
+        message = session.exec(statement).first()
+
+    summary = ConversationSummary()
+    if message is not None:
+        data = json.loads(decode_content(message.content))
+        summary = ConversationSummary(
+            content=data['content'],
+            covered_until=datetime.datetime.fromisoformat(data['covered_until']))
+    summary_cache.set(key, summary)
+    return summary
+
+def save_conversation_summary(office_id: str, from_number: str,
+                              summary: ConversationSummary) -> ChatMessage:
+    content = encode_content(json.dumps({
+        'content': summary.content,
+        'covered_until': summary.covered_until.isoformat(),
+    }))
+    with session_scope() as session:
+        message = ChatMessage(
+            id=uuid7str(),
+            office_id=office_id,
+            phone_number=from_number,
+            role=SUMMARY_ROLE,
+            timestamp=datetime.datetime.now().isoformat(),
+            content=content)
+        session.add(message)
+    summary_cache.set((office_id, from_number), summary)
+    return message
+
+def compact_chat_messages(batch_size: int = 500, dry_run: bool = False) -> tuple[int, int, int]:
+    """Rewrites rows stored in an older format with the current one.
+
+    Returns the number of rewritten rows and their size before and after.
+    """
+    rows = size_before = size_after = 0
+    last_id = ''
+    while True:
+        with Session(engine) as session:
+            statement = select(ChatMessage)
+            statement = statement.where(ChatMessage.id > last_id)
+            statement = statement.order_by(ChatMessage.id.asc())
+            statement = statement.limit(batch_size)
+            messages = session.exec(statement).all()
+            if not messages:
+                break
+            for message in messages:
+                if is_encoded(message.content, chat_content_version):
+                    continue
+                content = encode_content(decode_content(message.content))
+                rows += 1
+                size_before += len(message.content)
+                size_after += len(content)
+                message.content = content
+                session.add(message)
+            last_id = messages[-1].id
+            if not dry_run:
+                session.commit()
+    return rows, size_before, size_after
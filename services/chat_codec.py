@@ -0,0 +1,117 @@
+import os
+import json
+import zlib
+
+# Stored content is either the legacy raw JSON or MAGIC + version + payload.
+MAGIC = b'\x00HU'
+# Version 1 dropped every null, including the content of tools returning None,
+# those rows are repaired when read. Version 2 only drops `OPTIONAL_FIELDS`.
+VERSION_ZLIB = 1
+VERSION_ZLIB_NULLS = 2
+VERSIONS = (VERSION_ZLIB, VERSION_ZLIB_NULLS)
+
+# Fragments that show up in every serialized conversation. This dictionary is
+# part of format version 1: rows written with it can only be read with the
+# exact same bytes, so never edit it, add a new version instead.
+ZLIB_DICTIONARY = b''.join([
+    b'"model_name":"gpt-4o-2024-08-06",',
+    b'"tool_call_id":"call_',
+    b'"args":"{}","tool_call_id":"call_',
+    b'"part_kind":"tool-call"}],',
+    b'"part_kind":"tool-return"}],"kind":"request"},',
+    b'"part_kind":"retry-prompt"}],"kind":"request"},',
+    b'"part_kind":"system-prompt"},',
+    b'"part_kind":"user-prompt"}],"kind":"request"},',
+    b'"part_kind":"text"}],',
+    b'"kind":"response"},',
+    b'{"parts":[{"tool_name":"get_office_info","content":{"id":"',
+    b'{"parts":[{"tool_name":"get_patient","content":{"id":"',
+    b'{"parts":[{"tool_name":"list_doctors","content":[{"id":"',
+    b'{"parts":[{"tool_name":"list_specialities","content":[{"id":"',
+    b'{"parts":[{"tool_name":"get_appointment","content":{"id":"',
+    b'{"parts":[{"tool_name":"current_date_time","content":"Current date and time is: ',
+    b'"name":"","description":"","address":"","phone_number":"+55',
+    b'"email":"","website":"https://","opening_hours":"","maps_link":"https://maps.app.goo.gl/',
+    b'"reviews":"","bio":null,"office_id":"',
+    b'"date_time":"","patient_id":"","doctor_id":"',
+    b'"timestamp":"20',
+    b'{"parts":[{"content":"',
+])
+
+# Fields that default to None when parsing, by message and part kind. Nulls are
+# only dropped from these: anything else, like the content of a tool return,
+# is required even when null.
+OPTIONAL_FIELDS = {
+    'response': {'model_name'},
+    'system-prompt': {'dynamic_ref'},
+    'tool-call': {'tool_call_id'},
+    'tool-return': {'tool_call_id'},
+    'retry-prompt': {'tool_name', 'tool_call_id'},
+}
+
+def _drop_nulls(item: dict, kind: str | None) -> dict:
+    optional = OPTIONAL_FIELDS.get(kind, ())
+    return {key: value for key, value in item.items() if value is not None or key not in optional}
+
+def _strip(message: dict) -> dict:
+    message = _drop_nulls(message, message.get('kind'))
+    if 'parts' in message:
+        message['parts'] = [_drop_nulls(part, part.get('part_kind')) for part in message['parts']]
+    return message
+
+def _restore(content: bytes) -> bytes:
+    # Version 1 rows lost the content of tools that returned None.
+    data = json.loads(content)
+    if not isinstance(data, list):
+        return content
+    for message in data:
+        for part in message.get('parts', []) if isinstance(message, dict) else []:
+            if part.get('part_kind') == 'tool-return':
+                part.setdefault('content', None)
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+def compact_json(content: bytes | str) -> bytes:
+    data = json.loads(content)
+    if isinstance(data, list):
+        data = [_strip(message) if isinstance(message, dict) else message
+                for message in data]
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False).encode()
+
+def encode_content(content: bytes | str, version: int | None = None) -> bytes:
+    """Turns serialized messages into the stored representation."""
+    if version is None:
+        version = chat_content_version
+    if version == 0:
+        return content.encode() if isinstance(content, str) else bytes(content)
+    if version in VERSIONS:
+        compressor = zlib.compressobj(level=9, zdict=ZLIB_DICTIONARY)
+        payload = compressor.compress(compact_json(content)) + compressor.flush()
+        return MAGIC + bytes([version]) + payload
+    raise ValueError(f"Unknown chat content version: {version}")
+
+def decode_content(content: bytes | memoryview | str) -> bytes:
+    """Returns the JSON of a stored row, whatever version it was written with."""
+    if isinstance(content, str):
+        return content.encode()
+    content = bytes(content)
+    if not content.startswith(MAGIC):
+        return content
+    version = content[len(MAGIC)]
+    payload = content[len(MAGIC) + 1:]
+    if version in VERSIONS:
+        decompressor = zlib.decompressobj(zdict=ZLIB_DICTIONARY)
+        content = decompressor.decompress(payload) + decompressor.flush()
+        return _restore(content) if version == VERSION_ZLIB else content
+    raise ValueError(f"Unknown chat content version: {version}")
+
+def is_encoded(content: bytes | memoryview | str, version: int | None = None) -> bool:
+    if isinstance(content, str):
+        return False
+    content = bytes(content[:len(MAGIC) + 1])
+    if not content.startswith(MAGIC):
+        return False
+    return version is None or content[len(MAGIC)] == version
+
+# 0 writes legacy raw JSON and 1 the first compressed format, useful to roll
+# back to a worker that can't read newer rows.
+chat_content_version = int(os.getenv('CHAT_CONTENT_VERSION') or VERSION_ZLIB_NULLS)
@@ -1,16 +1,28 @@
-from database import engine
+from database import UnitOfWork, engine, session_scope
 from sqlmodel import (
     select,
-    Session
+    text,
 )
 from models import (
     Contact, 
 )
 
-def find_contact_by_phone_number(office_id: str, phone_number: str) -> Contact | None:
-    with Session(engine) as session:
+def find_contact_by_phone_number(office_id: str, phone_number: str, uow: UnitOfWork | None = None) -> Contact | None:
+    with session_scope(uow) as session:
         statement = select(Contact)
         statement = statement.where(Contact.office_id == office_id)
         statement = statement.where(Contact.phone_number == phone_number)
         contact = session.exec(statement).first()
-        return contact
\ No newline at end of file
+        return contact
+
+def refresh_contact_view(concurrently: bool = True):
+    """Refreshes the contact materialized view, a no-op outside Postgres.
+
+    Refreshing concurrently needs the unique `ux_contact_kind_id` index and
+    does not block readers.
+    """
+    if engine.dialect.name != 'postgresql':
+        return
+    with session_scope() as session:
+        session.exec(text(
+          f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if concurrently else ''}contact"))
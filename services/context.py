@@ -0,0 +1,108 @@
+import os
+import json
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pydantic_ai.messages import ModelRequest, SystemPromptPart
+from models import (
+    Appointment,
+    Doctor,
+    Office,
+    Patient,
+    Speciality,
+)
+from utils import actual_date_time, env_flag
+from services.appointment import find_appointment
+from services.patient import find_patient
+from services.projection import project
+from services.reference import find_office_reference
+from services.routing import Route
+
+logger = logging.getLogger('health_up:context')
+
+context_prefetch_enabled = env_flag('CONTEXT_PREFETCH', True)
+prefetch_timeout = float(os.getenv('CONTEXT_PREFETCH_TIMEOUT') or 10)
+
+# Every query gets its own session, so they can run at the same time.
+prefetch_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv('CONTEXT_PREFETCH_WORKERS') or 8),
+    thread_name_prefix='prefetch')
+
+CONTEXT_HEADER = ("Current context, already fetched from the database. "
+                  "Use it instead of calling tools for the same data:")
+
+def _dump(tool_name: str, value) -> dict | list | None:
+    """`value` as the tool would return it."""
+    value = project(tool_name, value)
+    if value is None or isinstance(value, dict):
+        return value
+    if isinstance(value, list):
+        return [item if isinstance(item, dict) else item.model_dump(mode='json', exclude_none=True)
+                for item in value]
+    return value.model_dump(mode='json', exclude_none=True)
+
+@dataclass
+class AppointmentContext:
+    """Snapshot of what the appointment agent looks up on almost every turn."""
+    office: Office
+    patient: Patient | None
+    appointment: Appointment | None
+    doctors: list[Doctor]
+    specialities: list[Speciality]
+
+    def summary(self) -> str:
+        return json.dumps({
+            'office': _dump('get_office_info', self.office),
+            'patient': _dump('get_patient', self.patient),
+            'appointment': _dump('get_appointment', self.appointment),
+            'doctors': _dump('list_doctors', self.doctors),
+            'specialities': _dump('list_specialities', self.specialities),
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    def message(self) -> ModelRequest:
+        """Request to append to the message history, it is not stored with the conversation."""
+        return ModelRequest(parts=[SystemPromptPart(content=f"{CONTEXT_HEADER}\n{self.summary()}")])
+
+class ContextPrefetch:
+    """Appointment context queries running in the background."""
+
+    def __init__(self, route: Route, patient_phone_number: str):
+        office_id = route.office.id
+        self.office = route.office
+        self._patient = prefetch_executor.submit(find_patient, office_id, patient_phone_number)
+        self._appointment: Future | None = None
+        if route.contact_id is not None:
+            now = actual_date_time('America/Sao_Paulo')
+            self._appointment = prefetch_executor.submit(
+                find_appointment, office_id, route.contact_id, now.date_time)
+        # Doctors and specialities are usually already cached.
+        self._reference = prefetch_executor.submit(find_office_reference, office_id)
+
+    def cancel(self):
+        """Drops the queries that didn't start yet, for messages the agent won't answer."""
+        for future in (self._patient, self._appointment, self._reference):
+            if future is not None:
+                future.cancel()
+
+    def result(self, timeout: float = prefetch_timeout) -> AppointmentContext | None:
+        """Waits for the queries, returns None if any of them failed so the agent uses its tools."""
+        try:
+            reference = self._reference.result(timeout)
+            return AppointmentContext(
+                office=self.office,
+                patient=self._patient.result(timeout),
+                appointment=self._appointment.result(timeout) if self._appointment else None,
+                doctors=reference.doctors,
+                specialities=reference.specialities,
+            )
+        except Exception as e:
+            logger.error(f"Error prefetching context for office {self.office.id}: {e}")
+            return None
+
+def prefetch_context(route: Route, contact_phone_number: str) -> ContextPrefetch | None:
+    """Starts fetching the context of agents that have one, patients for now."""
+    if not context_prefetch_enabled:
+        return None
+    if route.contact_kind is not None and route.contact_kind != 'patient':
+        return None
+    return ContextPrefetch(route, contact_phone_number)
@@ -0,0 +1,93 @@
+import os
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+import httpx
+import openai
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:deadline')
+
+message_deadline = float(os.getenv('MESSAGE_DEADLINE') or 120)
+agent_timeout = float(os.getenv('AGENT_TIMEOUT') or 60)
+# Bounds every single model request, so one hung connection can't use the whole budget.
+model_request_timeout = float(os.getenv('MODEL_REQUEST_TIMEOUT') or 30)
+# The timed out message is dropped, so the reply must not promise an answer to it.
+deadline_reply = (os.getenv('DEADLINE_REPLY') or
+                  "Sorry, this is taking longer than expected. Please send your message again.")
+
+TIMEOUT_ERRORS = (
+    TimeoutError,
+    asyncio.TimeoutError,
+    httpx.TimeoutException,
+    openai.APITimeoutError,
+    requests.Timeout,
+)
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage: str):
+        self.stage = stage
+        super().__init__(f"Deadline exceeded during {stage}")
+
+class Deadline:
+    """Time budget of a message, every stage gets at most what is left of it."""
+
+    def __init__(self, seconds: float = message_deadline):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    @property
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def check(self, stage: str):
+        if self.expired:
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, stage: str, limit: float) -> float:
+        """Timeout for a stage: its own `limit` or what is left of the deadline."""
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(stage)
+        return min(limit, remaining)
+
+    @contextmanager
+    def stage(self, stage: str):
+        """Turns timeouts, and any failure once the deadline passed, into `DeadlineExceeded`."""
+        self.check(stage)
+        try:
+            yield
+        except DeadlineExceeded:
+            raise
+        except TIMEOUT_ERRORS as e:
+            raise DeadlineExceeded(stage) from e
+        except Exception as e:
+            if self.expired:
+                raise DeadlineExceeded(stage) from e
+            raise
+
+    async def wait(self, stage: str, coroutine, limit: float):
+        """Awaits `coroutine`, cancelling it after the stage timeout."""
+        try:
+            timeout = self.timeout(stage, limit)
+        except DeadlineExceeded:
+            coroutine.close()
+            raise
+        with self.stage(stage):
+            return await asyncio.wait_for(coroutine, timeout)
+
+    def run(self, stage: str, coroutine, limit: float):
+        """Blocking version of `wait`, for the synchronous worker."""
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+        return loop.run_until_complete(self.wait(stage, coroutine, limit))
@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import datetime
+import threading
+from sqlalchemy import delete, inspect
+from sqlmodel import select
+from database import UnitOfWork, after_commit, engine, session_scope
+from services.aio.database import AsyncUnitOfWork, session_scope as async_session_scope
+from models import ProcessedMessage
+from cache import TTLCache
+from utils import env_flag
+
+logger = logging.getLogger('health_up:dedup')
+
+dedup_enabled = env_flag('DEDUP_ENABLED', True)
+
+# Fields Twilio identifies a message with, depending on how it was forwarded.
+SID_FIELDS = ('message_sid', 'sms_message_sid', 'MessageSid', 'SmsMessageSid', 'sid')
+
+def message_key(message: dict) -> tuple[str, bool]:
+    """Returns the dedup key of a message and whether it is its Twilio SID."""
+    for name in SID_FIELDS:
+        if message.get(name):
+            return f"sid:{message[name]}", True
+    payload = json.dumps(message, sort_keys=True, separators=(',', ':'), default=str)
+    return 'sha256:' + hashlib.sha256(payload.encode()).hexdigest(), False
+
+class DedupStore:
+    """Remembers processed messages and their replies.
+
+    Recent keys are kept in memory and every key is stored in the
+    `processedmessage` table, in the same transaction as the chat history,
+    so a redelivered message is recognized by any worker. A duplicate is
+    acknowledged with the stored reply instead of running the agent again.
+
+    Messages without a SID are keyed by a hash of their payload, and kept
+    for `payload_ttl` only, since a contact may legitimately send the same
+    text twice.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float = 24 * 3600,
+                 payload_ttl: float = 120, sweep_interval: float = 600,
+                 enabled: bool = dedup_enabled):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.payload_ttl = payload_ttl
+        self.sweep_interval = sweep_interval
+        self.recent = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.duplicates = 0
+        self.swept = 0
+        self._last_sweep = time.monotonic()
+        self._lock = threading.Lock()
+
+    def check_table(self):
+        """Turns deduplication off when migration 3 didn't create its table yet."""
+        if not self.enabled:
+            return
+        try:
+            with engine.connect() as connection:
+                exists = inspect(connection).has_table(ProcessedMessage.__tablename__)
+        except Exception as e:
+            logger.error(f"Error looking up the processedmessage table: {e}")
+            return
+        if not exists:
+            logger.warning("Deduplication is off, the processedmessage table doesn't exist. "
+                           "Run the migrations to turn it on.")
+            self.enabled = False
+
+    def find(self, key: str) -> ProcessedMessage | None:
+        processed = self.recent.get(key)
+        if processed is not None and processed.expires_at <= datetime.datetime.now():
+            self.recent.pop(key)
+            return None
+        if processed is None:
+            try:
+                with session_scope() as session:
+                    statement = select(ProcessedMessage)
+                    statement = statement.where(ProcessedMessage.key == key)
+                    statement = statement.where(ProcessedMessage.expires_at > datetime.datetime.now())
+                    processed = session.exec(statement).first()
+            except Exception as e:
+                # Processing the message twice beats not processing it.
+                logger.error(f"Error looking up processed message {key}: {e}")
+                return None
+            if processed is None:
+                return None
+            self.recent.set(key, processed)
+        with self._lock:
+            self.duplicates += 1
+        return processed
+
+    def _processed(self, key: str, has_sid: bool, reply: str | None, is_media: bool,
+                   ai_message_id: str | None) -> ProcessedMessage:
+        now = datetime.datetime.now()
+        ttl = self.ttl if has_sid else self.payload_ttl
+        return ProcessedMessage(
+            key=key,
+            reply=reply,
+            is_media=is_media,
+            ai_message_id=ai_message_id,
+            created_at=now,
+            expires_at=now + datetime.timedelta(seconds=ttl))
+
+    def record(self, key: str, has_sid: bool, reply: str | None, is_media: bool,
+               ai_message_id: str | None, uow: UnitOfWork | None = None) -> ProcessedMessage:
+        processed = self._processed(key, has_sid, reply, is_media, ai_message_id)
+        try:
+            with session_scope(uow, nested=True) as session:
+                session.merge(processed)
+                session.flush()
+        except Exception as e:
+            logger.error(f"Error recording processed message {key}: {e}")
+        after_commit(uow, lambda: self.recent.set(key, processed))
+        return processed
+
+    async def record_async(self, key: str, has_sid: bool, reply: str | None, is_media: bool,
+                           ai_message_id: str | None,
+                           uow: AsyncUnitOfWork | None = None) -> ProcessedMessage:
+        processed = self._processed(key, has_sid, reply, is_media, ai_message_id)
+        try:
+            async with async_session_scope(uow, nested=True) as session:
+                await session.merge(processed)
+                await session.flush()
+        except Exception as e:
+            logger.error(f"Error recording processed message {key}: {e}")
+        after_commit(uow, lambda: self.recent.set(key, processed))
+        return processed
+
+    def mark_delivered(self, key: str):
+        try:
+            with session_scope() as session:
+                processed = session.get(ProcessedMessage, key)
+                if processed is not None:
+                    processed.delivered = True
+        except Exception as e:
+            # At worst a redelivery sends the reply again.
+            logger.error(f"Error marking processed message {key} delivered: {e}")
+        cached = self.recent.get(key)
+        if cached is not None:
+            cached.delivered = True
+
+    def sent_chunks(self, reply_key: str, count: int) -> set[int]:
+        """Indexes of the chunks of an outbound reply recorded by `mark_chunk_sent`."""
+        keys = {f"{reply_key}:{index}": index for index in range(count)}
+        try:
+            with session_scope() as session:
+                statement = select(ProcessedMessage.key)
+                statement = statement.where(ProcessedMessage.key.in_(keys))
+                statement = statement.where(ProcessedMessage.expires_at > datetime.datetime.now())
+                return {keys[key] for key in session.exec(statement)}
+        except Exception as e:
+            # At worst the chunks are sent again.
+            logger.error(f"Error looking up the sent chunks of {reply_key}: {e}")
+            return set()
+
+    def mark_chunk_sent(self, reply_key: str, index: int):
+        """Remembers a chunk was sent, so a redelivered reply skips it."""
+        now = datetime.datetime.now()
+        try:
+            with session_scope() as session:
+                session.merge(ProcessedMessage(
+                    key=f"{reply_key}:{index}",
+                    delivered=True,
+                    created_at=now,
+                    expires_at=now + datetime.timedelta(seconds=self.ttl)))
+        except Exception as e:
+            logger.error(f"Error marking chunk {index} of {reply_key} sent: {e}")
+
+    def sweep(self) -> int:
+        """Deletes expired rows."""
+        with session_scope() as session:
+            result = session.execute(delete(ProcessedMessage).where(
+                ProcessedMessage.expires_at <= datetime.datetime.now()))
+            count = result.rowcount
+        with self._lock:
+            self.swept += count
+        return count
+
+    def sweep_if_due(self):
+        now = time.monotonic()
+        if now - self._last_sweep < self.sweep_interval:
+            return
+        self._last_sweep = now
+        try:
+            count = self.sweep()
+            if count:
+                logger.info(f"Swept {count} expired processed messages")
+        except Exception as e:
+            logger.error(f"Error sweeping processed messages: {e}")
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {**self.recent.stats(), 'duplicates': self.duplicates, 'swept': self.swept}
+
+dedup_store = DedupStore(
+    maxsize=int(os.getenv('DEDUP_CACHE_SIZE') or 10000),
+    ttl=float(os.getenv('DEDUP_TTL') or 24 * 3600),
+    payload_ttl=float(os.getenv('DEDUP_PAYLOAD_TTL') or 120),
+    sweep_interval=float(os.getenv('DEDUP_SWEEP_INTERVAL') or 600))
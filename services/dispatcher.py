@@ -0,0 +1,54 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Hashable
+
+logger = logging.getLogger('health_up:dispatcher')
+
+class ConversationDispatcher:
+    """Runs coroutines concurrently while keeping the ones sharing a key in order.
+
+    `concurrency` caps how many coroutines run at once and `max_pending` caps
+    how many can be queued (running or waiting) before `submit` blocks the caller.
+    A task fails with the exception of its coroutine, the next one of the same
+    key still runs.
+    """
+
+    def __init__(self, concurrency: int, max_pending: int | None = None):
+        self._running = asyncio.Semaphore(concurrency)
+        self._pending = asyncio.Semaphore(max_pending or concurrency * 4)
+        self._tails: dict[Hashable, asyncio.Task] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, key: Hashable,
+                     factory: Callable[[], Awaitable[Any]]) -> asyncio.Task:
+        await self._pending.acquire()
+        previous = self._tails.get(key)
+        task = asyncio.create_task(self._run(key, previous, factory))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _run(self, key: Hashable, previous: asyncio.Task | None,
+                   factory: Callable[[], Awaitable[Any]]):
+        if previous is not None:
+            # Only wait for the previous message of the conversation to finish,
+            # its failure must not prevent the next one from being handled.
+            await asyncio.wait([previous])
+        async with self._running:
+            try:
+                return await factory()
+            except Exception:
+                # Raised again so whoever tracks the task knows it didn't succeed.
+                logger.exception(f"Error handling message for {key}")
+                raise
+
+    def _done(self, key: Hashable, task: asyncio.Task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+        self._pending.release()
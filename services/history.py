@@ -0,0 +1,196 @@
+import os
+import asyncio
+import logging
+import datetime
+from dataclasses import dataclass, field
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    UserPromptPart,
+)
+from pydantic_ai import Agent
+from agents.summary_agent import summary_agent
+from services.chat import (
+    ConversationSummary,
+    find_conversation_summary,
+    save_conversation_summary,
+)
+from services.usage import usage_tracker
+
+logger = logging.getLogger('health_up:history')
+
+# A summary that takes longer is skipped, the turns are summarized on the next message.
+summary_timeout = float(os.getenv('SUMMARY_TIMEOUT') or 20)
+
+def estimate_tokens(messages: list[ModelMessage]) -> int:
+    # Roughly four bytes of serialized JSON per token, good enough for budgeting.
+    if not messages:
+        return 0
+    return len(ModelMessagesTypeAdapter.dump_json(messages)) // 4
+
+@dataclass
+class Turn:
+    """A user prompt and every request/response that followed it."""
+    messages: list[ModelMessage]
+    tokens: int = 0
+
+    @property
+    def timestamp(self) -> datetime.datetime | None:
+        for message in self.messages:
+            if isinstance(message, ModelResponse):
+                return message.timestamp
+            for part in message.parts:
+                if isinstance(part, UserPromptPart):
+                    return part.timestamp
+        return None
+
+def system_prompt_parts(agent: Agent) -> list[SystemPromptPart]:
+    """The agent's static system prompt, as it starts a new conversation."""
+    return [SystemPromptPart(content=prompt) for prompt in agent._system_prompts]
+
+def split_turns(messages: list[ModelMessage]) -> tuple[list[SystemPromptPart], list[Turn]]:
+    system: list[SystemPromptPart] = []
+    turns: list[Turn] = []
+    for index, message in enumerate(messages):
+        if index == 0 and isinstance(message, ModelRequest):
+            system = [p for p in message.parts if isinstance(p, SystemPromptPart)]
+            parts = [p for p in message.parts if not isinstance(p, SystemPromptPart)]
+            if not parts:
+                continue
+            message = ModelRequest(parts=parts)
+        starts_turn = isinstance(message, ModelRequest) and any(
+            isinstance(p, UserPromptPart) for p in message.parts)
+        if starts_turn or not turns:
+            turns.append(Turn(messages=[]))
+        turns[-1].messages.append(message)
+    for turn in turns:
+        turn.tokens = estimate_tokens(turn.messages)
+    return system, turns
+
+@dataclass
+class HistoryWindow:
+    office_id: str
+    phone_number: str
+    system: list[SystemPromptPart]
+    summary: ConversationSummary
+    kept: list[Turn] = field(default_factory=list)
+    to_summarize: list[Turn] = field(default_factory=list)
+
+    def messages(self, system: list[SystemPromptPart] | None = None,
+                 context: ModelRequest | None = None) -> list[ModelMessage]:
+        """History to run the agent with, static prompt first and dynamic content last.
+
+        `system` replaces the system prompt stored with the conversation, so
+        every conversation of an agent shares a byte-identical prefix that
+        providers can cache, even after the prompt changed. `context` changes
+        every turn, so it goes last and is never stored.
+        """
+        messages: list[ModelMessage] = []
+        has_history = bool(self.system or self.summary.content or self.kept)
+        # An empty history makes the agent add its system prompt and store it. With a
+        # context the history isn't empty, so new conversations start with `system` here.
+        use_system = system is not None and (has_history or context is not None)
+        parts = list(system if use_system else self.system)
+        if self.summary.content:
+            parts.append(SystemPromptPart(
+                f"Summary of the earlier conversation: {self.summary.content}"))
+        if parts:
+            messages.append(ModelRequest(parts=parts))
+        for turn in self.kept:
+            messages.extend(turn.messages)
+        if context is not None:
+            messages.append(context)
+        return messages
+
+    @property
+    def tokens(self) -> int:
+        return sum(turn.tokens for turn in self.kept)
+
+class HistoryManager:
+    """Keeps the message history given to the agents under a token budget.
+
+    Turns that no longer fit are folded into a rolling summary stored with the
+    conversation. Once over budget the history is trimmed down to
+    `keep_ratio` of it, so the summary is only recomputed every few turns.
+    """
+
+    def __init__(self, token_budget: int = 4000, keep_ratio: float = 0.5):
+        self.token_budget = token_budget
+        self.keep_ratio = keep_ratio
+
+    def prepare(self, office_id: str, phone_number: str,
+                messages: list[ModelMessage]) -> HistoryWindow:
+        system, turns = split_turns(messages)
+        summary = find_conversation_summary(office_id, phone_number)
+        if summary.covered_until is not None:
+            turns = [turn for turn in turns
+                     if turn.timestamp is None or turn.timestamp > summary.covered_until]
+
+        window = HistoryWindow(office_id=office_id, phone_number=phone_number,
+                               system=system, summary=summary, kept=turns)
+        if window.tokens <= self.token_budget:
+            return window
+
+        target = self.token_budget * self.keep_ratio
+        kept: list[Turn] = []
+        tokens = 0
+        for turn in reversed(turns):
+            if kept and tokens + turn.tokens > target:
+                break
+            kept.insert(0, turn)
+            tokens += turn.tokens
+        window.kept = kept
+        window.to_summarize = turns[:len(turns) - len(kept)]
+        return window
+
+    def summarize(self, window: HistoryWindow, timeout: float = summary_timeout):
+        try:
+            result = summary_agent.run_sync(self._summary_prompt(window),
+                                            model_settings={'timeout': timeout})
+            usage_tracker.record(summary_agent.name, window.office_id, result.usage())
+            self._store(window, result.data)
+        except Exception as e:
+            logger.error(f"Error summarizing conversation {window.phone_number}: {e}")
+        window.to_summarize = []
+
+    async def summarize_async(self, window: HistoryWindow, timeout: float = summary_timeout):
+        try:
+            result = await summary_agent.run(self._summary_prompt(window),
+                                             model_settings={'timeout': timeout})
+            usage_tracker.record(summary_agent.name, window.office_id, result.usage())
+            await asyncio.to_thread(self._store, window, result.data)
+        except Exception as e:
+            logger.error(f"Error summarizing conversation {window.phone_number}: {e}")
+        window.to_summarize = []
+
+    def _summary_prompt(self, window: HistoryWindow) -> str:
+        lines: list[str] = []
+        for turn in window.to_summarize:
+            for message in turn.messages:
+                for part in message.parts:
+                    if isinstance(part, UserPromptPart) and isinstance(part.content, str):
+                        lines.append(f"contact: {part.content}")
+                    elif isinstance(part, TextPart):
+                        lines.append(f"assistant: {part.content}")
+        previous = window.summary.content or 'None'
+        new_turns = '\n'.join(lines)
+        return f"Previous summary:\n{previous}\n\nNew turns:\n{new_turns}"
+
+    def _store(self, window: HistoryWindow, content: str):
+        covered_until = None
+        for turn in reversed(window.to_summarize):
+            covered_until = turn.timestamp
+            if covered_until is not None:
+                break
+        if covered_until is None:
+            return
+        window.summary = ConversationSummary(content=content, covered_until=covered_until)
+        save_conversation_summary(window.office_id, window.phone_number, window.summary)
+
+history_manager = HistoryManager(
+    token_budget=int(os.getenv('HISTORY_TOKEN_BUDGET') or 4000),
+    keep_ratio=float(os.getenv('HISTORY_KEEP_RATIO') or 0.5))
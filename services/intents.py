@@ -0,0 +1,151 @@
+import re
+import logging
+import threading
+import unicodedata
+from dataclasses import dataclass
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    UserPromptPart,
+)
+from database import UnitOfWork
+from utils import actual_date_time, env_flag
+from services.appointment import find_appointment
+from services.routing import Route
+
+logger = logging.getLogger('health_up:intents')
+
+intent_router_enabled = env_flag('INTENT_ROUTER', True)
+
+MENU = 'menu'
+BUSINESS_HOURS = 'business_hours'
+OFFICE_LOCATION = 'office_location'
+
+# Whole messages, after normalization, that can only mean one thing.
+PHRASES = {
+    MENU: {'menu', 'menu please', 'show menu', 'show the menu', 'cardapio', 'opcoes'},
+    BUSINESS_HOURS: {'business hours', 'opening hours', 'hours', 'office hours',
+                     'horario', 'horarios', 'horario de funcionamento'},
+    OFFICE_LOCATION: {'office location', 'location', 'address', 'where are you',
+                      'localizacao', 'endereco', 'onde fica'},
+}
+
+# Menus from the agents' system prompts, kept in sync by hand.
+PATIENT_MENU = ['Make appointment', 'Business hours', 'Office location', 'Specialties']
+PATIENT_APPOINTMENT_MENU = ['Cancel appointment', 'Reschedule appointment']
+MENUS = {
+    'doctor': ['List appointments'],
+    'manager': ['List inventory'],
+    'owner': ['Show revenue', 'List most popular services'],
+}
+# Patient menu options answered without the agent, by their number.
+PATIENT_MENU_INTENTS = {'2': BUSINESS_HOURS, '3': OFFICE_LOCATION}
+
+def normalize(text: str) -> str:
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text).split())
+
+def numbered(options: list[str]) -> str:
+    return '\n'.join(f"{number}. {option}" for number, option in enumerate(options, 1))
+
+def last_reply(messages: list[ModelMessage]) -> str | None:
+    for message in reversed(messages):
+        if isinstance(message, ModelResponse):
+            texts = [part.content for part in message.parts if isinstance(part, TextPart)]
+            if texts:
+                return '\n'.join(texts)
+    return None
+
+def shows_patient_menu(text: str | None) -> bool:
+    if text is None:
+        return False
+    return all(re.search(rf'^\W*{number}\W+{re.escape(PATIENT_MENU[int(number) - 1])}',
+                         text, re.IGNORECASE | re.MULTILINE)
+               for number in PATIENT_MENU_INTENTS)
+
+@dataclass
+class IntentReply:
+    intent: str
+    text: str
+    messages: list[ModelMessage]
+
+    def messages_json(self) -> bytes:
+        return ModelMessagesTypeAdapter.dump_json(self.messages)
+
+class IntentRouter:
+    """Answers unambiguous requests without calling the agents.
+
+    Only whole messages are matched: 'menu', a few phrasings of business
+    hours and office location, and the number of those options right after
+    the patient menu was shown. Anything else returns None and goes to the
+    agent. New conversations always go to the agent too, so the contact
+    is greeted first.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.messages = 0
+        self.handled: dict[str, int] = {}
+
+    def match(self, route: Route, content: str, messages: list[ModelMessage]) -> str | None:
+        if not messages:
+            return None
+        text = normalize(content)
+        patient = route.contact_kind is None or route.contact_kind == 'patient'
+        if patient and text in PATIENT_MENU_INTENTS and shows_patient_menu(last_reply(messages)):
+            return PATIENT_MENU_INTENTS[text]
+        for intent, phrases in PHRASES.items():
+            if text in phrases and (patient or intent == MENU):
+                return intent
+        return None
+
+    def answer(self, intent: str, route: Route, uow: UnitOfWork | None = None) -> str:
+        office = route.office
+        if intent == BUSINESS_HOURS:
+            return f"{office.name} business hours:\n{office.opening_hours}"
+        if intent == OFFICE_LOCATION:
+            return f"{office.name} is at {office.address}\n{office.maps_link}"
+        return self.menu(route, uow)
+
+    def menu(self, route: Route, uow: UnitOfWork | None = None) -> str:
+        if route.contact_kind in MENUS:
+            return f"How can I help you?\n{numbered(MENUS[route.contact_kind])}"
+        if route.contact_id is not None:
+            now = actual_date_time('America/Sao_Paulo')
+            if find_appointment(route.office.id, route.contact_id, now.date_time, uow=uow):
+                return ("You have an scheduled existing appointment. What do you want?\n"
+                        f"{numbered(PATIENT_APPOINTMENT_MENU)}")
+        return f"How may I help you today?\n{numbered(PATIENT_MENU)}"
+
+    def route(self, route: Route, content: str, messages: list[ModelMessage],
+              uow: UnitOfWork | None = None) -> IntentReply | None:
+        intent = self.match(route, content, messages) if intent_router_enabled else None
+        with self._lock:
+            self.messages += 1
+            if intent is not None:
+                self.handled[intent] = self.handled.get(intent, 0) + 1
+        if intent is None:
+            return None
+
+        text = self.answer(intent, route, uow)
+        logger.info(f"Answered {intent} for office {route.office.id} without the agent")
+        return IntentReply(intent=intent, text=text, messages=[
+            ModelRequest(parts=[UserPromptPart(content=content)]),
+            ModelResponse(parts=[TextPart(content=text)]),
+        ])
+
+    def stats(self) -> dict:
+        with self._lock:
+            handled = sum(self.handled.values())
+            return {
+                'messages': self.messages,
+                'handled': handled,
+                'share': round(handled / self.messages, 3) if self.messages else 0.0,
+                'intents': dict(self.handled),
+            }
+
+intent_router = IntentRouter()
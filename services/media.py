@@ -1,31 +1,175 @@
-import openai
+import io
 import os
+import hashlib
+import logging
 import mimetypes
+import openai
 import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from twilio.rest import Client
 from urllib.parse import urlparse
+from utils import env_flag
+from services.audio import (
+  AudioTooLong,
+  preprocess_audio,
+  preprocess_available,
+)
+from services.deadline import Deadline
+from services.transcripts import content_key, sid_key, transcript_cache
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:media')
+
+chunk_size = int(os.getenv('MEDIA_CHUNK_SIZE') or 64 * 1024)
+# Whisper rejects uploads over 25 MB.
+max_media_bytes = int(os.getenv('MEDIA_MAX_BYTES') or 25 * 1024 * 1024)
+download_timeout = (float(os.getenv('MEDIA_CONNECT_TIMEOUT') or 5),
+                    float(os.getenv('MEDIA_READ_TIMEOUT') or 30))
+transcription_timeout = float(os.getenv('TRANSCRIPTION_TIMEOUT') or 60)
+# Voice notes up to this size are buffered to look up a forwarded copy's transcript.
+hash_lookup_max_bytes = int(os.getenv('TRANSCRIPT_HASH_MAX_BYTES') or 2 * 1024 * 1024)
+retain_media = env_flag('MEDIA_RETAIN')
+
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(
+    pool_connections=int(os.getenv('MEDIA_POOL_CONNECTIONS') or 4),
+    pool_maxsize=int(os.getenv('MEDIA_POOL_MAXSIZE') or 16)))
+
+class MediaTooLarge(Exception):
+    pass
+
+class MediaStream(io.RawIOBase):
+    """Read-only file over a streamed HTTP download.
+
+    At most one chunk of the body is held in memory; when `retain_to` is
+    given every chunk is also written to that file. `sha256` hashes what was
+    read so far.
+    """
+
+    def __init__(self, response: requests.Response, max_bytes: int = max_media_bytes,
+                 retain_to: io.BufferedWriter | None = None, deadline: Deadline | None = None):
+        self._chunks = response.iter_content(chunk_size=chunk_size)
+        self._buffer = b''
+        self._max_bytes = max_bytes
+        self._retain_to = retain_to
+        self._deadline = deadline
+        self.size = 0
+        self.sha256 = hashlib.sha256()
 
-def transcribe_media(media_url, media_path, mime_type, 
-                     twilio_client: Client, openai_client: openai.OpenAI):
-  file_extension = mimetypes.guess_extension(mime_type)
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if not self._buffer:
+            if self._deadline is not None:
+                self._deadline.check('download')
+            self._buffer = next(self._chunks, b'')
+            self.size += len(self._buffer)
+            if self.size > self._max_bytes:
+                raise MediaTooLarge(f"Media is larger than {self._max_bytes} bytes")
+            self.sha256.update(self._buffer)
+            if self._retain_to is not None and self._buffer:
+                self._retain_to.write(self._buffer)
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+def _transcribe(openai_client: openai.OpenAI, filename, file, mime_type,
+                deadline: Deadline | None = None, **options):
+  timeout = transcription_timeout
+  if deadline is not None:
+    timeout = deadline.timeout('transcription', transcription_timeout)
+  return openai_client.with_options(
+    timeout=timeout, **options
+  ).audio.transcriptions.create(
+    model="whisper-1",
+    file=(filename, file, mime_type),
+    response_format="text"
+  )
+
+def _transcribe_content(openai_client: openai.OpenAI, media_sid, filename,
+                        content: bytes, mime_type, deadline: Deadline | None = None):
+  try:
+    audio = preprocess_audio(content)
+  except AudioTooLong as e:
+    logger.warning(f"Rejected {media_sid}: {e}")
+    raise
+  except Exception as e:
+    logger.error(f"Error preprocessing {media_sid}, uploading it as is: {e}")
+    audio = None
+
+  if audio is None:
+    transcription = _transcribe(openai_client, filename, io.BytesIO(content), mime_type,
+                                deadline)
+    logger.info(f"Transcribed {len(content)} bytes of {media_sid}")
+    return transcription
+
+  if not audio.segments:
+    logger.info(f"{media_sid} only contains silence")
+    return None
+  transcriptions = [
+    _transcribe(openai_client, f"{media_sid}-{index}.ogg", io.BytesIO(segment), 'audio/ogg',
+                deadline)
+    for index, segment in enumerate(audio.segments)
+  ]
+  logger.info(f"Transcribed {audio.processed_bytes} bytes of {media_sid} "
+              f"({audio.original_bytes - audio.processed_bytes} bytes saved)")
+  return ' '.join(t.strip() for t in transcriptions)
+
+def _hash_lookup(response: requests.Response) -> bool:
+  """Whether the audio is small enough to buffer for a lookup by its hash."""
+  length = response.headers.get('Content-Length')
+  return (transcript_cache is not None and length is not None and length.isdigit()
+          and int(length) <= hash_lookup_max_bytes)
+
+def transcribe_media(media_url, media_path, mime_type,
+                     twilio_client: Client, openai_client: openai.OpenAI,
+                     deadline: Deadline | None = None):
+  file_extension = mimetypes.guess_extension(mime_type) or '.oga'
   media_sid = os.path.basename(urlparse(media_url).path)
-  content = requests.get(
-    media_url, 
-    auth=(twilio_client.account_sid, twilio_client.password), 
-    stream=True
-  ).raw.read()
-  filename = '{path}/{sid}{ext}'.format(path=media_path, 
-                                        sid=media_sid, 
-                                        ext=file_extension if file_extension else '.oga')
-  with open(filename, 'wb') as fd:
-    fd.write(content)
-  
-  if os.path.exists(filename):  
-    response = openai_client.audio.transcriptions.create(
-        model="whisper-1",
-        file=open(filename, "rb"),
-        response_format="text"
-    )
-    return response
-
-  return None
\ No newline at end of file
+  filename = f"{media_sid}{file_extension}"
+
+  timeout = download_timeout
+  if deadline is not None:
+    timeout = (download_timeout[0], deadline.timeout('download', download_timeout[1]))
+
+  with http_session.get(
+    media_url,
+    auth=(twilio_client.account_sid, twilio_client.password),
+    stream=True,
+    timeout=timeout,
+  ) as response:
+    response.raise_for_status()
+    # Preprocessing needs the whole audio, and so does looking up a copy by its hash,
+    # otherwise it is streamed.
+    buffered = preprocess_available or _hash_lookup(response)
+    retain_to = open(f"{media_path}/{filename}", 'wb') if retain_media else None
+    try:
+      stream = MediaStream(response, retain_to=retain_to, deadline=deadline)
+      if buffered:
+        # The audio stays bounded by MEDIA_MAX_BYTES.
+        content = stream.readall()
+      else:
+        # The stream can't be rewound, so the upload must not be retried.
+        transcription = _transcribe(openai_client, filename, stream, mime_type,
+                                    deadline, max_retries=0)
+        logger.info(f"Transcribed {stream.size} bytes of {media_sid}")
+    finally:
+      if retain_to is not None:
+        retain_to.close()
+
+  if buffered:
+    cached = transcript_cache.get(content_key(stream.sha256)) if transcript_cache else None
+    if cached is not None:
+      logger.info(f"Reused the transcript of a copy of {media_sid}")
+      transcript_cache.set(sid_key(media_url), cached)
+      return cached
+    transcription = _transcribe_content(openai_client, media_sid, filename, content,
+                                        mime_type, deadline)
+  if transcription is not None and transcript_cache is not None:
+    transcript_cache.set(content_key(stream.sha256), transcription)
+    transcript_cache.set(sid_key(media_url), transcription)
+  return transcription
@@ -1,64 +1,66 @@
 import os
 import openai
 import logging
-from twilio.rest import Client
+from typing import Callable, Collection
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from utils import env_flag
+from services.sender import OutboundSender
+from services.tts import tts_cache
+
+load_dotenv()
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def send_text(from_number, to_number, message, twilio_client: Client):
-  response = twilio_client.messages.create(
-      from_=f"whatsapp:{from_number}",
-      body=message,
-      to=f"whatsapp:{to_number}",
-  )
-  return response
+audio_replies = env_flag('AUDIO_REPLIES')
+tts_executor = ThreadPoolExecutor(max_workers=int(os.getenv('TTS_CONCURRENCY') or 4),
+                                  thread_name_prefix='tts')
+
+def text_message(message) -> dict:
+  return {'body': message}
 
-def send_audio(from_number, to_number, message, ai_response_id, 
-               media_path: str, twilio_client: Client, openai_client: openai.OpenAI):
-  speech_audio_file = f"{ai_response_id}.mp3"
-  speech_file_path = f"{media_path}/{speech_audio_file}"
-  
-  response = openai_client.audio.speech.create(
-    model="tts-1",
-    voice="alloy",
-    input=message
-  )
-  
-  response.write_to_file(speech_file_path)
-  
-  response = twilio_client.messages.create(
-      from_=f"whatsapp:{from_number}",
-      media_url=[f"https://healthup.loclx.io/medias/{speech_audio_file}"],
-      body=message,
-      to=f"whatsapp:{to_number}",
-  )
-  
-  return response
+def audio_message(message, speech_audio_file) -> dict:
+  return {
+      'body': message,
+      'media_url': [tts_cache.url(speech_audio_file)],
+  }
+
+def split_message(body_text, max_length=1600) -> list[str]:
+  return [body_text[i:i + max_length] for i in range(0, len(body_text), max_length)]
 
 def send_reply(from_number, to_number, body_text, is_media, ai_response_id, 
-              media_path: str, twilio_client: Client, openai_client: openai.OpenAI):
-  try:
-      max_length = 1600
-      # Calculate the number of messages
-      num_messages = len(body_text) // max_length + (1 if len(body_text) % max_length > 0 else 0)
-    
-      for i in range(num_messages):
-          # Calculate start and end indices for the substring
-          start_index = i * max_length
-          end_index = start_index + max_length
+              media_path: str, sender: OutboundSender, openai_client: openai.OpenAI,
+              sent_chunks: Collection[int] = (),
+              on_chunk_sent: Callable[[int], None] | None = None) -> bool:
+  """Returns whether every message of the reply was sent, errors are only logged.
 
-          # Get the substring for the current chunk
-          message_chunk = body_text[start_index:end_index]
-          
-          response = send_text(from_number, to_number, message_chunk, twilio_client)
-          # if is_media:
-          #   response = send_audio(from_number, to_number, message_chunk, 
-          #                         ai_response_id, media_path, twilio_client, openai_client)
-          # else:
-          #   response = send_text(from_number, to_number, message_chunk, twilio_client)
+  Chunks in `sent_chunks` went out with an earlier attempt and are skipped,
+  `on_chunk_sent` is called with the index of each chunk once sent.
+  """
+  chunks = split_message(body_text)
+  num_messages = len(chunks)
+  pending = [index for index in range(num_messages) if index not in sent_chunks]
 
-          logger.info(f"Message {i + 1}/{num_messages} sent from {from_number} to {to_number}: {response.sid}")
+  if is_media and audio_replies:
+      # Every chunk is synthesized at once, they are still sent in order.
+      speech_files = [tts_executor.submit(tts_cache.synthesize, chunks[index], openai_client)
+                      for index in pending]
+      messages = (audio_message(chunks[index], speech_file.result())
+                  for index, speech_file in zip(pending, speech_files))
+  else:
+      messages = (text_message(chunks[index]) for index in pending)
+
+  def sent(position, response):
+      index = pending[position]
+      logger.info(f"Message {index + 1}/{num_messages} sent from {from_number} to {to_number}: {response.sid}")
+      if on_chunk_sent is not None:
+          on_chunk_sent(index)
+
+  try:
+      sender.send_all(from_number, to_number, messages, on_sent=sent)
+      return True
 
   except Exception as e:
-      logger.error(f"Error sending message to {to_number}: {e}")
\ No newline at end of file
+      logger.error(f"Error sending message to {to_number}: {e}")
+      return False
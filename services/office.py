@@ -1,21 +1,20 @@
-from database import engine
+from database import UnitOfWork, session_scope
 from sqlmodel import (
     select,
-    Session
 )
 from models import (
     Office, 
 )
 
-def find_office_by_phone_number(phone_number) -> Office: 
-    with Session(engine) as session:
+def find_office_by_phone_number(phone_number, uow: UnitOfWork | None = None) -> Office: 
+    with session_scope(uow) as session:
         statement = select(Office)
         statement = statement.where(Office.phone_number == phone_number)
         results = session.exec(statement)
         return results.first()  
     
-def find_office_by_id(office_id) -> Office: 
-    with Session(engine) as session:
+def find_office_by_id(office_id, uow: UnitOfWork | None = None) -> Office: 
+    with session_scope(uow) as session:
         statement = select(Office)
         statement = statement.where(Office.id == office_id)
         results = session.exec(statement)
@@ -0,0 +1,76 @@
+import logging
+import threading
+from collections import deque
+from kafka import ConsumerRebalanceListener, KafkaConsumer, TopicPartition
+from kafka.structs import OffsetAndMetadata
+
+logger = logging.getLogger('health_up:offsets')
+
+class OffsetTracker:
+    """Tracks in-flight records and tells which offsets are safe to commit.
+
+    A partition can only be committed up to its highest contiguous finished
+    record, so a crash never skips a message that was still being handled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records: dict[TopicPartition, deque[list]] = {}
+        self._index: dict[tuple[TopicPartition, int], list] = {}
+
+    def track(self, partition: TopicPartition, offset: int):
+        with self._lock:
+            entry = [offset, False]
+            self._records.setdefault(partition, deque()).append(entry)
+            self._index[(partition, offset)] = entry
+
+    def done(self, partition: TopicPartition, offset: int):
+        with self._lock:
+            entry = self._index.pop((partition, offset), None)
+            if entry is not None:
+                entry[1] = True
+
+    def committable(self) -> dict[TopicPartition, OffsetAndMetadata]:
+        offsets: dict[TopicPartition, OffsetAndMetadata] = {}
+        with self._lock:
+            for partition, records in self._records.items():
+                last_done = None
+                while records and records[0][1]:
+                    last_done = records.popleft()[0]
+                if last_done is not None:
+                    # Kafka expects the offset of the next record to consume.
+                    offsets[partition] = OffsetAndMetadata(last_done + 1, '')
+        return offsets
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._index)
+
+    def forget(self, partitions):
+        with self._lock:
+            for partition in partitions:
+                for offset, _ in self._records.pop(partition, ()):
+                    self._index.pop((partition, offset), None)
+
+class CommitOnRevoke(ConsumerRebalanceListener):
+    """Commits finished records before partitions move to another consumer.
+
+    Records of revoked partitions still being handled are forgotten, the new
+    owner will receive them again.
+    """
+
+    def __init__(self, consumer: KafkaConsumer, tracker: OffsetTracker):
+        self.consumer = consumer
+        self.tracker = tracker
+
+    def on_partitions_revoked(self, revoked):
+        offsets = self.tracker.committable()
+        if offsets:
+            try:
+                self.consumer.commit(offsets)
+            except Exception as e:
+                logger.error(f"Error committing offsets on revoke: {e}")
+        self.tracker.forget(revoked)
+
+    def on_partitions_assigned(self, assigned):
+        pass
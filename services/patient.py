@@ -1,33 +1,31 @@
-from database import engine
+from database import UnitOfWork, session_scope
 from sqlmodel import (
     select,
-    Session
 )
 from models import (
     Patient,
     PatientHistory
 )
     
-def add_patient(patient) -> Patient: 
-    with Session(engine) as session:
+def add_patient(patient, uow: UnitOfWork | None = None) -> Patient: 
+    with session_scope(uow, nested=True) as session:
         session.add(patient)
-        session.commit()
         session.flush()
         return patient
 
-def find_patient(office_id, phone_number) -> Patient: 
-    with Session(engine) as session:
+def find_patient(office_id, phone_number, uow: UnitOfWork | None = None) -> Patient: 
+    with session_scope(uow) as session:
         statement = select(Patient)
         statement = statement.where(Patient.office_id == office_id)
         statement = statement.where(Patient.phone_number == phone_number)
         results = session.exec(statement)
         return results.first()
 
-def find_patient_history(patient_id) -> Patient: 
-    with Session(engine) as session:
+def find_patient_history(patient_id, uow: UnitOfWork | None = None) -> Patient: 
+    with session_scope(uow) as session:
         statement = select(PatientHistory)
         statement = statement.where(PatientHistory.patient_id == patient_id)
         statement = statement.limit(5)
         statement = statement.order_by(PatientHistory.date_time.desc())
         results = session.exec(statement)
-        return results.first()
\ No newline at end of file
+        return results.first()
@@ -0,0 +1,130 @@
+import os
+import json
+import inspect
+import logging
+import functools
+from dataclasses import dataclass
+from pydantic import BaseModel
+from sqlmodel import select, Session
+from database import engine
+from models import ChatMessage
+from utils import env_flag
+from services.chat_codec import decode_content, encode_content
+
+logger = logging.getLogger('health_up:projection')
+
+projection_enabled = env_flag('TOOL_PROJECTION', True)
+
+# Fields each tool returns to the model, tools not listed return whole rows.
+DEFAULT_TOOL_FIELDS: dict[str, tuple[str, ...]] = {
+    'get_office_info': ('name', 'address', 'phone_number', 'email', 'website',
+                        'opening_hours', 'maps_link'),
+    'get_patient': ('id', 'name', 'phone_number'),
+    'create_patient': ('id', 'name', 'phone_number'),
+    'get_doctor': ('id', 'name', 'phone_number'),
+    'list_doctors': ('id', 'name'),
+    'list_specialities': ('id', 'name', 'description'),
+    'get_appointment': ('id', 'date_time', 'doctor_id', 'patient_id'),
+    'create_appointment': ('id', 'date_time', 'doctor_id', 'patient_id'),
+    'list_appointments': ('id', 'date_time', 'doctor_id', 'patient_id', 'patient_name'),
+    'get_patient_history': ('date_time', 'description', 'doctor_id'),
+    'get_manager': ('id', 'name'),
+    'get_owner': ('id', 'name'),
+}
+
+def _tool_fields() -> dict[str, tuple[str, ...]]:
+    # TOOL_FIELDS='{"get_patient": ["id", "name", "email"]}' overrides single tools.
+    fields = dict(DEFAULT_TOOL_FIELDS)
+    overrides = os.getenv('TOOL_FIELDS')
+    if overrides:
+        try:
+            fields.update({tool: tuple(names) for tool, names in json.loads(overrides).items()})
+        except (ValueError, AttributeError, TypeError) as e:
+            logger.error(f"Ignoring invalid TOOL_FIELDS: {e}")
+    return fields
+
+tool_fields = _tool_fields()
+
+def _select(value, fields: tuple[str, ...]):
+    if isinstance(value, (list, tuple)):
+        return [_select(item, fields) for item in value]
+    if isinstance(value, BaseModel):
+        value = value.model_dump(mode='json', include=set(fields))
+    if isinstance(value, dict):
+        # In field set order, so the same row always serializes the same.
+        return {name: value[name] for name in fields if value.get(name) is not None}
+    return value
+
+def project(tool_name: str, value):
+    """Only the fields of `value` the tool's field set has, without empty ones."""
+    fields = tool_fields.get(tool_name)
+    if not projection_enabled or fields is None:
+        return value
+    return _select(value, fields)
+
+def projected(function):
+    """Projects what a tool returns with the field set named after it."""
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            return project(function.__name__, await function(*args, **kwargs))
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return project(function.__name__, function(*args, **kwargs))
+    return wrapper
+
+@dataclass
+class ProjectionSavings:
+    rows: int = 0
+    tool_returns: int = 0
+    tokens_before: int = 0
+    tokens_after: int = 0
+    stored_before: int = 0
+    stored_after: int = 0
+
+def _compact_json(value) -> bytes:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+def measure_stored_projections(batch_size: int = 500, limit: int | None = None) -> ProjectionSavings:
+    """Compares stored chat messages with what they would be with the current field sets.
+
+    Tokens are estimated from the JSON the tool returns are sent as, stored
+    bytes are the encoded rows.
+    """
+    savings = ProjectionSavings()
+    last_id = ''
+    while limit is None or savings.rows < limit:
+        with Session(engine) as session:
+            statement = select(ChatMessage)
+            statement = statement.where(ChatMessage.id > last_id)
+            statement = statement.order_by(ChatMessage.id.asc())
+            statement = statement.limit(batch_size)
+            messages = session.exec(statement).all()
+        if not messages:
+            break
+        last_id = messages[-1].id
+        for message in messages:
+            if limit is not None and savings.rows >= limit:
+                break
+            try:
+                model_messages = json.loads(decode_content(message.content))
+            except ValueError:
+                continue
+            if not isinstance(model_messages, list):
+                # Summaries are stored as a single object.
+                continue
+            savings.rows += 1
+            savings.stored_before += len(encode_content(_compact_json(model_messages)))
+            for model_message in model_messages:
+                for part in model_message.get('parts', []):
+                    if part.get('part_kind') != 'tool-return' or 'content' not in part:
+                        continue
+                    savings.tool_returns += 1
+                    content = part['content']
+                    savings.tokens_before += len(_compact_json(content)) // 4
+                    part['content'] = project(part.get('tool_name'), content)
+                    savings.tokens_after += len(_compact_json(part['content'])) // 4
+            savings.stored_after += len(encode_content(_compact_json(model_messages)))
+    return savings
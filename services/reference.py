@@ -0,0 +1,173 @@
+import os
+import time
+import logging
+import datetime
+import threading
+from dataclasses import dataclass, field
+from database import engine
+from sqlalchemy import delete, inspect
+from sqlmodel import (
+    select,
+    Session
+)
+from models import (
+    Doctor,
+    Office,
+    OfficeChange,
+    Speciality,
+)
+from cache import TTLCache
+
+logger = logging.getLogger('health_up:reference')
+
+class OfficeNotFound(LookupError):
+    def __init__(self, office_id: str):
+        super().__init__(f"Office {office_id} not found")
+
+@dataclass
+class OfficeReference:
+    office: Office
+    doctors: list[Doctor] = field(default_factory=list)
+    specialities: list[Speciality] = field(default_factory=list)
+
+    def doctor(self, doctor_id: str) -> Doctor | None:
+        return next((d for d in self.doctors if d.id == doctor_id), None)
+
+    def doctor_by_name(self, doctor_name: str) -> Doctor | None:
+        return next((d for d in self.doctors if d.name == doctor_name), None)
+
+class OfficeReferenceCache:
+    """Office, doctors and specialities of each office, which barely ever change.
+
+    An office is loaded with a single query the first time one of its
+    agents needs it and then served from memory until it expires or is
+    invalidated. Offices are edited outside the worker, which records them
+    with `notify_office_change`; every `poll_interval` seconds the worker
+    invalidates the offices changed since. Entries are shared between
+    threads and must not be modified.
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float | None = 600,
+                 poll_interval: float = 30):
+        self.references = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.poll_interval = poll_interval
+        self.polling = True
+        self.invalidations = 0
+        # Last change seen, None until the first poll.
+        self._last_change: int | None = None
+        self._last_poll = time.monotonic()
+        self._lock = threading.Lock()
+
+    def load(self, office_id: str) -> OfficeReference | None:
+        statement = (
+            select(Office, Doctor, Speciality)
+            .outerjoin(Doctor, Doctor.office_id == Office.id)
+            .outerjoin(Speciality, Speciality.office_id == Office.id)
+            .where(Office.id == office_id))
+        with Session(engine) as session:
+            rows = session.exec(statement).all()
+        if not rows:
+            return None
+
+        # Every doctor is repeated once per speciality and the other way around.
+        doctors: dict[str, Doctor] = {}
+        specialities: dict[str, Speciality] = {}
+        for _, doctor, speciality in rows:
+            if doctor is not None:
+                doctors.setdefault(doctor.id, doctor)
+            if speciality is not None:
+                specialities.setdefault(speciality.id, speciality)
+        return OfficeReference(office=rows[0][0],
+                               doctors=list(doctors.values()),
+                               specialities=list(specialities.values()))
+
+    def get(self, office_id: str) -> OfficeReference | None:
+        reference = self.references.get(office_id)
+        if reference is None:
+            reference = self.load(office_id)
+            if reference is not None:
+                self.references.set(office_id, reference)
+        return reference
+
+    def invalidate(self, office_id: str | None = None):
+        """Drops an office, or every office, so it is loaded again on next use."""
+        if office_id is None:
+            self.references.clear()
+        else:
+            self.references.pop(office_id)
+        with self._lock:
+            self.invalidations += 1
+
+    def check_table(self):
+        """Stops polling for changes when migration 5 didn't create its table yet."""
+        try:
+            with engine.connect() as connection:
+                exists = inspect(connection).has_table(OfficeChange.__tablename__)
+        except Exception as e:
+            logger.error(f"Error looking up the officechange table: {e}")
+            return
+        if not exists:
+            logger.warning("Office changes are only seen after OFFICE_CACHE_TTL, the officechange "
+                           "table doesn't exist. Run the migrations to create it.")
+            self.polling = False
+
+    def poll_changes(self) -> int:
+        """Invalidates the offices changed since the last poll, returns how many changes."""
+        with Session(engine) as session:
+            statement = select(OfficeChange)
+            statement = statement.where(OfficeChange.id > (self._last_change or 0))
+            statement = statement.order_by(OfficeChange.id.asc())
+            changes = session.exec(statement).all()
+        if self._last_change is None:
+            # Anything cached before the first poll may predate a change.
+            self._last_change = changes[-1].id if changes else 0
+            self.invalidate()
+            return 0
+        for change in changes:
+            self.invalidate(change.office_id)
+            self._last_change = change.id
+        return len(changes)
+
+    def poll_changes_if_due(self):
+        now = time.monotonic()
+        if not self.polling or now - self._last_poll < self.poll_interval:
+            return
+        self._last_poll = now
+        try:
+            count = self.poll_changes()
+            if count:
+                logger.info(f"Reloading offices after {count} changes")
+        except Exception as e:
+            logger.error(f"Error polling office changes: {e}")
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {**self.references.stats(), 'invalidations': self.invalidations}
+
+office_reference_cache = OfficeReferenceCache(
+    maxsize=int(os.getenv('OFFICE_CACHE_SIZE') or 1000),
+    ttl=float(os.getenv('OFFICE_CACHE_TTL') or 600),
+    poll_interval=float(os.getenv('OFFICE_CHANGES_INTERVAL') or 30))
+
+# Change rows only need to outlive the poll interval of every worker.
+office_change_retention = datetime.timedelta(days=1)
+
+def notify_office_change(office_id: str | None = None):
+    """Makes every worker reload an office, or every office, within `OFFICE_CHANGES_INTERVAL`.
+
+    Call it after editing an office, its doctors or its specialities.
+    """
+    now = datetime.datetime.now()
+    with Session(engine) as session:
+        session.add(OfficeChange(office_id=office_id, created_at=now))
+        session.execute(delete(OfficeChange).where(
+            OfficeChange.created_at < now - office_change_retention))
+        session.commit()
+    office_reference_cache.invalidate(office_id)
+
+def find_office_reference(office_id: str) -> OfficeReference:
+    """Raises `OfficeNotFound` if the office was deleted, its agents can't answer without it."""
+    reference = office_reference_cache.get(office_id)
+    if reference is None:
+        raise OfficeNotFound(office_id)
+    return reference
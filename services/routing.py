@@ -0,0 +1,123 @@
+import os
+import time
+import logging
+from dataclasses import dataclass
+from database import engine
+from sqlmodel import (
+    select,
+    Session
+)
+from models import (
+    Contact,
+    Office,
+)
+from cache import TTLCache
+from services.office import find_office_by_phone_number
+from services.contact import find_contact_by_phone_number
+
+logger = logging.getLogger('health_up:routing')
+
+@dataclass
+class Route:
+    office: Office
+    contact_kind: str | None = None
+    contact_id: str | None = None
+
+class RoutingResolver:
+    """Resolves (office number, contact number) to the office and contact kind.
+
+    Routes are kept in a TTL/LRU cache so most messages never touch the
+    database to find out which agent should answer them. Every office and
+    contact is loaded at startup and again every `refresh_interval`, before
+    the loaded routes expire, so only new contacts fall back to lookups.
+    """
+
+    def __init__(self, maxsize: int = 10000, ttl: float | None = 300,
+                 refresh_interval: float | None = 240):
+        self.routes = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.offices = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.refresh_interval = refresh_interval
+        self.refreshes = 0
+        self._last_load: float | None = None
+
+    def load(self):
+        """Loads every office and contact with two queries."""
+        with Session(engine) as session:
+            offices = session.exec(select(Office)).all()
+            contacts = session.exec(select(Contact)).all()
+
+        offices_by_id: dict[str, Office] = {}
+        for office in offices:
+            offices_by_id[office.id] = office
+            self.offices.set(office.phone_number, office)
+        for contact in contacts:
+            office = offices_by_id.get(contact.office_id)
+            if office is None:
+                continue
+            self.routes.set(
+                (office.phone_number, contact.phone_number),
+                Route(office=office, contact_kind=contact.kind, contact_id=contact.id))
+        self._last_load = time.monotonic()
+        logger.info(f"Loaded {len(offices)} offices and {len(contacts)} contacts")
+
+    def refresh_if_due(self):
+        """Loads every route again once `refresh_interval` passed since the last load."""
+        if not self.refresh_interval:
+            return
+        now = time.monotonic()
+        if self._last_load is not None and now - self._last_load < self.refresh_interval:
+            return
+        # Not retried right away when it fails.
+        self._last_load = now
+        try:
+            self.load()
+            self.refreshes += 1
+        except Exception as e:
+            logger.error(f"Error refreshing routing cache: {e}")
+
+    def resolve(self, office_phone_number: str, contact_phone_number: str) -> Route | None:
+        key = (office_phone_number, contact_phone_number)
+        route = self.routes.get(key)
+        if route is not None:
+            return route
+
+        office = self.offices.get(office_phone_number)
+        if office is None:
+            office = find_office_by_phone_number(office_phone_number)
+            if office is None:
+                return None
+            self.offices.set(office_phone_number, office)
+
+        contact = find_contact_by_phone_number(office.id, contact_phone_number)
+        route = Route(office=office)
+        if contact is not None:
+            route.contact_kind = contact.kind
+            route.contact_id = contact.id
+        self.routes.set(key, route)
+        return route
+
+    def invalidate(self, office_id: str | None = None, contact_phone_number: str | None = None) -> int:
+        """Drops cached routes of an office, a contact, or both."""
+        def matches(key, route: Route) -> bool:
+            if office_id is not None and route.office.id != office_id:
+                return False
+            if contact_phone_number is not None and key[1] != contact_phone_number:
+                return False
+            return True
+
+        if office_id is None and contact_phone_number is None:
+            self.offices.clear()
+        elif contact_phone_number is None:
+            self.offices.pop_matching(lambda _, office: office.id == office_id)
+        return self.routes.pop_matching(matches)
+
+    def stats(self) -> dict[str, int]:
+        return {**self.routes.stats(), 'refreshes': self.refreshes}
+
+routing_ttl = float(os.getenv('ROUTING_CACHE_TTL') or 300)
+
+routing_resolver = RoutingResolver(
+    maxsize=int(os.getenv('ROUTING_CACHE_SIZE') or 10000),
+    ttl=routing_ttl,
+    # 0 turns the refresh off, routes are then only looked up once they expire.
+    refresh_interval=float(os.getenv('ROUTING_REFRESH_INTERVAL') or routing_ttl * 0.8))
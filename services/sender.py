@@ -0,0 +1,225 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
+from typing import Callable, Iterable
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from twilio.base.exceptions import TwilioRestException
+from twilio.http import HttpClient
+from twilio.http.http_client import TwilioHttpClient
+from twilio.http.response import Response
+from twilio.rest import Client
+from utils import env_flag
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:sender')
+
+# Too Many Requests and transient server errors, anything else won't succeed on retry.
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+send_rate = float(os.getenv('TWILIO_SEND_RATE') or 20)
+send_burst = int(os.getenv('TWILIO_SEND_BURST') or 20)
+send_max_retries = int(os.getenv('TWILIO_SEND_MAX_RETRIES') or 5)
+backoff_base = float(os.getenv('TWILIO_BACKOFF_BASE') or 0.5)
+backoff_max = float(os.getenv('TWILIO_BACKOFF_MAX') or 30)
+twilio_timeout = float(os.getenv('TWILIO_TIMEOUT') or 15)
+# Total time a message may spend being retried, throttling included.
+send_timeout = float(os.getenv('TWILIO_SEND_TIMEOUT') or 60)
+twilio_pool_size = int(os.getenv('TWILIO_POOL_MAXSIZE') or 16)
+
+class TokenBucket:
+    """Allows `rate` operations per second with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Takes a token and returns how long to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> float:
+        """Blocks until a token is available and returns the time waited."""
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+class FakeTwilioHttpClient(HttpClient):
+    """Twilio transport that records requests instead of sending them.
+
+    Queue status codes in `statuses` to make the next requests fail, for
+    instance `[429, 503]` to be throttled twice before succeeding.
+    """
+
+    def __init__(self, latency: float = 0, statuses: list[int] | None = None):
+        super().__init__(logger, False)
+        self.latency = latency
+        self.statuses = deque(statuses or [])
+        self.requests: list[dict] = []
+        self._lock = threading.Lock()
+
+    def request(self, method, uri, params=None, data=None, headers=None, auth=None,
+                timeout=None, allow_redirects=False) -> Response:
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            status = self.statuses.popleft() if self.statuses else 201
+            self.requests.append({'method': method, 'uri': uri, 'data': data, 'status': status})
+        if status >= 400:
+            return Response(status, json.dumps({'code': status, 'message': 'Fake error', 'status': status}))
+        return Response(status, json.dumps({
+            'sid': f"SM{uuid.uuid4().hex}",
+            'status': 'queued',
+            'from': data.get('From') if data else None,
+            'to': data.get('To') if data else None,
+            'body': data.get('Body') if data else None,
+        }))
+
+    def sent(self) -> list[dict]:
+        with self._lock:
+            return [r['data'] for r in self.requests if r['status'] < 400]
+
+def twilio_http_client() -> HttpClient:
+    """Keep-alive connection pool for the Twilio API, or the fake with `TWILIO_FAKE`."""
+    if env_flag('TWILIO_FAKE'):
+        return FakeTwilioHttpClient(latency=float(os.getenv('TWILIO_FAKE_LATENCY') or 0))
+
+    http_client = TwilioHttpClient(timeout=twilio_timeout)
+    # Retries are handled by the sender, so they are rate limited too.
+    http_client.session.mount('https://', HTTPAdapter(
+        pool_connections=4, pool_maxsize=twilio_pool_size, max_retries=0))
+    return http_client
+
+class OutboundSender:
+    """Sends WhatsApp messages through Twilio at a bounded rate.
+
+    Every sender number gets its own token bucket, throttled and failed
+    requests are retried with exponential backoff and full jitter, and the
+    messages of a reply are sent in order while holding a lock on the
+    recipient, so concurrent replies to the same contact don't interleave.
+    """
+
+    def __init__(self, twilio_client: Client, rate: float = send_rate, burst: int = send_burst,
+                 max_retries: int = send_max_retries, backoff_base: float = backoff_base,
+                 backoff_max: float = backoff_max, send_timeout: float = send_timeout):
+        self.twilio_client = twilio_client
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.send_timeout = send_timeout
+        self._buckets: dict[str, TokenBucket] = {}
+        # Lock and number of senders waiting on it, per recipient with a reply in flight.
+        self._recipient_locks: dict[str, tuple[threading.Lock, int]] = {}
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.retries = 0
+        self.failed = 0
+        self.throttled_seconds = 0.0
+
+    def _bucket(self, from_number: str) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get(from_number)
+            if bucket is None:
+                bucket = self._buckets[from_number] = TokenBucket(self.rate, self.burst)
+            return bucket
+
+    @contextmanager
+    def _recipient(self, to_number: str):
+        """Holds the lock of `to_number`, replies to other recipients never wait on it."""
+        with self._lock:
+            lock, users = self._recipient_locks.get(to_number, (None, 0))
+            if lock is None:
+                lock = threading.Lock()
+            self._recipient_locks[to_number] = (lock, users + 1)
+        try:
+            with lock:
+                yield
+        finally:
+            with self._lock:
+                _, users = self._recipient_locks[to_number]
+                if users == 1:
+                    del self._recipient_locks[to_number]
+                else:
+                    self._recipient_locks[to_number] = (lock, users - 1)
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _count(self, **increments):
+        with self._lock:
+            for name, value in increments.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def send(self, from_number: str, to_number: str, **params):
+        """Creates a single message, retrying throttled and transient failures."""
+        bucket = self._bucket(from_number)
+        started = time.monotonic()
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            if waited:
+                self._count(throttled_seconds=waited)
+            try:
+                response = self.twilio_client.messages.create(
+                    from_=f"whatsapp:{from_number}",
+                    to=f"whatsapp:{to_number}",
+                    **params,
+                )
+            except TwilioRestException as e:
+                delay = self._backoff(attempt)
+                out_of_time = time.monotonic() - started + delay > self.send_timeout
+                if e.status not in RETRYABLE_STATUSES or attempt >= self.max_retries or out_of_time:
+                    self._count(failed=1)
+                    raise
+                attempt += 1
+                self._count(retries=1)
+                logger.warning(f"Twilio returned {e.status} sending to {to_number}, "
+                               f"retry {attempt}/{self.max_retries} in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            self._count(sent=1)
+            return response
+
+    def send_all(self, from_number: str, to_number: str, messages: Iterable[dict],
+                 on_sent: Callable[[int, object], None] | None = None) -> list:
+        """Sends `messages` in order, stopping at the first one that can't be sent.
+
+        `on_sent` is called with the index and response of each message once sent.
+        """
+        responses = []
+        with self._recipient(to_number):
+            for index, params in enumerate(messages):
+                responses.append(self.send(from_number, to_number, **params))
+                if on_sent is not None:
+                    on_sent(index, responses[-1])
+        return responses
+
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            return {
+                'senders': len(self._buckets),
+                'sent': self.sent,
+                'retries': self.retries,
+                'failed': self.failed,
+                'throttled_seconds': round(self.throttled_seconds, 3),
+            }
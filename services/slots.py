@@ -0,0 +1,215 @@
+import os
+import re
+import bisect
+import logging
+import datetime
+import unicodedata
+import pytz
+from sqlalchemy import text
+from database import UnitOfWork, session_scope
+from models import Appointment
+from services.appointment import add_appointment, list_doctor_appointment_times
+
+logger = logging.getLogger('health_up:slots')
+
+office_timezone = os.getenv('OFFICE_TIMEZONE') or 'America/Sao_Paulo'
+slot_duration = datetime.timedelta(minutes=int(os.getenv('APPOINTMENT_DURATION_MINUTES') or 30))
+slot_window = datetime.timedelta(days=int(os.getenv('SLOT_WINDOW_DAYS') or 14))
+# Used when an office's opening hours can't be parsed.
+default_opening_hours = os.getenv('DEFAULT_OPENING_HOURS') or 'Mon-Fri 08:00-18:00'
+
+# Weekday numbers by English and Portuguese names and abbreviations.
+DAYS = {
+    'mon': 0, 'monday': 0, 'seg': 0, 'segunda': 0,
+    'tue': 1, 'tues': 1, 'tuesday': 1, 'ter': 1, 'terca': 1,
+    'wed': 2, 'wednesday': 2, 'qua': 2, 'quarta': 2,
+    'thu': 3, 'thur': 3, 'thurs': 3, 'thursday': 3, 'qui': 3, 'quinta': 3,
+    'fri': 4, 'friday': 4, 'sex': 4, 'sexta': 4,
+    'sat': 5, 'saturday': 5, 'sab': 5, 'sabado': 5,
+    'sun': 6, 'sunday': 6, 'dom': 6, 'domingo': 6,
+}
+EVERY_DAY = {'daily', 'everyday', 'todos'}
+RANGE_WORDS = {'-', 'to', 'through', 'thru', 'a', 'ate', 'as'}
+TOKEN = re.compile(r'\d{1,2}(?:[:h]\d{2})?h?(?:\s*[ap]m)?|[a-z]+|-')
+
+OpeningHours = dict[int, list[tuple[datetime.time, datetime.time]]]
+
+class SlotUnavailable(Exception):
+    def __init__(self, date_time: datetime.datetime, conflict: datetime.datetime | None = None,
+                 reason: str = "is outside business hours"):
+        self.date_time = date_time
+        self.conflict = conflict
+        if conflict is not None:
+            reason = f"conflicts with the appointment at {conflict:%d/%m/%Y %H:%M}"
+        super().__init__(f"{date_time:%d/%m/%Y %H:%M} {reason}")
+
+def _parse_time(token: str) -> datetime.time | None:
+    match = re.fullmatch(r'(\d{1,2})(?:[:h](\d{2}))?h?\s*([ap]m)?', token)
+    if match is None:
+        return None
+    hour, minute, meridiem = int(match[1]), int(match[2] or 0), match[3]
+    if meridiem == 'pm' and hour < 12:
+        hour += 12
+    elif meridiem == 'am' and hour == 12:
+        hour = 0
+    if hour == 24 and minute == 0:
+        return datetime.time.max
+    if hour > 23 or minute > 59:
+        return None
+    return datetime.time(hour, minute)
+
+def parse_opening_hours(opening_hours: str | None) -> OpeningHours:
+    """Parses free text hours like 'Mon-Fri 08:00-18:00; Sat 8h-12h'.
+
+    Days without hours are closed, hours without days apply to weekdays.
+    Returns an empty dict when nothing could be understood.
+    """
+    text = unicodedata.normalize('NFKD', (opening_hours or '').lower().replace('–', '-'))
+    text = ''.join(c for c in text if not unicodedata.combining(c))
+
+    hours: OpeningHours = {}
+    days: list[int] = []
+    last_day: int | None = None
+    in_range = False
+    group_has_hours = False
+    opens: datetime.time | None = None
+
+    for token in TOKEN.findall(text):
+        if token in DAYS or token in EVERY_DAY:
+            if group_has_hours:
+                days, group_has_hours = [], False
+            if token in EVERY_DAY:
+                days.extend(range(7))
+            elif in_range and last_day is not None:
+                day = last_day
+                while day != DAYS[token]:
+                    day = (day + 1) % 7
+                    days.append(day)
+            else:
+                days.append(DAYS[token])
+            last_day = DAYS.get(token)
+            in_range = False
+        elif token in RANGE_WORDS:
+            in_range = True
+        elif (time := _parse_time(token)) is not None:
+            if opens is None:
+                opens = time
+            else:
+                for day in days or range(5):
+                    hours.setdefault(day, []).append((opens, time))
+                opens, group_has_hours = None, True
+            in_range = False
+
+    for intervals in hours.values():
+        intervals.sort()
+    return hours
+
+def office_hours(opening_hours: str | None) -> OpeningHours:
+    return parse_opening_hours(opening_hours) or parse_opening_hours(default_opening_hours)
+
+def local_now() -> datetime.datetime:
+    return datetime.datetime.now(pytz.timezone(office_timezone)).replace(tzinfo=None, microsecond=0)
+
+def to_local(date_time: datetime.datetime | str) -> datetime.datetime:
+    """Appointments are stored as naive office local times."""
+    # Table models aren't validated, so tool arguments may still be strings.
+    if isinstance(date_time, str):
+        date_time = datetime.datetime.fromisoformat(date_time)
+    if date_time.tzinfo is None:
+        return date_time
+    return date_time.astimezone(pytz.timezone(office_timezone)).replace(tzinfo=None)
+
+def _interval(day: datetime.date, opens: datetime.time,
+              closes: datetime.time) -> tuple[datetime.datetime, datetime.datetime]:
+    """Opening and closing datetimes, hours closing at 24:00 end at the next midnight."""
+    start = datetime.datetime.combine(day, opens)
+    if closes == datetime.time.max:
+        return start, datetime.datetime.combine(day + datetime.timedelta(days=1), datetime.time())
+    return start, datetime.datetime.combine(day, closes)
+
+def is_open(hours: OpeningHours, slot: datetime.datetime,
+            duration: datetime.timedelta = slot_duration) -> bool:
+    """Whether the slot starting at `slot` fits in one interval of `hours`."""
+    for opens, closes in hours.get(slot.weekday(), []):
+        opening, closing = _interval(slot.date(), opens, closes)
+        if opening <= slot and slot + duration <= closing:
+            return True
+    return False
+
+def _overlapping(starts: list[datetime.datetime], slot: datetime.datetime,
+                 duration: datetime.timedelta) -> datetime.datetime | None:
+    """Returns the appointment in `starts` overlapping the slot starting at `slot`."""
+    index = bisect.bisect_right(starts, slot - duration)
+    if index < len(starts) and starts[index] < slot + duration:
+        return starts[index]
+    return None
+
+def free_slots(hours: OpeningHours, busy: list[datetime.datetime],
+               start: datetime.datetime, end: datetime.datetime, limit: int,
+               duration: datetime.timedelta = slot_duration) -> list[datetime.datetime]:
+    """Slots of `duration` within opening hours between `start` and `end` not overlapping `busy`.
+
+    `busy` holds appointment start times in order, each lasting `duration`.
+    """
+    slots: list[datetime.datetime] = []
+    day = start.date()
+    while day <= end.date() and len(slots) < limit:
+        for opens, closes in hours.get(day.weekday(), []):
+            slot, closing = _interval(day, opens, closes)
+            while slot + duration <= closing and len(slots) < limit:
+                if slot >= start and slot + duration <= end and _overlapping(busy, slot, duration) is None:
+                    slots.append(slot)
+                slot += duration
+        day += datetime.timedelta(days=1)
+    return slots
+
+def find_available_slots(opening_hours: str | None, doctor_id: str,
+                         start: datetime.datetime | None = None,
+                         end: datetime.datetime | None = None, limit: int = 10,
+                         uow: UnitOfWork | None = None) -> list[datetime.datetime]:
+    """First `limit` free slots of the doctor, from now to `SLOT_WINDOW_DAYS` ahead by default."""
+    start = max(to_local(start), local_now()) if start else local_now()
+    end = to_local(end) if end else start + slot_window
+    busy = list_doctor_appointment_times(doctor_id, start - slot_duration, end, uow=uow)
+    return free_slots(office_hours(opening_hours), busy, start, end, limit)
+
+# Serializes bookings of the same doctor across workers until the transaction ends.
+LOCK_DOCTOR = text('SELECT pg_advisory_xact_lock(hashtext(:key))')
+
+def _lock_doctor(session, doctor_id: str):
+    if session.get_bind().dialect.name == 'postgresql':
+        session.execute(LOCK_DOCTOR, {'key': f'appointment:{doctor_id}'})
+
+def _reserve(appointment: Appointment, uow: UnitOfWork) -> Appointment:
+    slot = appointment.date_time
+    with session_scope(uow) as session:
+        _lock_doctor(session, appointment.doctor_id)
+        busy = list_doctor_appointment_times(appointment.doctor_id, slot - slot_duration,
+                                             slot + slot_duration, uow=uow)
+        conflict = _overlapping(busy, slot, slot_duration)
+        if conflict is not None:
+            raise SlotUnavailable(slot, conflict)
+    return add_appointment(appointment, uow=uow)
+
+def check_bookable(appointment: Appointment, opening_hours: str | None):
+    """Raises `SlotUnavailable` for past slots and slots outside opening hours."""
+    appointment.date_time = to_local(appointment.date_time)
+    slot = appointment.date_time
+    if slot < local_now():
+        raise SlotUnavailable(slot, reason="is in the past")
+    if not is_open(office_hours(opening_hours), slot):
+        raise SlotUnavailable(slot)
+
+def reserve_slot(appointment: Appointment, opening_hours: str | None,
+                 uow: UnitOfWork | None = None) -> Appointment:
+    """Adds the appointment, raising `SlotUnavailable` if the doctor isn't free then.
+
+    The doctor stays locked until the booking commits, so it is committed right
+    away in a transaction of its own. Only when `uow` already wrote something
+    the booking may depend on, like the patient, it goes through `uow`.
+    """
+    check_bookable(appointment, opening_hours)
+    if uow is not None and uow.flushed:
+        return _reserve(appointment, uow)
+    with UnitOfWork() as own:
+        return _reserve(appointment, own)
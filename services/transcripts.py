@@ -0,0 +1,94 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+from urllib.parse import urlparse
+from dotenv import load_dotenv
+from utils import env_flag
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:transcripts')
+
+def sid_key(media_url: str) -> str:
+    return 'sid:' + os.path.basename(urlparse(media_url).path)
+
+def content_key(sha256) -> str:
+    """Key of the audio hashed by `sha256`, shared by forwarded copies of a voice note."""
+    return 'sha256:' + sha256.hexdigest()
+
+class TranscriptCache:
+    """Persistent transcript cache backed by a local SQLite file.
+
+    Transcripts are stored under a hash of the audio, so a forwarded copy
+    with a new media SID is recognized once downloaded, and under the Twilio
+    media SID as an alias, so redelivered messages are free without
+    downloading anything. Entries expire
+    after `ttl` seconds and the least recently used ones are dropped past
+    `max_entries`.
+    """
+
+    def __init__(self, path: str, ttl: float = 30 * 24 * 3600, max_entries: int = 100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS transcript ('
+                'key TEXT PRIMARY KEY, transcript TEXT NOT NULL, '
+                'created_at REAL NOT NULL, accessed_at REAL NOT NULL)')
+            self._connection.execute(
+                'CREATE INDEX IF NOT EXISTS ix_transcript_accessed_at ON transcript (accessed_at)')
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                'SELECT transcript FROM transcript WHERE key = ? AND created_at >= ?',
+                (key, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute(
+                'UPDATE transcript SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return row[0]
+
+    def set(self, key: str, transcript: str):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO transcript (key, transcript, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (key, transcript, now, now))
+            self._evict(now)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            size = self._connection.execute('SELECT COUNT(*) FROM transcript').fetchone()[0]
+        return {'size': size, 'hits': self.hits, 'misses': self.misses}
+
+    def _evict(self, now: float):
+        self._connection.execute(
+            'DELETE FROM transcript WHERE created_at < ?', (now - self.ttl,))
+        self._connection.execute(
+            'DELETE FROM transcript WHERE key IN ('
+            'SELECT key FROM transcript ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,))
+
+transcript_cache: TranscriptCache | None = None
+if env_flag('TRANSCRIPT_CACHE_ENABLED', True):
+    transcript_cache = TranscriptCache(
+        path=os.getenv('TRANSCRIPT_CACHE_PATH') or os.path.join(
+            os.getenv('MEDIAS_PATH') or '.', 'transcripts.db'),
+        ttl=float(os.getenv('TRANSCRIPT_CACHE_TTL') or 30 * 24 * 3600),
+        max_entries=int(os.getenv('TRANSCRIPT_CACHE_MAX_ENTRIES') or 100000))
+
+def find_transcript(media_url: str) -> str | None:
+    if transcript_cache is None:
+        return None
+    return transcript_cache.get(sid_key(media_url))
@@ -0,0 +1,115 @@
+import os
+import glob
+import hashlib
+import logging
+import threading
+from pathlib import PurePath
+import openai
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger('health_up:tts')
+
+tts_model = os.getenv('TTS_MODEL') or 'tts-1'
+tts_voice = os.getenv('TTS_VOICE') or 'alloy'
+tts_timeout = float(os.getenv('TTS_TIMEOUT') or 30)
+medias_path = os.getenv('MEDIAS_PATH') or '.'
+medias_base_url = os.getenv('MEDIAS_BASE_URL') or 'https://healthup.loclx.io/medias'
+
+def served_url(directory: str) -> str:
+    """URL Twilio fetches the files of `directory` from, it must be within `MEDIAS_PATH`."""
+    relative = os.path.relpath(os.path.abspath(directory), os.path.abspath(medias_path))
+    if relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        raise ValueError(f"TTS_CACHE_PATH {directory} is not within MEDIAS_PATH {medias_path}, "
+                         f"it isn't served at MEDIAS_BASE_URL")
+    if relative == os.curdir:
+        return medias_base_url.rstrip('/')
+    return f"{medias_base_url.rstrip('/')}/{PurePath(relative).as_posix()}"
+
+class TTSCache:
+    """On-disk cache of synthesized speech.
+
+    Files are named after a hash of (text, voice, model) so the same reply is
+    only synthesized once. Hits refresh the file modification time and the
+    least recently used files are deleted once the directory goes over
+    `max_bytes`.
+    """
+
+    PREFIX = 'tts-'
+
+    def __init__(self, directory: str, base_url: str, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.base_url = base_url
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def key(self, text: str, voice: str, model: str) -> str:
+        return hashlib.sha256(f"{model}\0{voice}\0{text}".encode()).hexdigest()
+
+    def filename(self, key: str) -> str:
+        return f"{self.PREFIX}{key}.mp3"
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, self.filename(key))
+
+    def url(self, filename: str) -> str:
+        return f"{self.base_url}/{filename}"
+
+    def get(self, key: str) -> str | None:
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return self.filename(key)
+
+    def synthesize(self, text: str, openai_client: openai.OpenAI,
+                   voice: str = tts_voice, model: str = tts_model) -> str:
+        """Returns the file name of the speech for `text`, synthesizing it if needed."""
+        key = self.key(text, voice, model)
+        filename = self.get(key)
+        if filename is not None:
+            return filename
+
+        response = openai_client.with_options(timeout=tts_timeout).audio.speech.create(
+            model=model, voice=voice, input=text)
+        path = self.path(key)
+        temporary_path = f"{path}.{threading.get_ident()}.tmp"
+        response.write_to_file(temporary_path)
+        # Readers never see a partially written file.
+        os.replace(temporary_path, path)
+        self._evict()
+        return self.filename(key)
+
+    def stats(self) -> dict[str, int]:
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def _evict(self):
+        with self._lock:
+            files = []
+            for path in glob.glob(os.path.join(self.directory, f"{self.PREFIX}*.mp3")):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            total = sum(size for _, size, _ in files)
+            for _, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+tts_cache_path = os.getenv('TTS_CACHE_PATH') or medias_path
+tts_cache = TTSCache(
+    directory=tts_cache_path,
+    base_url=served_url(tts_cache_path),
+    max_bytes=int(os.getenv('TTS_CACHE_MAX_BYTES') or 512 * 1024 * 1024))
@@ -0,0 +1,122 @@
+import logging
+import datetime
+import threading
+from dataclasses import dataclass
+from uuid_extensions import uuid7str
+from pydantic_ai.usage import Usage
+from database import UnitOfWork, session_scope
+from services.aio.database import AsyncUnitOfWork, session_scope as async_session_scope
+from models import TurnUsage
+from utils import env_flag
+
+logger = logging.getLogger('health_up:usage')
+
+usage_recording = env_flag('USAGE_RECORDING', True)
+
+# Where providers report prompt tokens served from their prefix cache.
+CACHED_TOKEN_DETAILS = ('cached_tokens', 'cache_read_input_tokens')
+
+def cached_tokens(usage: Usage) -> int:
+    details = usage.details or {}
+    return sum(details.get(name, 0) for name in CACHED_TOKEN_DETAILS)
+
+@dataclass
+class UsageTotals:
+    runs: int = 0
+    requests: int = 0
+    input_tokens: int = 0
+    cached_tokens: int = 0
+    output_tokens: int = 0
+
+    def add(self, usage: Usage):
+        self.runs += 1
+        self.requests += usage.requests
+        self.input_tokens += usage.request_tokens or 0
+        self.cached_tokens += cached_tokens(usage)
+        self.output_tokens += usage.response_tokens or 0
+
+    def as_dict(self) -> dict[str, float]:
+        return {
+            'runs': self.runs,
+            'requests': self.requests,
+            'input_tokens': self.input_tokens,
+            'cached_tokens': self.cached_tokens,
+            'output_tokens': self.output_tokens,
+            'cached_ratio': round(self.cached_tokens / self.input_tokens, 3) if self.input_tokens else 0,
+        }
+
+class UsageTracker:
+    """Token usage of agent runs, per agent and per office.
+
+    Totals are kept in memory for the stats report. Turns recorded with a
+    unit of work are also stored in the `turnusage` table, in the same
+    transaction as the chat message they produced.
+    """
+
+    def __init__(self):
+        self.agents: dict[str, UsageTotals] = {}
+        self.offices: dict[str, UsageTotals] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, agent_name: str, office_id: str | None, usage: Usage,
+               phone_number: str | None, chat_message_id: str | None,
+               uow: UnitOfWork | AsyncUnitOfWork | None) -> TurnUsage | None:
+        """Adds the usage to the totals, returns the row to store if any."""
+        with self._lock:
+            self.agents.setdefault(agent_name, UsageTotals()).add(usage)
+            if office_id is not None:
+                self.offices.setdefault(office_id, UsageTotals()).add(usage)
+        if uow is None or not usage_recording:
+            return None
+
+        return TurnUsage(
+            id=uuid7str(),
+            office_id=office_id,
+            phone_number=phone_number,
+            agent=agent_name,
+            chat_message_id=chat_message_id,
+            requests=usage.requests,
+            input_tokens=usage.request_tokens or 0,
+            cached_tokens=cached_tokens(usage),
+            output_tokens=usage.response_tokens or 0,
+            created_at=datetime.datetime.now())
+
+    def record(self, agent_name: str, office_id: str | None, usage: Usage,
+               phone_number: str | None = None, chat_message_id: str | None = None,
+               uow: UnitOfWork | None = None) -> TurnUsage | None:
+        turn = self._count(agent_name, office_id, usage, phone_number, chat_message_id, uow)
+        if turn is None:
+            return None
+        try:
+            with session_scope(uow, nested=True) as session:
+                session.add(turn)
+                session.flush()
+        except Exception as e:
+            # Losing a usage row is better than losing the reply.
+            logger.error(f"Error recording usage of {agent_name}: {e}")
+            return None
+        return turn
+
+    async def record_async(self, agent_name: str, office_id: str | None, usage: Usage,
+                           phone_number: str | None = None, chat_message_id: str | None = None,
+                           uow: AsyncUnitOfWork | None = None) -> TurnUsage | None:
+        turn = self._count(agent_name, office_id, usage, phone_number, chat_message_id, uow)
+        if turn is None:
+            return None
+        try:
+            async with async_session_scope(uow, nested=True) as session:
+                session.add(turn)
+                await session.flush()
+        except Exception as e:
+            logger.error(f"Error recording usage of {agent_name}: {e}")
+            return None
+        return turn
+
+    def stats(self) -> dict[str, dict]:
+        with self._lock:
+            return {
+                'agents': {name: totals.as_dict() for name, totals in self.agents.items()},
+                'offices': {office_id: totals.as_dict() for office_id, totals in self.offices.items()},
+            }
+
+usage_tracker = UsageTracker()
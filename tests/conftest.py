@@ -0,0 +1,78 @@
+import os
+import tempfile
+
+# The engines are created on import, so the test database is set up first.
+_directory = tempfile.mkdtemp(prefix='health_up_tests_')
+os.environ['DATABASE_URL'] = f"sqlite:///{_directory}/test.db"
+os.environ['ASYNC_DATABASE_URL'] = f"sqlite+aiosqlite:///{_directory}/test.db"
+os.environ['MEDIAS_PATH'] = _directory
+# Enough for main to import, nothing is sent: Twilio requests go to the fake client.
+os.environ['TWILIO_ACCOUNT_SID'] = 'AC00000000000000000000000000000000'
+os.environ['TWILIO_AUTH_TOKEN'] = 'test'
+os.environ['TWILIO_FAKE'] = 'true'
+os.environ['OPENAI_API_KEY'] = 'test'
+
+import datetime
+import pytest
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlmodel import SQLModel, Session
+from database import engine
+from models import (
+    Appointment,
+    Doctor,
+    Manager,
+    Office,
+    Owner,
+    Patient,
+    PatientHistory,
+    Speciality,
+)
+from services.aio.database import dispose_async_engine
+
+# A Monday, far enough ahead to never be in the past.
+APPOINTMENT_TIME = datetime.datetime(2100, 1, 4, 10, 0)
+
+# The sqlite drivers only begin a transaction before DML, a unit of work starting
+# with a SAVEPOINT would then be committed when it is released.
+@event.listens_for(Engine, 'connect')
+def disable_driver_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+@event.listens_for(Engine, 'begin')
+def begin_transaction(connection):
+    # AUTOCOMMIT connections, like the migrations' one, must not be left in a transaction.
+    if connection.get_execution_options().get('isolation_level') != 'AUTOCOMMIT':
+        connection.exec_driver_sql('BEGIN')
+
+@pytest.fixture(autouse=True)
+async def dispose_engine():
+    yield
+    # Every test runs its own event loop, the pooled async connections belong to it.
+    await dispose_async_engine()
+
+@pytest.fixture
+def database():
+    """Tables without the contact view, with one office and a contact of each kind."""
+    # The metadata level DDL also creates the materialized view, which is Postgres only.
+    tables = [table for table in SQLModel.metadata.sorted_tables if table.name != 'contact']
+    for table in reversed(tables):
+        table.drop(engine, checkfirst=True)
+    for table in tables:
+        table.create(engine)
+    with Session(engine) as session:
+        session.add(Office(id='o1', name='Smile', description='Dental care', address='Rua A, 1',
+                           phone_number='+1', email='smile@example.com', website='example.com',
+                           opening_hours='Mon-Fri 08:00-18:00', maps_link='https://maps/smile',
+                           reviews=''))
+        session.add(Doctor(id='d1', name='Ana', phone_number='+2', office_id='o1'))
+        session.add(Manager(id='m1', name='Bia', phone_number='+3', office_id='o1'))
+        session.add(Owner(id='w1', name='Caio', phone_number='+4', office_id='o1'))
+        session.add(Patient(id='p1', name='Davi', phone_number='+5', office_id='o1'))
+        session.add(Speciality(id='s1', name='Orthodontics', description='Braces', office_id='o1'))
+        session.add(PatientHistory(id='h1', date_time=datetime.datetime(2024, 5, 1, 9, 0),
+                                   description='Cleaning', patient_id='p1', doctor_id='d1'))
+        session.add(Appointment(id='a1', date_time=APPOINTMENT_TIME, office_id='o1',
+                                patient_id='p1', doctor_id='d1'))
+        session.commit()
+    yield engine
@@ -0,0 +1,242 @@
+import datetime
+import pytest
+from pydantic import BaseModel
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    UserPromptPart,
+)
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from sqlmodel import Session, select
+from conftest import APPOINTMENT_TIME
+from database import UnitOfWork
+from models import Appointment, Patient, ProcessedMessage, TurnUsage
+import main
+from agents.appointment_agent import appointment_agent
+from services.routing import Route
+import services.appointment
+import services.chat
+import services.doctor
+import services.manager
+import services.office
+import services.owner
+import services.patient
+import services.slots
+import services.speciality
+import services.aio.appointment
+import services.aio.chat
+import services.aio.database
+import services.aio.doctor
+import services.aio.manager
+import services.aio.office
+import services.aio.owner
+import services.aio.patient
+import services.aio.slots
+import services.aio.speciality
+from services.aio.database import AsyncUnitOfWork, run_read, run_write, to_async_url
+
+PAST = datetime.datetime(2000, 1, 1)
+
+READS = [
+    ('office', 'find_office_by_phone_number', ('+1',)),
+    ('office', 'find_office_by_id', ('o1',)),
+    ('doctor', 'find_doctor_by_id', ('d1',)),
+    ('doctor', 'find_doctor_by_phone_number', ('o1', '+2')),
+    ('doctor', 'find_doctor_by_name', ('o1', 'Ana')),
+    ('doctor', 'find_doctors_by_office_id', ('o1',)),
+    ('manager', 'find_manager_by_id', ('m1',)),
+    ('manager', 'find_manager_by_phone_number', ('o1', '+3')),
+    ('owner', 'find_owner_by_id', ('w1',)),
+    ('owner', 'find_owner_by_phone_number', ('o1', '+4')),
+    ('patient', 'find_patient', ('o1', '+5')),
+    ('patient', 'find_patient_history', ('p1',)),
+    ('speciality', 'find_specilities_by_office_id', ('o1',)),
+    ('appointment', 'list_office_appointments', ('o1', PAST)),
+    ('appointment', 'list_doctor_appointments', ('d1', PAST)),
+    ('appointment', 'find_appointment', ('o1', 'p1', PAST)),
+    ('appointment', 'list_doctor_appointment_times',
+     ('d1', APPOINTMENT_TIME - datetime.timedelta(days=1), APPOINTMENT_TIME + datetime.timedelta(days=1))),
+    ('slots', 'find_available_slots',
+     ('Mon-Fri 08:00-18:00', 'd1', APPOINTMENT_TIME.replace(hour=8), APPOINTMENT_TIME.replace(hour=12))),
+]
+
+def dump(value):
+    if isinstance(value, list):
+        return [dump(item) for item in value]
+    if isinstance(value, BaseModel):
+        return value.model_dump()
+    return value
+
+def mirrored(module: str, name: str):
+    sync_module = getattr(services, module)
+    async_module = getattr(services.aio, module)
+    return getattr(sync_module, name), getattr(async_module, name)
+
+@pytest.mark.parametrize('module, name, args', READS, ids=[f"{m}.{n}" for m, n, _ in READS])
+async def test_reads_match_the_sync_service_layer(database, module, name, args):
+    function, async_function = mirrored(module, name)
+    expected = function(*args)
+    assert expected  # Every read finds something in the test data.
+    assert dump(await async_function(*args)) == dump(expected)
+
+async def test_free_slots_skip_booked_appointments(database):
+    slots = await services.aio.slots.find_available_slots(
+        'Mon-Fri 08:00-18:00', 'd1', APPOINTMENT_TIME.replace(hour=8),
+        APPOINTMENT_TIME.replace(hour=12))
+    assert APPOINTMENT_TIME not in slots
+    assert APPOINTMENT_TIME.replace(hour=8) in slots
+
+async def test_writes_are_committed_with_the_unit_of_work(database):
+    async with AsyncUnitOfWork() as uow:
+        await services.aio.patient.add_patient(
+            Patient(id='p2', name='Eva', phone_number='+6', office_id='o1'), uow)
+        await services.aio.appointment.add_appointment(
+            Appointment(id='a2', date_time=APPOINTMENT_TIME.replace(hour=11), office_id='o1',
+                        patient_id='p2', doctor_id='d1'), uow)
+        assert uow.flushed
+        # Not visible outside the unit of work before the commit.
+        assert services.patient.find_patient('o1', '+6') is None
+
+    assert services.patient.find_patient('o1', '+6').id == 'p2'
+    assert services.appointment.find_appointment('o1', 'p2', PAST).id == 'a2'
+
+    appointment = await services.aio.appointment.find_appointment('o1', 'p2', PAST)
+    assert await services.aio.appointment.delete_appointment(appointment)
+    assert services.appointment.find_appointment('o1', 'p2', PAST) is None
+
+async def test_failed_unit_of_work_is_rolled_back(database):
+    with pytest.raises(RuntimeError):
+        async with AsyncUnitOfWork() as uow:
+            await services.aio.patient.add_patient(
+                Patient(id='p2', name='Eva', phone_number='+6', office_id='o1'), uow)
+            raise RuntimeError('agent failed')
+    assert await services.aio.patient.find_patient('o1', '+6') is None
+
+class Calls:
+    """Records which variant of a read `run_read` picked."""
+
+    def __init__(self):
+        self.calls: list[tuple[str, object]] = []
+
+    def sync(self, office_id, phone_number, uow=None):
+        self.calls.append(('sync', uow))
+        return services.patient.find_patient(office_id, phone_number, uow=uow)
+
+    async def async_(self, office_id, phone_number):
+        self.calls.append(('async', None))
+        return await services.aio.patient.find_patient(office_id, phone_number)
+
+async def test_run_read_awaits_the_async_layer_when_enabled(database, monkeypatch):
+    monkeypatch.setattr(services.aio.database, 'async_db_enabled', True)
+    calls = Calls()
+    with UnitOfWork() as uow:
+        patient = await run_read(calls.sync, calls.async_, 'o1', '+5', uow=uow)
+    assert patient.id == 'p1'
+    assert calls.calls == [('async', None)]
+
+async def test_run_read_falls_back_to_sync_once_the_unit_of_work_flushed(database, monkeypatch):
+    monkeypatch.setattr(services.aio.database, 'async_db_enabled', True)
+    calls = Calls()
+    with UnitOfWork() as uow:
+        services.patient.add_patient(Patient(id='p2', name='Eva', phone_number='+6', office_id='o1'), uow)
+        assert uow.flushed
+        # Only the unit of work sees the patient it created.
+        patient = await run_read(calls.sync, calls.async_, 'o1', '+6', uow=uow)
+    assert patient.id == 'p2'
+    assert calls.calls == [('sync', uow)]
+
+async def test_run_read_uses_threads_when_disabled(database, monkeypatch):
+    monkeypatch.setattr(services.aio.database, 'async_db_enabled', False)
+    calls = Calls()
+    with UnitOfWork() as uow:
+        patient = await run_read(calls.sync, calls.async_, 'o1', '+5', uow=uow)
+    assert patient.id == 'p1'
+    assert calls.calls == [('sync', None)]
+
+@pytest.mark.parametrize('url, expected', [
+    ('sqlite:///health_up.db', 'sqlite+aiosqlite:///health_up.db'),
+    ('postgresql://user:secret@db/health_up', 'postgresql+asyncpg://user:secret@db/health_up'),
+    ('postgresql+psycopg2://user:secret@db/health_up', 'postgresql+asyncpg://user:secret@db/health_up'),
+])
+def test_to_async_url(url, expected):
+    assert to_async_url(url) == expected
+
+async def test_chat_history_round_trips_through_the_async_unit_of_work(database):
+    messages = [ModelRequest(parts=[UserPromptPart('Oi')]), ModelResponse(parts=[TextPart('Olá Davi')])]
+    async with AsyncUnitOfWork() as uow:
+        await services.aio.chat.add_message_to_conversation(
+            'o1', '+5', ModelMessagesTypeAdapter.dump_json(messages), messages, uow)
+        assert uow.flushed
+    loaded = await services.aio.chat.load_conversation('o1', '+5')
+    assert loaded.messages() == services.chat.load_conversation('o1', '+5').messages()
+    assert [part.content for message in loaded.messages() for part in message.parts] == ['Oi', 'Olá Davi']
+
+async def test_async_booking_rejects_taken_slots(database):
+    taken = Appointment(id='a2', date_time=APPOINTMENT_TIME, office_id='o1', patient_id='p1', doctor_id='d1')
+    with pytest.raises(services.slots.SlotUnavailable):
+        await services.aio.slots.reserve_slot(taken, 'Mon-Fri 08:00-18:00')
+    free = Appointment(id='a3', date_time=APPOINTMENT_TIME.replace(hour=11), office_id='o1',
+                       patient_id='p1', doctor_id='d1')
+    async with AsyncUnitOfWork() as uow:
+        await services.aio.slots.reserve_slot(free, 'Mon-Fri 08:00-18:00', uow)
+        # Committed on its own, the unit of work had nothing written yet.
+        assert not uow.flushed
+        assert services.appointment.find_appointment('o1', 'p1', APPOINTMENT_TIME.replace(hour=11))
+
+def greeting_model(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+    return ModelResponse(parts=[TextPart('Olá Davi!')])
+
+async def test_async_handler_writes_through_the_async_unit_of_work(database, monkeypatch):
+    monkeypatch.setattr(services.aio.database, 'async_db_enabled', True)
+    services.chat.conversation_cache.clear()
+    # The contact view is Postgres only.
+    monkeypatch.setattr(main.routing_resolver, 'resolve', lambda office_phone_number, contact_phone_number:
+                        Route(services.office.find_office_by_id('o1'), 'patient', 'p1'))
+    uows = []
+    select_agent = main.select_agent
+    def recording_select_agent(route, contact_phone_number, uow=None, context=None):
+        uows.append(uow)
+        return select_agent(route, contact_phone_number, uow, context)
+    monkeypatch.setattr(main, 'select_agent', recording_select_agent)
+
+    message = {'to_number': 'whatsapp:+1', 'from_number': 'whatsapp:+5', 'body': 'Oi',
+               'num_media': '0', 'message_sid': 'SM-async'}
+    with appointment_agent.override(model=FunctionModel(greeting_model)):
+        await main.handle_message_async(message)
+
+    assert [type(uow) for uow in uows] == [AsyncUnitOfWork]
+    history = services.chat.load_conversation('o1', '+5').messages()
+    assert history[-1].parts[0].content == 'Olá Davi!'
+    assert services.chat.conversation_cache.get(('o1', '+5')).messages() == history
+    with Session(database) as session:
+        assert session.get(ProcessedMessage, 'sid:SM-async').delivered
+        assert session.exec(select(TurnUsage).where(TurnUsage.phone_number == '+5')).one()
+
+class Writes:
+    """Records which variant of a write `run_write` picked."""
+
+    def __init__(self):
+        self.calls: list[str] = []
+
+    def sync(self, patient, uow=None):
+        self.calls.append('sync')
+        return services.patient.add_patient(patient, uow=uow)
+
+    async def async_(self, patient, uow=None):
+        self.calls.append('async')
+        return await services.aio.patient.add_patient(patient, uow)
+
+async def test_run_write_awaits_the_async_layer_with_an_async_unit_of_work(database):
+    writes = Writes()
+    async with AsyncUnitOfWork() as uow:
+        await run_write(writes.sync, writes.async_,
+                        Patient(id='p2', name='Eva', phone_number='+6', office_id='o1'), uow=uow)
+    with UnitOfWork() as uow:
+        await run_write(writes.sync, writes.async_,
+                        Patient(id='p3', name='Gil', phone_number='+7', office_id='o1'), uow=uow)
+    assert writes.calls == ['async', 'sync']
+    assert services.patient.find_patient('o1', '+6').id == 'p2'
+    assert services.patient.find_patient('o1', '+7').id == 'p3'
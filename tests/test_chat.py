@@ -0,0 +1,122 @@
+from types import SimpleNamespace
+import pytest
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    UserPromptPart,
+)
+import cache as cache_module
+from cache import TTLCache
+from database import UnitOfWork
+from services import chat
+from services.chat import (
+    HISTORY_LIMIT,
+    add_message_to_conversation,
+    conversation_cache,
+    get_conversation_messages,
+)
+
+def turn(text: str, reply: str, system: str | None = None) -> list[ModelMessage]:
+    parts = [SystemPromptPart(system)] if system else []
+    return [ModelRequest(parts=[*parts, UserPromptPart(text)]), ModelResponse(parts=[TextPart(reply)])]
+
+def store(messages: list[ModelMessage], uow: UnitOfWork | None = None, phone_number: str = '+5'):
+    return add_message_to_conversation('o1', phone_number, ModelMessagesTypeAdapter.dump_json(messages),
+                                       messages, uow)
+
+def texts(messages: list[ModelMessage]) -> list[str]:
+    return [part.content for message in messages for part in message.parts]
+
+@pytest.fixture
+def loads(database, monkeypatch) -> list[tuple[str, str]]:
+    """Conversations read from the database, starting with an empty cache."""
+    conversation_cache.clear()
+    loaded: list[tuple[str, str]] = []
+    load_conversation = chat.load_conversation
+    def recording_load(office_id, from_number, uow=None):
+        loaded.append((office_id, from_number))
+        return load_conversation(office_id, from_number, uow)
+    monkeypatch.setattr(chat, 'load_conversation', recording_load)
+    return loaded
+
+def test_conversations_are_read_once_then_served_from_the_cache(loads):
+    store(turn('Oi', 'Olá', system='You are a secretary.'))
+    hits = conversation_cache.stats()['hits']
+    assert texts(get_conversation_messages('o1', '+5')) == ['You are a secretary.', 'Oi', 'Olá']
+    assert texts(get_conversation_messages('o1', '+5')) == ['You are a secretary.', 'Oi', 'Olá']
+    assert loads == [('o1', '+5')]
+    assert conversation_cache.stats()['hits'] == hits + 1
+
+def test_stored_replies_are_appended_to_the_cached_conversation(loads):
+    store(turn('Oi', 'Olá'))
+    get_conversation_messages('o1', '+5')
+    with UnitOfWork() as uow:
+        store(turn('menu', '1. Make appointment'), uow)
+        # Only once it is committed.
+        assert texts(get_conversation_messages('o1', '+5')) == ['Oi', 'Olá']
+    assert texts(get_conversation_messages('o1', '+5')) == ['Oi', 'Olá', 'menu', '1. Make appointment']
+    assert loads == [('o1', '+5')]
+
+def test_rolled_back_replies_are_not_cached(loads):
+    get_conversation_messages('o1', '+5')
+    with pytest.raises(RuntimeError):
+        with UnitOfWork() as uow:
+            store(turn('Oi', 'Olá'), uow)
+            raise RuntimeError('agent failed')
+    assert get_conversation_messages('o1', '+5') == []
+    conversation_cache.clear()
+    assert get_conversation_messages('o1', '+5') == []
+
+def test_cached_conversations_keep_the_first_row_and_the_latest_ones(loads):
+    store(turn('first', 'reply 0', system='You are a secretary.'))
+    for number in range(1, HISTORY_LIMIT + 3):
+        store(turn(f"message {number}", f"reply {number}"))
+    cached = texts(get_conversation_messages('o1', '+5'))
+    conversation_cache.clear()
+    loaded = texts(get_conversation_messages('o1', '+5'))
+    assert cached == loaded
+    assert loaded[:3] == ['You are a secretary.', 'first', 'reply 0']
+    assert loaded[3] == 'message 3'
+    assert len(loaded) == 3 + 2 * HISTORY_LIMIT
+
+def test_cache_evicts_the_least_recently_used_entries():
+    cache = TTLCache(maxsize=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert 'b' not in cache
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+def test_cache_stays_within_its_weight_budget():
+    cache = TTLCache(maxsize=10, max_weight=10, weigh=len)
+    cache.set('a', 'xxxx')
+    cache.set('b', 'xxxx')
+    assert cache.update('a', lambda value: value + 'xxxx')
+    # `a` grew and was used last, so `b` made room.
+    assert 'b' not in cache
+    assert cache.stats()['weight'] == 8
+    assert not cache.update('b', lambda value: value)
+
+def test_cache_counts_hits_and_misses():
+    cache = TTLCache()
+    cache.get('a')
+    cache.set('a', 1)
+    cache.get('a')
+    assert cache.stats() == {'size': 1, 'weight': 0, 'hits': 1, 'misses': 1, 'evictions': 0}
+
+def test_cache_entries_expire_after_their_ttl(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(cache_module, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+    cache = TTLCache(ttl=60)
+    cache.set('a', 1)
+    clock[0] += 60
+    assert cache.get('a') == 1
+    clock[0] += 1
+    assert 'a' not in cache
+    assert cache.get('a') is None
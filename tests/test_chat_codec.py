@@ -0,0 +1,86 @@
+import json
+import datetime
+import pytest
+from pydantic_ai.messages import (
+    ModelMessagesTypeAdapter,
+    ModelRequest,
+    ModelResponse,
+    RetryPromptPart,
+    SystemPromptPart,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from services.chat_codec import (
+    MAGIC,
+    VERSION_ZLIB,
+    VERSION_ZLIB_NULLS,
+    decode_content,
+    encode_content,
+    is_encoded,
+)
+
+TIMESTAMP = datetime.datetime(2025, 3, 1, 12, 0, tzinfo=datetime.timezone.utc)
+
+def conversation(tool_content) -> list:
+    return [
+        ModelRequest(parts=[
+            SystemPromptPart(content='You schedule appointments.'),
+            UserPromptPart(content='Do I have an appointment?', timestamp=TIMESTAMP),
+        ]),
+        ModelResponse(parts=[ToolCallPart(tool_name='get_appointment', args='{}', tool_call_id='call_1')],
+                      model_name='gpt-4o', timestamp=TIMESTAMP),
+        ModelRequest(parts=[
+            ToolReturnPart(tool_name='get_appointment', content=tool_content,
+                           tool_call_id='call_1', timestamp=TIMESTAMP),
+            RetryPromptPart(content='Try again', timestamp=TIMESTAMP),
+        ]),
+        ModelResponse(parts=[TextPart(content='You have no appointment.')], timestamp=TIMESTAMP),
+    ]
+
+def round_trip(messages: list, version: int | None = None) -> list:
+    content = encode_content(ModelMessagesTypeAdapter.dump_json(messages), version)
+    return ModelMessagesTypeAdapter.validate_json(decode_content(content))
+
+@pytest.mark.parametrize('tool_content', [None, '', [], {}, {'id': 'a1', 'bio': None}])
+@pytest.mark.parametrize('version', [0, VERSION_ZLIB, VERSION_ZLIB_NULLS])
+def test_round_trip_keeps_tool_returns(tool_content, version):
+    messages = conversation(tool_content)
+    assert round_trip(messages, version) == messages
+
+def test_only_optional_nulls_are_dropped():
+    content = encode_content(ModelMessagesTypeAdapter.dump_json(conversation(None)))
+    parts = [part for message in json.loads(decode_content(content)) for part in message['parts']]
+    tool_return = next(part for part in parts if part['part_kind'] == 'tool-return')
+    retry = next(part for part in parts if part['part_kind'] == 'retry-prompt')
+    assert tool_return['content'] is None
+    assert 'tool_name' not in retry and 'tool_call_id' not in retry
+
+def test_legacy_json_rows_are_read_and_compacted():
+    legacy = ModelMessagesTypeAdapter.dump_json(conversation(None))
+    assert not is_encoded(legacy)
+    assert decode_content(legacy) == legacy
+    assert decode_content(legacy.decode()) == legacy
+
+    content = encode_content(decode_content(legacy))
+    assert is_encoded(content, VERSION_ZLIB_NULLS)
+    assert len(content) < len(legacy)
+    assert ModelMessagesTypeAdapter.validate_json(decode_content(content)) == conversation(None)
+
+def test_version_1_rows_without_tool_content_are_restored():
+    # Written by the first compressed format, which dropped the null content.
+    data = json.loads(ModelMessagesTypeAdapter.dump_json(conversation(None)))
+    for message in data:
+        for part in message['parts']:
+            if part['part_kind'] == 'tool-return':
+                del part['content']
+    stored = encode_content(json.dumps(data), VERSION_ZLIB)
+    assert stored.startswith(MAGIC + bytes([VERSION_ZLIB]))
+    assert ModelMessagesTypeAdapter.validate_json(decode_content(stored)) == conversation(None)
+
+def test_unknown_versions_are_rejected():
+    with pytest.raises(ValueError):
+        encode_content(b'[]', 9)
+    with pytest.raises(ValueError):
+        decode_content(MAGIC + bytes([9]) + b'')
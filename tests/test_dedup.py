@@ -0,0 +1,139 @@
+from contextlib import contextmanager
+from types import SimpleNamespace
+import pytest
+from sqlmodel import Session, select
+import main
+from database import UnitOfWork, engine
+from models import ProcessedMessage
+from services import dedup as dedup_module
+from services.dedup import DedupStore, message_key
+
+@contextmanager
+def broken_scope(uow=None, nested=False):
+    raise RuntimeError('database is unavailable')
+    yield
+
+def stored(key: str) -> ProcessedMessage | None:
+    with Session(engine) as session:
+        return session.get(ProcessedMessage, key)
+
+def test_messages_are_keyed_by_their_sid():
+    assert message_key({'MessageSid': 'SM1', 'body': 'Oi'}) == ('sid:SM1', True)
+    assert message_key({'sid': 'SM1'}) == ('sid:SM1', True)
+
+def test_messages_without_a_sid_are_keyed_by_their_payload():
+    key, has_sid = message_key({'from': '+5', 'body': 'Oi'})
+    assert not has_sid and key.startswith('sha256:')
+    assert message_key({'body': 'Oi', 'from': '+5'})[0] == key
+    assert message_key({'from': '+5', 'body': 'Olá'})[0] != key
+
+def test_recorded_messages_are_found_once_committed(database):
+    store = DedupStore()
+    with UnitOfWork() as uow:
+        store.record('sid:SM1', True, 'Olá!', False, 'ai1', uow)
+        assert 'sid:SM1' not in store.recent
+    assert store.find('sid:SM1').reply == 'Olá!'
+    # Other workers find it in the database.
+    processed = DedupStore().find('sid:SM1')
+    assert (processed.reply, processed.ai_message_id, processed.delivered) == ('Olá!', 'ai1', False)
+    assert store.find('sid:SM2') is None
+    assert store.stats()['duplicates'] == 1
+
+def test_rolled_back_messages_are_not_recorded(database):
+    store = DedupStore()
+    with pytest.raises(RuntimeError):
+        with UnitOfWork() as uow:
+            store.record('sid:SM1', True, 'Olá!', False, None, uow)
+            raise RuntimeError('agent failed')
+    assert store.find('sid:SM1') is None
+    assert stored('sid:SM1') is None
+
+def test_payload_keys_expire_sooner(database):
+    store = DedupStore(payload_ttl=0)
+    store.record('sha256:abc', False, 'Olá!', False, None)
+    store.record('sid:SM1', True, 'Olá!', False, None)
+    assert store.find('sha256:abc') is None
+    assert store.find('sid:SM1') is not None
+    assert 'sha256:abc' not in store.recent
+
+def test_delivered_marks_are_stored_and_cached(database):
+    store = DedupStore()
+    store.record('sid:SM1', True, 'Olá!', False, None)
+    store.find('sid:SM1')
+    store.mark_delivered('sid:SM1')
+    assert store.recent.get('sid:SM1').delivered
+    assert stored('sid:SM1').delivered
+
+def test_delivered_marks_fall_back_to_the_cache(database, monkeypatch):
+    store = DedupStore()
+    store.record('sid:SM1', True, 'Olá!', False, None)
+    store.find('sid:SM1')
+    monkeypatch.setattr(dedup_module, 'session_scope', broken_scope)
+    store.mark_delivered('sid:SM1')
+    assert store.find('sid:SM1').delivered
+    assert not stored('sid:SM1').delivered
+
+def test_unavailable_databases_let_messages_through(database, monkeypatch):
+    monkeypatch.setattr(dedup_module, 'session_scope', broken_scope)
+    store = DedupStore()
+    store.record('sid:SM1', True, 'Olá!', False, None)
+    assert DedupStore().find('sid:SM1') is None
+
+def test_sent_chunks_are_remembered(database):
+    store = DedupStore()
+    store.mark_chunk_sent('ai1', 0)
+    store.mark_chunk_sent('ai1', 2)
+    assert store.sent_chunks('ai1', 3) == {0, 2}
+    assert store.sent_chunks('ai2', 3) == set()
+
+def test_expired_rows_are_swept(database, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(dedup_module, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+    store = DedupStore(payload_ttl=0, sweep_interval=600)
+    store.record('sha256:abc', False, 'Olá!', False, None)
+    store.record('sid:SM1', True, 'Olá!', False, None)
+    store.sweep_if_due()
+    assert stored('sha256:abc') is not None
+    clock[0] += 600
+    store.sweep_if_due()
+    assert stored('sha256:abc') is None
+    assert stored('sid:SM1') is not None
+    assert store.stats()['swept'] == 1
+
+def test_deduplication_is_off_until_the_table_exists(database):
+    store = DedupStore()
+    store.check_table()
+    assert store.enabled
+    ProcessedMessage.__table__.drop(engine)
+    store.check_table()
+    assert not store.enabled
+
+@pytest.fixture
+def sent(database, monkeypatch) -> list[str]:
+    replies: list[str] = []
+    def deliver_reply(from_number, to_number, body_text, is_media, ai_response_id):
+        replies.append(body_text)
+        return True
+    monkeypatch.setattr(main, 'deliver_reply', deliver_reply)
+    monkeypatch.setattr(main, 'dedup_store', DedupStore())
+    return replies
+
+def test_duplicates_resend_an_undelivered_reply_once(sent):
+    main.dedup_store.record('sid:SM1', True, 'Olá!', False, 'ai1')
+    assert main.handle_duplicate('sid:SM1', '+1', '+5')
+    assert main.handle_duplicate('sid:SM1', '+1', '+5')
+    assert sent == ['Olá!']
+    assert stored('sid:SM1').delivered
+
+def test_delivered_duplicates_are_only_acknowledged(sent):
+    main.dedup_store.record('sid:SM1', True, 'Olá!', False, 'ai1')
+    main.dedup_store.mark_delivered('sid:SM1')
+    assert main.handle_duplicate('sid:SM1', '+1', '+5')
+    assert not main.handle_duplicate('sid:SM2', '+1', '+5')
+    assert sent == []
+
+def test_disabled_deduplication_handles_every_message(sent):
+    main.dedup_store.record('sid:SM1', True, 'Olá!', False, 'ai1')
+    main.dedup_store.enabled = False
+    assert not main.handle_duplicate('sid:SM1', '+1', '+5')
+    assert sent == []
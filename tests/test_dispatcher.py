@@ -0,0 +1,69 @@
+import asyncio
+import pytest
+from services.dispatcher import ConversationDispatcher
+
+async def test_messages_of_a_key_run_in_order():
+    dispatcher = ConversationDispatcher(concurrency=8)
+    handled = []
+
+    async def handle(key, number, delay):
+        await asyncio.sleep(delay)
+        handled.append((key, number))
+
+    # Earlier messages take longer, they would finish last if run concurrently.
+    for number in range(5):
+        for key in ('a', 'b'):
+            await dispatcher.submit(key, lambda key=key, number=number: handle(key, number, 0.01 * (5 - number)))
+    await dispatcher.drain()
+    for key in ('a', 'b'):
+        assert [number for k, number in handled if k == key] == list(range(5))
+
+async def test_keys_run_concurrently_up_to_the_concurrency():
+    dispatcher = ConversationDispatcher(concurrency=2)
+    running = peak = 0
+
+    async def handle():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    for key in range(6):
+        await dispatcher.submit(key, handle)
+    await dispatcher.drain()
+    assert peak == 2
+
+async def test_a_failure_is_raised_and_does_not_block_the_key():
+    dispatcher = ConversationDispatcher(concurrency=4)
+    handled = []
+
+    async def fail():
+        raise RuntimeError('model error')
+
+    async def handle():
+        handled.append('next')
+
+    failed = await dispatcher.submit('a', fail)
+    following = await dispatcher.submit('a', handle)
+    await dispatcher.drain()
+    with pytest.raises(RuntimeError):
+        failed.result()
+    assert following.exception() is None
+    assert handled == ['next']
+
+async def test_submit_blocks_once_max_pending_is_reached():
+    dispatcher = ConversationDispatcher(concurrency=1, max_pending=2)
+    release = asyncio.Event()
+
+    async def handle():
+        await release.wait()
+
+    await dispatcher.submit('a', handle)
+    await dispatcher.submit('b', handle)
+    blocked = asyncio.create_task(dispatcher.submit('c', handle))
+    await asyncio.sleep(0.01)
+    assert not blocked.done()
+    release.set()
+    await blocked
+    await dispatcher.drain()
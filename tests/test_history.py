@@ -0,0 +1,232 @@
+import datetime
+from contextlib import contextmanager
+import pytest
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    SystemPromptPart,
+    TextPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from pydantic_ai.usage import Usage
+from sqlmodel import Session, select
+from conftest import APPOINTMENT_TIME
+from agents.appointment_agent import AppointmentDependencies, appointment_agent
+from agents.summary_agent import summary_agent
+from database import UnitOfWork, engine
+from services import usage as usage_module
+from services.chat import (
+    ConversationSummary,
+    find_conversation_summary,
+    save_conversation_summary,
+    summary_cache,
+)
+from services.context import CONTEXT_HEADER, AppointmentContext
+from services.history import HistoryManager, HistoryWindow, split_turns, system_prompt_parts
+from services.usage import UsageTracker, usage_tracker
+from models import Appointment, Office, TurnUsage
+
+SYSTEM = [SystemPromptPart('You are a secretary.')]
+START = datetime.datetime(2100, 1, 1, 9, tzinfo=datetime.timezone.utc)
+
+def conversation(turns: int) -> list[ModelMessage]:
+    """A stored conversation with one exchange a minute, turn `n` asking `message n`."""
+    messages: list[ModelMessage] = []
+    for number in range(turns):
+        timestamp = START + datetime.timedelta(minutes=number)
+        parts = [*SYSTEM] if number == 0 else []
+        messages.append(ModelRequest(parts=[*parts, UserPromptPart(f"message {number}", timestamp=timestamp)]))
+        messages.append(ModelResponse(parts=[TextPart(f"reply {number}")], timestamp=timestamp))
+    return messages
+
+def prompts(window: HistoryWindow) -> list[str]:
+    return [part.content for turn in window.kept for message in turn.messages
+            for part in message.parts if isinstance(part, UserPromptPart)]
+
+@pytest.fixture
+def summaries(database):
+    summary_cache.clear()
+    yield
+    summary_cache.clear()
+
+def context_message() -> ModelRequest:
+    office = Office(id='o1', name='Smile', description='', address='Rua A, 1', phone_number='+1',
+                    email='', website='', opening_hours='Mon-Fri 08:00-18:00', maps_link='', reviews='')
+    appointment = Appointment(id='a1', date_time=APPOINTMENT_TIME, office_id='o1', doctor_id='d1')
+    return AppointmentContext(office=office, patient=None, appointment=appointment,
+                              doctors=[], specialities=[]).message()
+
+def window(messages: list[ModelMessage]) -> HistoryWindow:
+    system, turns = split_turns(messages)
+    return HistoryWindow(office_id='o1', phone_number='+5', system=system,
+                         summary=ConversationSummary(), kept=turns)
+
+def test_new_conversations_without_context_leave_the_system_prompt_to_the_agent():
+    assert window([]).messages(SYSTEM) == []
+
+def test_new_conversations_get_the_system_prompt_then_the_context():
+    context = context_message()
+    messages = window([]).messages(SYSTEM, context)
+    assert messages == [ModelRequest(parts=SYSTEM), context]
+
+def test_context_goes_after_the_history():
+    stored = [ModelRequest(parts=[SystemPromptPart('Old prompt'), UserPromptPart('Oi')]),
+              ModelResponse(parts=[TextPart('Olá')])]
+    context = context_message()
+    messages = window(stored).messages(SYSTEM, context)
+    assert messages[0] == ModelRequest(parts=SYSTEM)
+    assert messages[-1] is context
+    assert [part.content for message in messages[1:-1] for part in message.parts] == ['Oi', 'Olá']
+
+def test_first_turn_runs_with_the_context_and_does_not_store_it():
+    seen: list[list[ModelMessage]] = []
+
+    def model(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        seen.append(messages)
+        return ModelResponse(parts=[TextPart('Olá!')])
+
+    context = context_message()
+    deps = AppointmentDependencies(office_id='o1', patient_id=None, patient_phone_number='+6')
+    history = window([]).messages(system_prompt_parts(appointment_agent), context)
+    with appointment_agent.override(model=FunctionModel(model)):
+        result = appointment_agent.run_sync('Oi', message_history=history, deps=deps)
+
+    prompts = [part.content for message in seen[0] for part in message.parts
+               if isinstance(part, SystemPromptPart)]
+    assert prompts[0] == system_prompt_parts(appointment_agent)[0].content
+    assert prompts[-1].startswith(CONTEXT_HEADER)
+    stored = [part for message in result.new_messages() for part in message.parts]
+    assert not any(isinstance(part, SystemPromptPart) for part in stored)
+    # The next turn gets the system prompt back from the agent, not from storage.
+    assert window(result.new_messages()).messages(SYSTEM)[0] == ModelRequest(parts=SYSTEM)
+
+def test_turns_start_at_each_user_prompt():
+    stored = conversation(2)
+    stored.insert(2, ModelRequest(parts=[ToolReturnPart('office_hours', 'Mon-Fri', 'call')]))
+    system, turns = split_turns(stored)
+    assert system == SYSTEM
+    assert [len(turn.messages) for turn in turns] == [3, 2]
+    assert turns[1].timestamp == START + datetime.timedelta(minutes=1)
+    assert all(turn.tokens > 0 for turn in turns)
+
+def test_histories_within_the_budget_are_kept_whole(summaries):
+    window = HistoryManager(token_budget=10**6).prepare('o1', '+5', conversation(6))
+    assert window.system == SYSTEM
+    assert prompts(window) == [f"message {number}" for number in range(6)]
+    assert window.to_summarize == []
+
+def test_histories_over_the_budget_are_trimmed_to_the_keep_ratio(summaries):
+    _, turns = split_turns(conversation(6))
+    manager = HistoryManager(token_budget=turns[-1].tokens * 4, keep_ratio=0.5)
+    window = manager.prepare('o1', '+5', conversation(6))
+    assert prompts(window) == ['message 4', 'message 5']
+    assert [turn.messages[0].parts[0].content for turn in window.to_summarize] == [
+        f"message {number}" for number in range(4)]
+
+def test_the_latest_turn_is_kept_even_over_the_budget(summaries):
+    window = HistoryManager(token_budget=1).prepare('o1', '+5', conversation(3))
+    assert prompts(window) == ['message 2']
+    assert len(window.to_summarize) == 2
+
+def test_summarized_turns_are_left_out_of_the_window(summaries):
+    save_conversation_summary('o1', '+5', ConversationSummary(
+        content='Davi asked for the hours.', covered_until=START + datetime.timedelta(minutes=3)))
+    summary_cache.clear()
+    window = HistoryManager(token_budget=10**6).prepare('o1', '+5', conversation(6))
+    assert prompts(window) == ['message 4', 'message 5']
+    messages = window.messages(SYSTEM)
+    assert messages[0] == ModelRequest(parts=[
+        *SYSTEM, SystemPromptPart('Summary of the earlier conversation: Davi asked for the hours.')])
+
+def summary_model(seen: list[str], error: Exception | None = None) -> FunctionModel:
+    def model(messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        seen.append(messages[-1].parts[-1].content)
+        if error is not None:
+            raise error
+        return ModelResponse(parts=[TextPart('Davi asked about messages 0 to 3.')])
+    return FunctionModel(model)
+
+def over_budget_window() -> HistoryWindow:
+    _, turns = split_turns(conversation(6))
+    return HistoryManager(token_budget=turns[-1].tokens * 4).prepare('o1', '+5', conversation(6))
+
+def test_summaries_are_stored_up_to_the_last_summarized_turn(summaries):
+    window = over_budget_window()
+    runs = usage_tracker.stats()['agents'].get(summary_agent.name, {}).get('runs', 0)
+    seen: list[str] = []
+    with summary_agent.override(model=summary_model(seen)):
+        HistoryManager().summarize(window)
+
+    assert seen[0].startswith('Previous summary:\nNone\n\nNew turns:\ncontact: message 0\nassistant: reply 0')
+    assert 'message 4' not in seen[0]
+    assert window.to_summarize == []
+    summary_cache.clear()
+    summary = find_conversation_summary('o1', '+5')
+    assert summary.content == 'Davi asked about messages 0 to 3.'
+    assert summary.covered_until == START + datetime.timedelta(minutes=3)
+    assert usage_tracker.stats()['agents'][summary_agent.name]['runs'] == runs + 1
+    # The next message starts from the summary.
+    assert prompts(HistoryManager(token_budget=10**6).prepare('o1', '+5', conversation(6))) == [
+        'message 4', 'message 5']
+
+async def test_summaries_are_stored_from_the_async_handler_too(summaries):
+    window = over_budget_window()
+    with summary_agent.override(model=summary_model([])):
+        await HistoryManager().summarize_async(window)
+    summary_cache.clear()
+    assert find_conversation_summary('o1', '+5').content == 'Davi asked about messages 0 to 3.'
+
+def test_failed_summaries_are_retried_on_the_next_message(summaries):
+    window = over_budget_window()
+    seen: list[str] = []
+    with summary_agent.override(model=summary_model(seen, error=TimeoutError())):
+        HistoryManager().summarize(window)
+    assert len(seen) == 1
+    assert window.to_summarize == []
+    summary_cache.clear()
+    assert find_conversation_summary('o1', '+5') == ConversationSummary()
+    assert len(over_budget_window().to_summarize) == 4
+
+def usage() -> Usage:
+    return Usage(requests=2, request_tokens=1000, response_tokens=50, details={'cached_tokens': 600})
+
+def test_usage_is_totalled_per_agent_and_office():
+    tracker = UsageTracker()
+    assert tracker.record('appointment_agent', 'o1', usage()) is None
+    tracker.record('appointment_agent', None, usage())
+    stats = tracker.stats()
+    assert stats['agents']['appointment_agent'] == {
+        'runs': 2, 'requests': 4, 'input_tokens': 2000, 'cached_tokens': 1200,
+        'output_tokens': 100, 'cached_ratio': 0.6}
+    assert stats['offices']['o1']['runs'] == 1
+
+def test_usage_is_stored_with_the_unit_of_work(database):
+    with UnitOfWork() as uow:
+        turn = UsageTracker().record('appointment_agent', 'o1', usage(), '+5', 'm1', uow)
+    with Session(engine) as session:
+        stored = session.exec(select(TurnUsage)).one()
+    assert stored.id == turn.id
+    assert (stored.phone_number, stored.chat_message_id, stored.agent) == ('+5', 'm1', 'appointment_agent')
+    assert (stored.requests, stored.input_tokens, stored.cached_tokens, stored.output_tokens) == (2, 1000, 600, 50)
+
+def test_failing_to_store_usage_keeps_the_reply(database, monkeypatch):
+    @contextmanager
+    def broken_scope(uow=None, nested=False):
+        raise RuntimeError('turnusage is locked')
+        yield
+
+    monkeypatch.setattr(usage_module, 'session_scope', broken_scope)
+    tracker = UsageTracker()
+    with UnitOfWork() as uow:
+        assert tracker.record('appointment_agent', 'o1', usage(), uow=uow) is None
+    assert tracker.stats()['agents']['appointment_agent']['runs'] == 1
+
+def test_usage_rows_can_be_turned_off(database, monkeypatch):
+    monkeypatch.setattr(usage_module, 'usage_recording', False)
+    with UnitOfWork() as uow:
+        assert UsageTracker().record('appointment_agent', 'o1', usage(), uow=uow) is None
+    with Session(engine) as session:
+        assert session.exec(select(TurnUsage)).all() == []
@@ -0,0 +1,88 @@
+import pytest
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    UserPromptPart,
+)
+from services import intents as intents_module
+from services.intents import (
+    BUSINESS_HOURS,
+    MENU,
+    OFFICE_LOCATION,
+    PATIENT_MENU,
+    IntentRouter,
+    normalize,
+    numbered,
+)
+from services.office import find_office_by_id
+from services.routing import Route
+
+def history(reply: str) -> list[ModelMessage]:
+    return [ModelRequest(parts=[UserPromptPart('Oi')]), ModelResponse(parts=[TextPart(reply)])]
+
+GREETED = history('Olá! Sou a secretária da Smile.')
+MENU_SHOWN = history(f"How may I help you today?\n{numbered(PATIENT_MENU)}")
+
+@pytest.fixture
+def office(database):
+    return find_office_by_id('o1')
+
+def test_messages_are_normalized_before_matching():
+    assert normalize('  Horário de  funcionamento?! ') == 'horario de funcionamento'
+    assert normalize('ENDEREÇO') == 'endereco'
+
+@pytest.mark.parametrize('content, intent', [
+    ('Menu', MENU), ('opções', MENU), ('Business hours?', BUSINESS_HOURS),
+    ('horários', BUSINESS_HOURS), ('Where are you?', OFFICE_LOCATION), ('onde fica', OFFICE_LOCATION),
+])
+def test_whole_phrases_are_matched(office, content, intent):
+    assert IntentRouter().match(Route(office, 'patient', 'p1'), content, GREETED) == intent
+
+@pytest.mark.parametrize('content', ['What are your business hours on saturday?', 'I want the menu', '2'])
+def test_anything_else_goes_to_the_agent(office, content):
+    assert IntentRouter().match(Route(office, 'patient', 'p1'), content, GREETED) is None
+
+def test_new_conversations_go_to_the_agent(office):
+    assert IntentRouter().match(Route(office), 'menu', []) is None
+
+def test_menu_numbers_are_matched_right_after_the_patient_menu(office):
+    router = IntentRouter()
+    assert router.match(Route(office), '2', MENU_SHOWN) == BUSINESS_HOURS
+    assert router.match(Route(office), '3.', MENU_SHOWN) == OFFICE_LOCATION
+    assert router.match(Route(office), '1', MENU_SHOWN) is None
+    assert router.match(Route(office, 'doctor', 'd1'), '2', MENU_SHOWN) is None
+
+def test_staff_only_get_their_menu(office):
+    router = IntentRouter()
+    assert router.match(Route(office, 'owner', 'w1'), 'menu', GREETED) == MENU
+    assert router.match(Route(office, 'owner', 'w1'), 'business hours', GREETED) is None
+
+def test_hours_and_location_come_from_the_office(office):
+    router = IntentRouter()
+    assert router.answer(BUSINESS_HOURS, Route(office)) == 'Smile business hours:\nMon-Fri 08:00-18:00'
+    assert router.answer(OFFICE_LOCATION, Route(office)) == 'Smile is at Rua A, 1\nhttps://maps/smile'
+
+def test_menus_depend_on_the_contact(office):
+    router = IntentRouter()
+    assert router.menu(Route(office)).startswith('How may I help you today?\n1. Make appointment')
+    assert router.menu(Route(office, 'patient', 'p1')).endswith(
+        '1. Cancel appointment\n2. Reschedule appointment')
+    assert router.menu(Route(office, 'manager', 'm1')) == 'How can I help you?\n1. List inventory'
+
+def test_routed_replies_are_stored_like_agent_turns(office):
+    router = IntentRouter()
+    reply = router.route(Route(office), 'Horários', GREETED)
+    assert reply.intent == BUSINESS_HOURS
+    request, response = reply.messages
+    assert request.parts[0].content == 'Horários'
+    assert response.parts[0].content == reply.text
+    assert router.route(Route(office), 'Quero marcar uma consulta', GREETED) is None
+    assert router.stats() == {'messages': 2, 'handled': 1, 'share': 0.5, 'intents': {BUSINESS_HOURS: 1}}
+
+def test_the_router_can_be_turned_off(office, monkeypatch):
+    monkeypatch.setattr(intents_module, 'intent_router_enabled', False)
+    router = IntentRouter()
+    assert router.route(Route(office), 'menu', GREETED) is None
+    assert router.stats()['messages'] == 1
@@ -0,0 +1,202 @@
+import asyncio
+from dataclasses import dataclass
+import pytest
+from kafka import TopicPartition
+from kafka.errors import CommitFailedError
+from kafka.structs import OffsetAndMetadata
+from twilio.rest import Client
+import main
+from services import broker
+from services.chat import load_conversation
+from services.deadline import Deadline
+from services.dedup import dedup_store
+from services.office import find_office_by_id
+from services.offsets import CommitOnRevoke
+from services.routing import Route
+from services.sender import FakeTwilioHttpClient, OutboundSender
+
+INBOUND = TopicPartition('process_message', 0)
+
+@dataclass
+class Record:
+    offset: int
+    value: dict
+
+class Stop(Exception):
+    pass
+
+class FakeConsumer:
+    """Returns `batches` from poll, then stops the worker loop."""
+
+    def __init__(self, batches: list[dict]):
+        self.batches = list(batches)
+        self.commits: list[dict] = []
+        self.closed = False
+
+    def subscribe(self, topics, listener=None):
+        self.listener = listener
+
+    def poll(self, timeout_ms=0, max_records=None):
+        if not self.batches:
+            raise Stop()
+        return self.batches.pop(0)
+
+    def commit(self, offsets):
+        self.commits.append(offsets)
+
+    def close(self):
+        self.closed = True
+
+def inbound_message(number: int) -> dict:
+    return {'to_number': 'whatsapp:+1', 'from_number': f"whatsapp:+55{number}", 'body': str(number)}
+
+def run_worker(monkeypatch, handle, records: int = 5) -> FakeConsumer:
+    consumer = FakeConsumer([{INBOUND: [Record(offset, inbound_message(offset))
+                                        for offset in range(records)]}])
+    monkeypatch.setattr(main, 'create_consumer', lambda **configs: consumer)
+    monkeypatch.setattr(main, 'handle_message_async', handle)
+    monkeypatch.setattr(main, 'inbound_retry_backoff', 0)
+    monkeypatch.setattr(main, 'load_caches', lambda: None)
+    with pytest.raises(Stop):
+        asyncio.run(main.main_async())
+    assert consumer.closed
+    return consumer
+
+def failing_on(body: str, failures: int | None = None):
+    calls = []
+
+    async def handle(message, deadline=None):
+        calls.append(message['body'])
+        if message['body'] == body and (failures is None or calls.count(body) <= failures):
+            raise RuntimeError('database is down')
+
+    handle.calls = calls
+    return handle
+
+def test_offsets_are_committed_after_the_messages_are_handled(monkeypatch):
+    consumer = run_worker(monkeypatch, failing_on('none'))
+    assert consumer.commits[-1] == {INBOUND: OffsetAndMetadata(5, '')}
+
+def test_a_failed_message_is_not_committed(monkeypatch):
+    monkeypatch.setattr(broker, 'dead_letter_topic', None)
+    handle = failing_on('2')
+    consumer = run_worker(monkeypatch, handle)
+    assert consumer.commits[-1] == {INBOUND: OffsetAndMetadata(2, '')}
+    assert handle.calls.count('2') == main.inbound_max_attempts
+    # The messages after it are still handled.
+    assert {'3', '4'} <= set(handle.calls)
+
+def test_a_message_is_committed_once_a_retry_succeeds(monkeypatch):
+    handle = failing_on('2', failures=1)
+    consumer = run_worker(monkeypatch, handle)
+    assert consumer.commits[-1] == {INBOUND: OffsetAndMetadata(5, '')}
+    assert handle.calls.count('2') == 2
+
+def test_a_message_that_keeps_failing_is_dead_lettered(monkeypatch):
+    parked = []
+    monkeypatch.setattr(broker, 'dead_letter_topic', 'health_up_dead_letter')
+    monkeypatch.setattr(broker, 'publish_dead_letter', lambda message, error: parked.append(message))
+    consumer = run_worker(monkeypatch, failing_on('2'))
+    assert consumer.commits[-1] == {INBOUND: OffsetAndMetadata(5, '')}
+    assert [message['body'] for message in parked] == ['2']
+
+def test_a_failed_dead_letter_publish_is_not_committed(monkeypatch):
+    def publish_dead_letter(message, error):
+        raise RuntimeError('broker unavailable')
+
+    monkeypatch.setattr(broker, 'dead_letter_topic', 'health_up_dead_letter')
+    monkeypatch.setattr(broker, 'publish_dead_letter', publish_dead_letter)
+    consumer = run_worker(monkeypatch, failing_on('2'))
+    assert consumer.commits[-1] == {INBOUND: OffsetAndMetadata(2, '')}
+
+OUTBOUND = TopicPartition('outbound_message', 0)
+LONG_REPLY = 'a' * 1600 + 'b' * 1600 + 'c' * 10
+
+class FakeLog:
+    """Consumer over one partition, redelivering from where it is rewound."""
+
+    def __init__(self, values: list[dict], polls: int, fail_commits: bool = False):
+        self.values = values
+        self.polls = polls
+        self.fail_commits = fail_commits
+        self.position = 0
+        self.commits: list[dict] = []
+        self.seeks: list[int] = []
+
+    def subscribe(self, topics, listener=None):
+        self.listener = listener
+
+    def poll(self, timeout_ms=0, max_records=None):
+        if self.polls == 0:
+            raise Stop()
+        self.polls -= 1
+        records = [Record(offset, self.values[offset]) for offset in range(self.position, len(self.values))]
+        self.position = len(self.values)
+        return {OUTBOUND: records} if records else {}
+
+    def seek(self, partition, offset):
+        self.seeks.append(offset)
+        self.position = offset
+
+    def commit(self, offsets):
+        if self.fail_commits:
+            raise CommitFailedError('group rebalanced')
+        self.commits.append(offsets)
+
+    def close(self):
+        pass
+
+def outbound_reply(body: str, to: str = '+5511') -> dict:
+    return {'from': '+1', 'to': to, 'body': body, 'is_media': False, 'ai_response_id': None}
+
+def run_sender(monkeypatch, consumer: FakeLog, statuses: list[int]) -> FakeTwilioHttpClient:
+    http_client = FakeTwilioHttpClient(statuses=statuses)
+    sender = OutboundSender(Client('AC00000000000000000000000000000000', 'test', http_client=http_client),
+                            max_retries=0)
+    monkeypatch.setattr(main, 'outbound_sender', sender)
+    monkeypatch.setattr(main, 'create_sender_consumer', lambda max_poll_records: consumer)
+    with pytest.raises(Stop):
+        main.main_sender()
+    return http_client
+
+def bodies(http_client: FakeTwilioHttpClient) -> list[str]:
+    return [data['Body'] for data in http_client.sent()]
+
+def test_sender_commits_the_replies_that_went_out(database, monkeypatch):
+    consumer = FakeLog([outbound_reply('hello'), outbound_reply('bye', to='+5522')], polls=1)
+    http_client = run_sender(monkeypatch, consumer, [])
+    assert sorted(bodies(http_client)) == ['bye', 'hello']
+    assert consumer.commits == [{OUTBOUND: OffsetAndMetadata(2, '')}]
+    assert isinstance(consumer.listener, CommitOnRevoke)
+
+def test_sender_redelivers_only_the_chunks_not_sent(database, monkeypatch):
+    consumer = FakeLog([outbound_reply(LONG_REPLY)], polls=2)
+    # The second chunk is refused once.
+    http_client = run_sender(monkeypatch, consumer, [201, 400])
+    assert consumer.seeks == [0]
+    assert [body[0] for body in bodies(http_client)] == ['a', 'b', 'c']
+    assert consumer.commits == [{OUTBOUND: OffsetAndMetadata(1, '')}]
+
+def test_sender_survives_a_rebalance(database, monkeypatch):
+    consumer = FakeLog([outbound_reply(LONG_REPLY)], polls=2, fail_commits=True)
+    run_sender(monkeypatch, consumer, [201, 400])
+
+    # The partition moved to another sender worker, which starts over from the last commit.
+    consumer = FakeLog([outbound_reply(LONG_REPLY), outbound_reply('next')], polls=1)
+    http_client = run_sender(monkeypatch, consumer, [])
+    assert bodies(http_client) == ['next']
+    assert consumer.commits == [{OUTBOUND: OffsetAndMetadata(2, '')}]
+
+def test_timed_out_messages_ask_the_contact_to_send_them_again(database, monkeypatch):
+    http_client = FakeTwilioHttpClient()
+    monkeypatch.setattr(main, 'outbound_sender', OutboundSender(
+        Client('AC00000000000000000000000000000000', 'test', http_client=http_client)))
+    monkeypatch.setattr(main.routing_resolver, 'resolve', lambda office_phone_number, contact_phone_number:
+                        Route(find_office_by_id('o1'), 'patient', 'p1'))
+    message = {'to_number': 'whatsapp:+1', 'from_number': 'whatsapp:+5', 'body': 'Oi',
+               'num_media': '0', 'message_sid': 'SM-late'}
+    main.handle_message(message, Deadline(0))
+    assert bodies(http_client) == [main.deadline_reply]
+    # Nothing was stored, so nothing will follow up on it.
+    assert load_conversation('o1', '+5').messages() == []
+    assert dedup_store.find('sid:SM-late') is None
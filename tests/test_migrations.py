@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+import pytest
+from sqlalchemy import create_engine, text
+from sqlmodel import SQLModel
+import migrations
+from migrations import (
+    INVALID_INDEXES_SQL,
+    create_indexes,
+    hot_query_indexes,
+    run_migrations,
+    verify,
+)
+
+@pytest.fixture
+def engine(tmp_path):
+    """A database of its own, the migrations table isn't dropped between tests."""
+    engine = create_engine(f"sqlite:///{tmp_path}/migrations.db")
+    for table in SQLModel.metadata.sorted_tables:
+        if table.name != 'contact':
+            table.create(engine)
+    yield engine
+    engine.dispose()
+
+class FakePostgresConnection:
+    """Records the statements run, reporting `invalid` as invalid indexes."""
+
+    dialect = SimpleNamespace(name='postgresql')
+
+    def __init__(self, invalid: set[str] = frozenset()):
+        self.invalid = invalid
+        self.statements: list[str] = []
+
+    def exec_driver_sql(self, statement: str):
+        self.statements.append(statement)
+        rows = list(self.invalid) if statement == INVALID_INDEXES_SQL else []
+        return SimpleNamespace(scalars=lambda: rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+def test_migrations_are_applied_once(engine):
+    applied = run_migrations(engine)
+    # The Postgres only one is recorded too, so it is not retried on every run.
+    assert [migration.version for migration in applied] == [1, 2, 3, 4, 5]
+    assert run_migrations(engine) == []
+    assert verify(engine) == []
+
+def test_verify_reports_missing_indexes(engine):
+    run_migrations(engine)
+    with engine.begin() as connection:
+        connection.execute(text('DROP INDEX ix_appointment_doctor_id_date_time'))
+    assert verify(engine) == ['ix_appointment_doctor_id_date_time']
+
+def test_invalid_indexes_are_dropped_before_being_built_again():
+    connection = FakePostgresConnection({'ix_office_phone_number'})
+    create_indexes(*hot_query_indexes)(connection)
+    assert connection.statements[:3] == [
+        INVALID_INDEXES_SQL,
+        'DROP INDEX CONCURRENTLY IF EXISTS ix_office_phone_number',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_office_phone_number ON office (phone_number)',
+    ]
+    assert sum(statement.startswith('DROP') for statement in connection.statements) == 1
+    assert len(connection.statements) == 2 + len(hot_query_indexes)
+
+def test_verify_reports_invalid_indexes(monkeypatch):
+    connection = FakePostgresConnection({'ix_chatmessage_office_id_phone_number_timestamp'})
+    expected = {index.name for migration in migrations.migrations for index in migration.indexes}
+    monkeypatch.setattr(migrations, 'inspect', lambda connection: SimpleNamespace(
+        get_indexes=lambda table_name: [{'name': name} for name in expected]))
+    assert verify(SimpleNamespace(connect=lambda: connection)) == [
+        'ix_chatmessage_office_id_phone_number_timestamp']
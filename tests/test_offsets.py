@@ -0,0 +1,91 @@
+from kafka import TopicPartition
+from kafka.structs import OffsetAndMetadata
+from services.offsets import CommitOnRevoke, OffsetTracker
+
+P0 = TopicPartition('process_message', 0)
+P1 = TopicPartition('process_message', 1)
+
+def tracker_with(partition, offsets) -> OffsetTracker:
+    tracker = OffsetTracker()
+    for offset in offsets:
+        tracker.track(partition, offset)
+    return tracker
+
+def test_nothing_is_committable_before_a_record_is_done():
+    tracker = tracker_with(P0, [10, 11])
+    assert tracker.committable() == {}
+    assert tracker.in_flight() == 2
+
+def test_commits_the_offset_after_the_last_done_record():
+    tracker = tracker_with(P0, [10, 11, 12])
+    tracker.done(P0, 10)
+    tracker.done(P0, 11)
+    assert tracker.committable() == {P0: OffsetAndMetadata(12, '')}
+    # Already returned offsets aren't committed again.
+    assert tracker.committable() == {}
+
+def test_a_gap_holds_back_the_records_after_it():
+    tracker = tracker_with(P0, [10, 11, 12, 13])
+    tracker.done(P0, 10)
+    tracker.done(P0, 12)
+    tracker.done(P0, 13)
+    assert tracker.committable() == {P0: OffsetAndMetadata(11, '')}
+    assert tracker.committable() == {}
+    tracker.done(P0, 11)
+    assert tracker.committable() == {P0: OffsetAndMetadata(14, '')}
+    assert tracker.in_flight() == 0
+
+def test_out_of_order_completion():
+    tracker = tracker_with(P0, [10, 11, 12])
+    for offset in (12, 11, 10):
+        tracker.done(P0, offset)
+    assert tracker.committable() == {P0: OffsetAndMetadata(13, '')}
+
+def test_partitions_are_committed_independently():
+    tracker = tracker_with(P0, [10, 11])
+    tracker.track(P1, 3)
+    tracker.done(P0, 11)
+    tracker.done(P1, 3)
+    assert tracker.committable() == {P1: OffsetAndMetadata(4, '')}
+
+def test_unknown_and_repeated_done_are_ignored():
+    tracker = tracker_with(P0, [10])
+    tracker.done(P0, 9)
+    tracker.done(P1, 10)
+    tracker.done(P0, 10)
+    tracker.done(P0, 10)
+    assert tracker.committable() == {P0: OffsetAndMetadata(11, '')}
+
+def test_forget_drops_revoked_partitions():
+    tracker = tracker_with(P0, [10, 11])
+    tracker.track(P1, 3)
+    tracker.forget([P0])
+    assert tracker.in_flight() == 1
+    # Records still being handled when revoked finish without being committed.
+    tracker.done(P0, 10)
+    tracker.done(P1, 3)
+    assert tracker.committable() == {P1: OffsetAndMetadata(4, '')}
+
+class FakeConsumer:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.commits: list[dict] = []
+
+    def commit(self, offsets):
+        if self.fail:
+            raise RuntimeError('rebalance in progress')
+        self.commits.append(offsets)
+
+def test_commit_on_revoke_commits_then_forgets():
+    tracker = tracker_with(P0, [10, 11])
+    tracker.done(P0, 10)
+    consumer = FakeConsumer()
+    CommitOnRevoke(consumer, tracker).on_partitions_revoked([P0])
+    assert consumer.commits == [{P0: OffsetAndMetadata(11, '')}]
+    assert tracker.in_flight() == 0
+
+def test_commit_on_revoke_survives_a_failed_commit():
+    tracker = tracker_with(P0, [10])
+    tracker.done(P0, 10)
+    CommitOnRevoke(FakeConsumer(fail=True), tracker).on_partitions_revoked([P0])
+    assert tracker.in_flight() == 0
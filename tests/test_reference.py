@@ -0,0 +1,72 @@
+import pytest
+from sqlmodel import Session
+from database import engine
+from models import Doctor, OfficeChange
+from services import reference
+from services.reference import OfficeNotFound, OfficeReferenceCache, find_office_reference
+
+def rename_doctor(name: str):
+    with Session(engine) as session:
+        doctor = session.get(Doctor, 'd1')
+        doctor.name = name
+        session.add(doctor)
+        session.commit()
+
+def doctor_names(cache: OfficeReferenceCache) -> list[str]:
+    return [doctor.name for doctor in cache.get('o1').doctors]
+
+def test_offices_are_loaded_once(database):
+    cache = OfficeReferenceCache()
+    reference_data = cache.get('o1')
+    assert reference_data.office.name == 'Smile'
+    assert [s.id for s in reference_data.specialities] == ['s1']
+    assert cache.get('o1') is reference_data
+    assert cache.stats()['misses'] == 1
+
+def test_invalidate_reloads_an_office(database):
+    cache = OfficeReferenceCache()
+    assert doctor_names(cache) == ['Ana']
+    rename_doctor('Ana Lima')
+    assert doctor_names(cache) == ['Ana']
+    cache.invalidate('o1')
+    assert doctor_names(cache) == ['Ana Lima']
+    rename_doctor('Ana')
+    cache.invalidate()
+    assert doctor_names(cache) == ['Ana']
+    assert cache.stats()['invalidations'] == 2
+
+def test_workers_reload_offices_changed_elsewhere(database, monkeypatch):
+    worker = OfficeReferenceCache(poll_interval=0)
+    worker.check_table()
+    assert worker.polling
+    worker.poll_changes_if_due()
+    assert doctor_names(worker) == ['Ana']
+
+    rename_doctor('Ana Lima')
+    # As if it ran in the process of the admin or the command line.
+    monkeypatch.setattr(reference, 'office_reference_cache', OfficeReferenceCache())
+    reference.notify_office_change('o1')
+    assert doctor_names(worker) == ['Ana']
+    assert worker.poll_changes() == 1
+    assert doctor_names(worker) == ['Ana Lima']
+    assert worker.poll_changes() == 0
+
+def test_first_poll_drops_what_was_cached_before(database):
+    worker = OfficeReferenceCache()
+    assert doctor_names(worker) == ['Ana']
+    rename_doctor('Ana Lima')
+    assert worker.poll_changes() == 0
+    assert doctor_names(worker) == ['Ana Lima']
+
+def test_polling_stops_without_the_change_table(database):
+    OfficeChange.__table__.drop(engine, checkfirst=True)
+    worker = OfficeReferenceCache(poll_interval=0)
+    worker.check_table()
+    assert not worker.polling
+    worker.poll_changes_if_due()
+
+def test_missing_offices_raise(database, monkeypatch):
+    monkeypatch.setattr(reference, 'office_reference_cache', OfficeReferenceCache())
+    assert find_office_reference('o1').office.id == 'o1'
+    with pytest.raises(OfficeNotFound):
+        find_office_reference('missing')
@@ -0,0 +1,140 @@
+from types import SimpleNamespace
+import pytest
+from pydantic_ai import Agent
+from pydantic_ai.exceptions import FallbackExceptionGroup, ModelHTTPError
+from pydantic_ai.messages import (
+    ModelMessage,
+    ModelRequest,
+    ModelResponse,
+    TextPart,
+    ToolCallPart,
+    ToolReturnPart,
+    UserPromptPart,
+)
+from pydantic_ai.models import ModelRequestParameters
+from pydantic_ai.models.function import AgentInfo, FunctionModel
+from pydantic_ai.tools import ToolDefinition
+from agents import router as router_module
+from agents.router import RoutedModel, is_simple_turn
+
+class Scripted:
+    """Model function answering with `text`, or raising `error`, and counting its calls."""
+
+    def __init__(self, text: str = '', error: Exception | None = None, tool: str | None = None):
+        self.text = text
+        self.error = error
+        self.tool = tool
+        self.calls = 0
+
+    def __call__(self, messages: list[ModelMessage], info: AgentInfo) -> ModelResponse:
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        if self.tool is not None and not isinstance(messages[-1].parts[-1], ToolReturnPart):
+            return ModelResponse(parts=[ToolCallPart(self.tool, {})])
+        return ModelResponse(parts=[TextPart(self.text)])
+
+def routed(primary: list, light: list | None = None) -> RoutedModel:
+    model = RoutedModel([f'primary{i}' for i in range(len(primary))],
+                        [f'light{i}' for i in range(len(light))] if light else None)
+    model.primary.models = [FunctionModel(f.__call__, model_name=f'primary{i}') for i, f in enumerate(primary)]
+    if light:
+        model.light.models = [FunctionModel(f.__call__, model_name=f'light{i}') for i, f in enumerate(light)]
+    return model
+
+def agent(model: RoutedModel) -> Agent:
+    agent = Agent(model)
+
+    @agent.tool_plain
+    def office_hours() -> str:
+        return 'Mon-Fri 08:00-18:00'
+
+    return agent
+
+def request(text: str) -> list[ModelMessage]:
+    return [ModelRequest(parts=[UserPromptPart(text)])]
+
+@pytest.mark.parametrize('text', ['Oi', 'Bom dia!', 'sim', '2', 'Obrigada', 'Ok, confirmo'])
+def test_greetings_menu_options_and_confirmations_are_simple(text):
+    assert is_simple_turn(request(text), ModelRequestParameters([], True, []))
+
+@pytest.mark.parametrize('text', ['I want to book with Ana next monday', 'What are the business hours?',
+                                  'oi oi oi oi oi', ''])
+def test_longer_or_open_questions_are_not_simple(text):
+    assert not is_simple_turn(request(text), ModelRequestParameters([], True, []))
+
+def test_tool_results_and_structured_results_need_the_primary_models():
+    parameters = ModelRequestParameters([], True, [])
+    tool_result = [ModelRequest(parts=[ToolReturnPart('office_hours', 'Mon-Fri', 'call')])]
+    assert not is_simple_turn(tool_result, parameters)
+    result_tool = ToolDefinition('final_result', 'The appointment', {'type': 'object', 'properties': {}})
+    assert not is_simple_turn(request('sim'), ModelRequestParameters([], False, [result_tool]))
+    assert not is_simple_turn([], parameters)
+
+def test_simple_turns_go_to_the_light_model():
+    primary, light = Scripted('primary'), Scripted('light')
+    model = routed([primary], [light])
+    assert agent(model).run_sync('Oi').data == 'light'
+    assert agent(model).run_sync('I want to book with Ana next monday').data == 'primary'
+    assert (primary.calls, light.calls) == (1, 1)
+    assert model.stats()['escalations'] == 0
+
+def test_light_tool_calls_are_escalated_and_their_usage_counted():
+    primary, light = Scripted('primary'), Scripted(tool='office_hours')
+    model = routed([primary], [light])
+    result = agent(model).run_sync('sim')
+    assert result.data == 'primary'
+    assert light.calls == 1
+    assert model.stats()['escalations'] == 1
+    light_tokens = model.light.stats['light0'].response_tokens
+    primary_tokens = model.primary.stats['primary0'].response_tokens
+    assert light_tokens > 0
+    assert result.usage().response_tokens == light_tokens + primary_tokens
+
+def test_failing_light_models_escalate():
+    primary, light = Scripted('primary'), Scripted(error=ModelHTTPError(503, 'light0'))
+    model = routed([primary], [light])
+    assert agent(model).run_sync('Oi').data == 'primary'
+    assert model.stats()['escalations'] == 1
+    assert model.stats()['light']['models']['light0']['failures'] == 1
+
+def test_rate_limited_primary_fails_over_to_the_next_model():
+    limited, backup = Scripted(error=ModelHTTPError(429, 'primary0')), Scripted('backup')
+    model = routed([limited, backup])
+    assert agent(model).run_sync('What are the business hours?').data == 'backup'
+    stats = model.stats()['primary']
+    assert stats['failovers'] == 1
+    assert stats['models']['primary0']['failures'] == 1
+    assert stats['models']['primary1']['requests'] == 1
+
+def test_client_errors_do_not_fail_over():
+    invalid, backup = Scripted(error=ModelHTTPError(400, 'primary0')), Scripted('backup')
+    model = routed([invalid, backup])
+    with pytest.raises(ModelHTTPError):
+        agent(model).run_sync('What are the business hours?')
+    assert backup.calls == 0
+
+def test_failed_models_cool_down_before_being_tried_again(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(router_module, 'time', SimpleNamespace(monotonic=lambda: clock[0]))
+    monkeypatch.setattr(router_module, 'failover_cooldown', 30)
+    limited, backup = Scripted(error=ModelHTTPError(429, 'primary0')), Scripted('backup')
+    model = routed([limited, backup])
+    agent(model).run_sync('What are the business hours?')
+    clock[0] += 10
+    agent(model).run_sync('What are the business hours?')
+    assert (limited.calls, backup.calls) == (1, 2)
+    clock[0] += 30
+    agent(model).run_sync('What are the business hours?')
+    assert (limited.calls, backup.calls) == (2, 3)
+
+def test_first_model_gets_another_chance_when_every_model_is_cooling_down(monkeypatch):
+    monkeypatch.setattr(router_module, 'failover_cooldown', 30)
+    first, second = Scripted(error=ModelHTTPError(503, 'primary0')), Scripted(error=TimeoutError())
+    model = routed([first, second])
+    with pytest.raises(FallbackExceptionGroup):
+        agent(model).run_sync('What are the business hours?')
+    first.error = None
+    first.text = 'recovered'
+    assert agent(model).run_sync('What are the business hours?').data == 'recovered'
+    assert (first.calls, second.calls) == (2, 1)
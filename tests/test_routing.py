@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+import pytest
+import cache as cache_module
+from sqlmodel import Session
+from models import Patient, selectable
+from services import routing as routing_module
+from services.routing import RoutingResolver
+
+@pytest.fixture
+def contacts(database):
+    """The contact materialized view, as a plain view sqlite can create."""
+    query = selectable.compile(database, compile_kwargs={'literal_binds': True})
+    with database.begin() as connection:
+        connection.exec_driver_sql(f'CREATE VIEW contact AS {query}')
+    yield database
+    with database.begin() as connection:
+        connection.exec_driver_sql('DROP VIEW contact')
+
+@pytest.fixture
+def clock(monkeypatch) -> list[float]:
+    """Time of the resolver and its caches, moved forward by the tests."""
+    now = [1000.0]
+    fake_time = SimpleNamespace(monotonic=lambda: now[0])
+    monkeypatch.setattr(routing_module, 'time', fake_time)
+    monkeypatch.setattr(cache_module, 'time', fake_time)
+    return now
+
+def queries(monkeypatch) -> list[str]:
+    """Records the one by one lookups of the resolver."""
+    calls: list[str] = []
+    find_office, find_contact = routing_module.find_office_by_phone_number, routing_module.find_contact_by_phone_number
+    monkeypatch.setattr(routing_module, 'find_office_by_phone_number',
+                        lambda *args: calls.append('office') or find_office(*args))
+    monkeypatch.setattr(routing_module, 'find_contact_by_phone_number',
+                        lambda *args: calls.append('contact') or find_contact(*args))
+    return calls
+
+def test_loaded_routes_resolve_without_queries(contacts, monkeypatch):
+    calls = queries(monkeypatch)
+    resolver = RoutingResolver()
+    resolver.load()
+    route = resolver.resolve('+1', '+2')
+    assert (route.office.id, route.contact_kind, route.contact_id) == ('o1', 'doctor', 'd1')
+    assert resolver.resolve('+1', '+5').contact_kind == 'patient'
+    assert calls == []
+
+def test_unknown_contacts_are_looked_up_and_cached(contacts, monkeypatch):
+    calls = queries(monkeypatch)
+    resolver = RoutingResolver()
+    resolver.load()
+    route = resolver.resolve('+1', '+9')
+    assert (route.office.id, route.contact_kind) == ('o1', None)
+    assert resolver.resolve('+1', '+9') is route
+    assert calls == ['contact']
+    assert resolver.resolve('+9', '+5') is None
+
+def test_routes_are_refreshed_before_they_expire(contacts, clock, monkeypatch):
+    resolver = RoutingResolver(ttl=300, refresh_interval=240)
+    resolver.load()
+    with Session(contacts) as session:
+        session.add(Patient(id='p2', name='Eva', phone_number='+6', office_id='o1'))
+        session.commit()
+
+    clock[0] += 200
+    resolver.refresh_if_due()
+    assert resolver.refreshes == 0
+    clock[0] += 40
+    resolver.refresh_if_due()
+    assert resolver.refreshes == 1
+
+    calls = queries(monkeypatch)
+    # Past the TTL of the first load, served from the refreshed one.
+    clock[0] += 100
+    assert resolver.resolve('+1', '+5').contact_id == 'p1'
+    assert resolver.resolve('+1', '+6').contact_id == 'p2'
+    assert calls == []
+
+def test_routes_expire_without_a_refresh(contacts, clock, monkeypatch):
+    resolver = RoutingResolver(ttl=300, refresh_interval=0)
+    resolver.load()
+    calls = queries(monkeypatch)
+    clock[0] += 340
+    resolver.refresh_if_due()
+    assert resolver.resolve('+1', '+5').contact_id == 'p1'
+    assert calls == ['office', 'contact']
+
+def test_refresh_retries_a_failed_startup_load_once_per_interval(database, clock):
+    # Without the contact view the load fails.
+    resolver = RoutingResolver(refresh_interval=240)
+    resolver.refresh_if_due()
+    assert resolver.refreshes == 0
+    clock[0] += 100
+    resolver.refresh_if_due()
+    assert resolver.stats()['refreshes'] == 0
+
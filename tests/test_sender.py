@@ -0,0 +1,155 @@
+import time
+import threading
+import pytest
+from twilio.base.exceptions import TwilioRestException
+from twilio.rest import Client
+from services import sender as sender_module
+from services.sender import FakeTwilioHttpClient, OutboundSender, TokenBucket
+
+def outbound_sender(statuses: list[int] | None = None, latency: float = 0,
+                    **options) -> tuple[OutboundSender, FakeTwilioHttpClient]:
+    http_client = FakeTwilioHttpClient(latency=latency, statuses=statuses)
+    client = Client('AC00000000000000000000000000000000', 'test', http_client=http_client)
+    options = {'backoff_base': 0.001, 'backoff_max': 0.01, **options}
+    return OutboundSender(client, **options), http_client
+
+@pytest.fixture
+def sleeps(monkeypatch) -> list[float]:
+    """Records the backoff sleeps of the sender instead of waiting."""
+    slept: list[float] = []
+    monkeypatch.setattr(sender_module.time, 'sleep', slept.append)
+    return slept
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(rate=100, capacity=5)
+    started = time.monotonic()
+    waits = [bucket.acquire() for _ in range(15)]
+    elapsed = time.monotonic() - started
+    assert waits[:5] == [0] * 5
+    assert all(wait > 0 for wait in waits[5:])
+    # Ten tokens past the burst at 100 per second.
+    assert 0.08 <= elapsed < 0.5
+
+def test_token_bucket_refills_over_time():
+    bucket = TokenBucket(rate=1000, capacity=2)
+    bucket.acquire()
+    bucket.acquire()
+    time.sleep(0.01)
+    assert bucket.acquire() == 0
+
+def test_each_sender_number_is_rate_limited_separately(sleeps):
+    sender, http_client = outbound_sender(rate=1, burst=1)
+    for from_number in ('+1', '+2', '+3'):
+        sender.send(from_number, '+55', body='hi')
+    assert sleeps == []
+    sender.send('+1', '+55', body='again')
+    assert len(sleeps) == 1 and 0.5 < sleeps[0] <= 1
+    assert sender.stats()['throttled_seconds'] == round(sleeps[0], 3)
+    assert sender.stats()['senders'] == 3
+
+@pytest.mark.parametrize('status', [429, 500, 502, 503, 504])
+def test_throttled_and_transient_failures_are_retried(status, sleeps):
+    sender, http_client = outbound_sender([status, status], max_retries=3)
+    response = sender.send('+1', '+55', body='hi')
+    assert response.sid.startswith('SM')
+    assert [request['status'] for request in http_client.requests] == [status, status, 201]
+    assert len(sleeps) == 2
+    assert sender.stats() == {'senders': 1, 'sent': 1, 'retries': 2, 'failed': 0,
+                              'throttled_seconds': 0}
+
+def test_backoff_is_jittered_and_capped(sleeps, monkeypatch):
+    sender, _ = outbound_sender([503] * 6, max_retries=6, backoff_base=1, backoff_max=4)
+    bounds = []
+    monkeypatch.setattr(sender_module.random, 'uniform',
+                        lambda low, high: bounds.append((low, high)) or high / 2)
+    sender.send('+1', '+55', body='hi')
+    assert bounds == [(0, 1), (0, 2), (0, 4), (0, 4), (0, 4), (0, 4)]
+    assert sleeps == [high / 2 for _, high in bounds]
+
+@pytest.mark.parametrize('status', [400, 401, 404])
+def test_client_errors_are_not_retried(status, sleeps):
+    sender, http_client = outbound_sender([status])
+    with pytest.raises(TwilioRestException):
+        sender.send('+1', '+55', body='hi')
+    assert len(http_client.requests) == 1
+    assert sleeps == []
+    assert sender.stats()['failed'] == 1
+
+def test_retries_stop_after_max_retries(sleeps):
+    sender, http_client = outbound_sender([503] * 5, max_retries=2)
+    with pytest.raises(TwilioRestException):
+        sender.send('+1', '+55', body='hi')
+    assert len(http_client.requests) == 3
+
+def test_retries_stop_at_the_send_timeout(sleeps):
+    sender, http_client = outbound_sender([503] * 5, max_retries=10, backoff_base=10,
+                                          backoff_max=10, send_timeout=1)
+    with pytest.raises(TwilioRestException):
+        sender.send('+1', '+55', body='hi')
+    assert len(http_client.requests) < 5
+
+def test_send_all_stops_at_the_first_failure():
+    sender, http_client = outbound_sender([201, 400])
+    sent = []
+    with pytest.raises(TwilioRestException):
+        sender.send_all('+1', '+55', [{'body': 'one'}, {'body': 'two'}, {'body': 'three'}],
+                        on_sent=lambda index, response: sent.append(index))
+    assert sent == [0]
+    assert [data['Body'] for data in http_client.sent()] == ['one']
+
+def test_replies_to_a_recipient_do_not_interleave():
+    sender, http_client = outbound_sender(latency=0.005)
+    replies = {name: [{'body': f"{name}{index}"} for index in range(4)] for name in 'abc'}
+    threads = [threading.Thread(target=sender.send_all, args=('+1', '+55', messages))
+               for messages in replies.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    sent = [data['Body'] for data in http_client.sent()]
+    assert len(sent) == 12
+    # Each reply went out whole and in order.
+    for start in range(0, 12, 4):
+        assert sent[start:start + 4] == [f"{sent[start][0]}{index}" for index in range(4)]
+    assert sender._recipient_locks == {}
+
+class ConcurrencyProbe(FakeTwilioHttpClient):
+    """Records how many requests were in flight at most."""
+
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.in_flight = self.peak = 0
+        self._probe_lock = threading.Lock()
+
+    def request(self, *args, **kwargs):
+        with self._probe_lock:
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            return super().request(*args, **kwargs)
+        finally:
+            with self._probe_lock:
+                self.in_flight -= 1
+
+def test_recipients_do_not_wait_on_each_other():
+    http_client = ConcurrencyProbe(latency=0.02)
+    sender = OutboundSender(Client('AC00000000000000000000000000000000', 'test', http_client=http_client))
+    threads = [threading.Thread(target=sender.send_all, args=('+1', to, [{'body': 'hi'}] * 2))
+               for to in ('+55', '+56', '+57', '+58')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert http_client.peak > 1
+    assert len(http_client.sent()) == 8
+
+def test_replies_to_a_recipient_are_sent_one_at_a_time():
+    http_client = ConcurrencyProbe(latency=0.005)
+    sender = OutboundSender(Client('AC00000000000000000000000000000000', 'test', http_client=http_client))
+    threads = [threading.Thread(target=sender.send_all, args=('+1', '+55', [{'body': 'hi'}] * 2))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert http_client.peak == 1
@@ -0,0 +1,109 @@
+import datetime
+import pytest
+from sqlmodel import Session, select
+from conftest import APPOINTMENT_TIME
+from database import UnitOfWork, engine
+from models import Appointment, Patient
+from services import slots
+from services.patient import add_patient
+from services.slots import (
+    SlotUnavailable,
+    free_slots,
+    is_open,
+    parse_opening_hours,
+    reserve_slot,
+)
+
+def time(value: str) -> datetime.time:
+    return datetime.time.fromisoformat(value)
+
+MONDAY = APPOINTMENT_TIME.date()
+DURATION = datetime.timedelta(minutes=30)
+
+@pytest.mark.parametrize('text, expected', [
+    ('Mon-Fri 08:00-18:00', {day: [(time('08:00'), time('18:00'))] for day in range(5)}),
+    ('Mon-Fri 08:00-12:00, 13:00-18:00; Sat 8h-12h',
+     {**{day: [(time('08:00'), time('12:00')), (time('13:00'), time('18:00'))] for day in range(5)},
+      5: [(time('08:00'), time('12:00'))]}),
+    ('Segunda a Sexta das 8h às 17h, Sábado 9h-13h',
+     {**{day: [(time('08:00'), time('17:00'))] for day in range(5)}, 5: [(time('09:00'), time('13:00'))]}),
+    ('Sat-Mon 9am-1pm', {day: [(time('09:00'), time('13:00'))] for day in (5, 6, 0)}),
+    ('daily 00:00-24:00', {day: [(time('00:00'), datetime.time.max)] for day in range(7)}),
+    ('9:00-17:00', {day: [(time('09:00'), time('17:00'))] for day in range(5)}),
+    ('Closed for holidays', {}),
+    (None, {}),
+])
+def test_parse_opening_hours(text, expected):
+    assert parse_opening_hours(text) == expected
+
+def test_free_slots_skip_busy_times_and_breaks():
+    hours = parse_opening_hours('Mon 08:00-10:00, 11:00-12:00')
+    busy = [datetime.datetime.combine(MONDAY, time('08:30'))]
+    start = datetime.datetime.combine(MONDAY, time('00:00'))
+    found = free_slots(hours, busy, start, start + datetime.timedelta(days=1), 10, DURATION)
+    assert [slot.time() for slot in found] == [
+        time('08:00'), time('09:00'), time('09:30'), time('11:00'), time('11:30')]
+
+def test_free_slots_respect_the_range_and_limit():
+    hours = parse_opening_hours('Mon-Fri 08:00-18:00')
+    start = datetime.datetime.combine(MONDAY, time('17:00'))
+    found = free_slots(hours, [], start, start + datetime.timedelta(days=1), 3, DURATION)
+    assert found == [start, start + DURATION, datetime.datetime.combine(MONDAY, time('08:00')) + datetime.timedelta(days=1)]
+
+def test_free_slots_run_until_midnight():
+    hours = parse_opening_hours('daily 22:00-24:00')
+    start = datetime.datetime.combine(MONDAY, time('00:00'))
+    found = free_slots(hours, [], start, start + datetime.timedelta(days=1), 10, DURATION)
+    assert found[-1] == datetime.datetime.combine(MONDAY, time('23:30'))
+    assert len(found) == 4
+
+@pytest.mark.parametrize('at, expected', [
+    ('08:00', True),
+    ('17:30', True),
+    ('17:45', False),
+    ('07:45', False),
+    # Ends past midnight, on the next day.
+    ('23:45', False),
+])
+def test_is_open(at, expected):
+    hours = parse_opening_hours('Mon-Fri 08:00-18:00')
+    assert is_open(hours, datetime.datetime.combine(MONDAY, time(at)), DURATION) is expected
+
+def appointment(at: datetime.datetime, patient_id: str = 'p1') -> Appointment:
+    return Appointment(id=f"a-{at:%H%M}-{patient_id}", date_time=at, office_id='o1',
+                       patient_id=patient_id, doctor_id='d1')
+
+def stored(appointment_id: str) -> Appointment | None:
+    with Session(engine) as session:
+        return session.exec(select(Appointment).where(Appointment.id == appointment_id)).first()
+
+def test_reserve_slot_rejects_times_outside_opening_hours(database):
+    late = datetime.datetime.combine(MONDAY, time('23:45'))
+    with pytest.raises(SlotUnavailable, match='outside business hours'):
+        reserve_slot(appointment(late), 'Mon-Fri 08:00-18:00')
+
+def test_reserve_slot_rejects_past_times(database, monkeypatch):
+    monkeypatch.setattr(slots, 'local_now', lambda: APPOINTMENT_TIME)
+    with pytest.raises(SlotUnavailable, match='in the past'):
+        reserve_slot(appointment(APPOINTMENT_TIME - datetime.timedelta(days=1)), 'Mon-Fri 08:00-18:00')
+
+@pytest.mark.parametrize('minutes', [-15, 0, 15])
+def test_reserve_slot_rejects_overlapping_appointments(database, minutes):
+    with pytest.raises(SlotUnavailable) as error:
+        reserve_slot(appointment(APPOINTMENT_TIME + datetime.timedelta(minutes=minutes)),
+                     'Mon-Fri 08:00-18:00')
+    assert error.value.conflict == APPOINTMENT_TIME
+
+def test_reserve_slot_commits_right_away(database):
+    with UnitOfWork() as uow:
+        reserved = reserve_slot(appointment(APPOINTMENT_TIME + DURATION), 'Mon-Fri 08:00-18:00', uow)
+        # Committed on its own, before the unit of work of the turn.
+        assert stored(reserved.id) is not None
+    assert not uow.flushed
+
+def test_reserve_slot_joins_a_unit_of_work_that_wrote(database):
+    with UnitOfWork() as uow:
+        add_patient(Patient(id='p2', name='Eva', phone_number='+6', office_id='o1'), uow)
+        reserved = reserve_slot(appointment(APPOINTMENT_TIME + DURATION, 'p2'), 'Mon-Fri 08:00-18:00', uow)
+        assert stored(reserved.id) is None
+    assert stored(reserved.id) is not None
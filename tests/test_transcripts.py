@@ -0,0 +1,112 @@
+import time
+from types import SimpleNamespace
+import pytest
+from services import media, transcripts
+from services.transcripts import TranscriptCache, find_transcript, sid_key
+
+AUDIO = b'OggS' + bytes(range(256)) * 64
+
+class FakeResponse:
+    def __init__(self, content: bytes, content_length: bool = True):
+        self.content = content
+        self.headers = {'Content-Length': str(len(content))} if content_length else {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        pass
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+class FakeOpenAI:
+    """Transcribes audio to a text naming how many bytes it got."""
+
+    def __init__(self):
+        self.uploads: list[bytes] = []
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self.create))
+
+    def with_options(self, **options):
+        return self
+
+    def create(self, model, file, response_format):
+        self.uploads.append(file[1].read())
+        return f"{len(self.uploads[-1])} bytes of audio"
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = TranscriptCache(str(tmp_path / 'transcripts.db'))
+    monkeypatch.setattr(transcripts, 'transcript_cache', cache)
+    monkeypatch.setattr(media, 'transcript_cache', cache)
+    monkeypatch.setattr(media, 'preprocess_available', False)
+    return cache
+
+def transcribe(monkeypatch, sid: str, openai_client: FakeOpenAI, content: bytes = AUDIO,
+               content_length: bool = True) -> str:
+    monkeypatch.setattr(media.http_session, 'get',
+                        lambda url, **kwargs: FakeResponse(content, content_length))
+    twilio_client = SimpleNamespace(account_sid='AC1', password='secret')
+    return media.transcribe_media(f"https://api.twilio.com/Media/{sid}", '/tmp', 'audio/ogg',
+                                  twilio_client, openai_client)
+
+def test_redelivered_messages_hit_by_sid(cache, monkeypatch):
+    openai_client = FakeOpenAI()
+    transcript = transcribe(monkeypatch, 'ME1', openai_client)
+    assert openai_client.uploads == [AUDIO]
+    assert find_transcript('https://api.twilio.com/Media/ME1') == transcript
+    assert find_transcript('https://api.twilio.com/Media/ME2') is None
+
+def test_forwarded_copies_hit_by_content_hash(cache, monkeypatch):
+    openai_client = FakeOpenAI()
+    transcript = transcribe(monkeypatch, 'ME1', openai_client)
+    assert transcribe(monkeypatch, 'ME2', openai_client) == transcript
+    assert len(openai_client.uploads) == 1
+    # The new SID is an alias from now on.
+    assert find_transcript('https://api.twilio.com/Media/ME2') == transcript
+
+def test_different_audio_is_transcribed(cache, monkeypatch):
+    openai_client = FakeOpenAI()
+    transcribe(monkeypatch, 'ME1', openai_client)
+    transcribe(monkeypatch, 'ME2', openai_client, AUDIO + b'more')
+    assert len(openai_client.uploads) == 2
+
+def test_streamed_voice_notes_are_stored_under_their_hash(cache, monkeypatch):
+    openai_client = FakeOpenAI()
+    # Without a length the audio is streamed, it can't be looked up before the upload.
+    transcript = transcribe(monkeypatch, 'ME1', openai_client, content_length=False)
+    transcribe(monkeypatch, 'ME2', openai_client, content_length=False)
+    assert len(openai_client.uploads) == 2
+    assert transcribe(monkeypatch, 'ME3', openai_client) == transcript
+    assert len(openai_client.uploads) == 2
+
+def test_large_voice_notes_are_streamed(cache, monkeypatch):
+    monkeypatch.setattr(media, 'hash_lookup_max_bytes', len(AUDIO) - 1)
+    openai_client = FakeOpenAI()
+    transcribe(monkeypatch, 'ME1', openai_client)
+    transcribe(monkeypatch, 'ME2', openai_client)
+    assert len(openai_client.uploads) == 2
+
+def test_entries_expire(tmp_path):
+    cache = TranscriptCache(str(tmp_path / 'transcripts.db'), ttl=0.01)
+    cache.set(sid_key('https://api.twilio.com/Media/ME1'), 'hello')
+    assert cache.get('sid:ME1') == 'hello'
+    time.sleep(0.02)
+    assert cache.get('sid:ME1') is None
+
+def test_least_recently_used_entries_are_dropped(tmp_path):
+    cache = TranscriptCache(str(tmp_path / 'transcripts.db'), max_entries=2)
+    cache.set('sid:ME1', 'one')
+    time.sleep(0.01)
+    cache.set('sid:ME2', 'two')
+    time.sleep(0.01)
+    cache.get('sid:ME1')
+    time.sleep(0.01)
+    cache.set('sid:ME3', 'three')
+    assert cache.get('sid:ME2') is None
+    assert cache.get('sid:ME1') == 'one'
+    assert cache.stats()['size'] == 2
@@ -1,3 +1,4 @@
+import os
 import datetime
 import pytz
 
@@ -9,3 +10,9 @@ def actual_date_time(tz) -> SystemDateTime:
     tz = pytz.timezone(tz)
     now = datetime.datetime.now(tz)
     return SystemDateTime(now.strftime("%Y-%m-%dT%H:%M:%S%z"))
+
+def env_flag(name: str, default: bool = False) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')